@@ -0,0 +1,65 @@
+#!/usr/bin/python
+"""
+This file contains bench_alert.py which measures the time pistatsview.py takes
+to check an updated device against the alert rules, as the number of rules
+grows while the number of rules applying to each device stays the same
+
+$ python benchmarks/bench_alert.py [-d devices] [-n samples] [-r rules[,rules...]]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from pistatsalert import AlertEngine, AlertRule
+from pistatsstore import StatsStore
+
+
+def make_rules(count):
+    """
+    Builds rules spread over as many sites, 4 of which apply to the devices of site0
+
+    :param count: (int) The number of rules
+    :return: (list) The AlertRule objects
+    """
+    templates = ("cpu > 90%% for 30s on site%d.*", "cpu0 > 0.95 on site%d.#",
+                 "eth0 tx < 1000 B/s on site%d.*", "* rx_drop > 0 /s on site%d.#")
+    return [AlertRule(templates[i % len(templates)] % (i / len(templates))) for i in range(count)]
+
+
+def bench_evaluate(devices, count, rules):
+    """
+    Aggregates samples of the devices of site0 and checks them against the rules
+
+    :return: (float) The number of microseconds per sample spent checking the rules
+    """
+    store = StatsStore()
+    engine = AlertEngine(rules, [])
+    sample = {"cpu": 0.5, "cores": [0.5, 0.5], "net": {"eth0": {"rx": 5000, "tx": 5000, "rx_drop": 0}}}
+    updated = [store.aggregate("site0.pi%d" % (i), [sample]) for i in range(devices)]
+
+    def run():
+        for i in range(count):
+            engine.evaluate(updated[i % devices], i)
+    return timeit.timeit(run, number=1) * 1e6 / count
+
+
+# Application Entry Point
+# ^^^^^^^^^^^^^^^^^^^^^^^
+if __name__ == "__main__":
+    devices = 100
+    count = 100000
+    rule_counts = (4, 40, 400, 4000)
+    for i in range(1, len(sys.argv) - 1):
+        if sys.argv[i] == "-d":
+            devices = int(sys.argv[i + 1])
+        elif sys.argv[i] == "-n":
+            count = int(sys.argv[i + 1])
+        elif sys.argv[i] == "-r":
+            rule_counts = [int(rules) for rules in sys.argv[i + 1].split(",")]
+
+    print "%d device(s), %d sample(s)" % (devices, count)
+    for rules in rule_counts:
+        print "%5d rule(s)  %8.2f us/sample" % (rules, bench_evaluate(devices, count, make_rules(rules)))
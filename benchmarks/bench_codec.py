@@ -0,0 +1,82 @@
+#!/usr/bin/python
+"""
+This file contains bench_codec.py which compares the size on the wire and the
+encode/decode time of every message format supported by pistatscodec.py
+
+$ python benchmarks/bench_codec.py [-i interfaces] [-n iterations]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from pistatscodec import StatsEncoder, StatsDecoder, FORMATS
+from pistatscommon import CPU_STATES, NET_COUNTERS
+
+
+def make_msg(ifaces):
+    """
+    Returns a utilization message like the ones pistatsd.py publishes
+
+    :param ifaces: (int) The number of network interfaces in the message
+    :return: (dict) The utilization message
+    """
+    net = dict()
+    for i in range(ifaces):
+        counters = dict((counter, 12.5 + i) for counter in NET_COUNTERS)
+        counters["rx"] = 1234567 + i
+        counters["tx"] = 7654321 + i
+        net["eth%d" % i] = counters
+    return {"cpu": 0.4242424242,
+            "cpu_states": dict((state, 0.125) for state in CPU_STATES),
+            "cores": [0.42, 0.24, 0.12, 0.21],
+            "net": net}
+
+
+def bench_format(fmt, msg, iterations):
+    """
+    Measures one message format
+
+    :param fmt: (str) The name of the message format
+    :param msg: (dict) The utilization message to encode
+    :param iterations: (int) The number of messages to encode and decode
+    :return: (tuple) The average body size in bytes and the encode and decode
+             times per message in microseconds
+    """
+    encoder = StatsEncoder(fmt)
+    decoder = StatsDecoder()
+
+    # Encode a full dictionary cycle so that the struct sizes include the
+    # repeated interface dictionary
+    bodies = [encoder.encode(msg) for i in range(iterations)]
+    size = float(sum(len(body) for body in bodies)) / len(bodies)
+
+    encode_time = timeit.timeit(lambda: encoder.encode(msg), number=iterations)
+
+    def decode_all():
+        for body in bodies:
+            decoder.decode("bench", encoder.content_type, body)
+    decode_time = timeit.timeit(decode_all, number=1)
+
+    return size, encode_time * 1e6 / iterations, decode_time * 1e6 / iterations
+
+
+# Application Entry Point
+# ^^^^^^^^^^^^^^^^^^^^^^^
+if __name__ == "__main__":
+    ifaces = 3
+    iterations = 20000
+    for i in range(1, len(sys.argv) - 1):
+        if sys.argv[i] == "-i":
+            ifaces = int(sys.argv[i + 1])
+        elif sys.argv[i] == "-n":
+            iterations = int(sys.argv[i + 1])
+
+    msg = make_msg(ifaces)
+    print "%d interface(s), %d message(s) per format" % (ifaces, iterations)
+    print "%-8s %12s %12s %12s" % ("format", "bytes/msg", "encode us", "decode us")
+    for fmt in FORMATS:
+        size, encode_us, decode_us = bench_format(fmt, msg, iterations)
+        print "%-8s %12.1f %12.2f %12.2f" % (fmt, size, encode_us, decode_us)
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+"""
+This file contains bench_e2e.py which runs simulated pistatsd.py publishers
+against an in-process stand-in for the message broker, consumed the way
+pistatsview.py consumes, and reports the messages handled per second along
+with the percentiles of the time spent in each stage and of the end-to-end
+latency, measured from the time sent along with every message
+
+The results can be saved, and compared with saved ones to catch performance
+regressions: the comparison fails if the throughput dropped, or a percentile
+grew, by more than the tolerance.
+
+$ python benchmarks/bench_e2e.py [-d devices] [-n rounds] [-f format] [-b batch] [--save file] [--compare file] [--tolerance percent]
+"""
+
+import json
+import os
+import sys
+import time
+import timeit
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from bench_codec import make_msg
+from pistatscodec import StatsEncoder, StatsDecoder
+from pistatscommon import monotonic, SAMPLED_HEADER
+from pistatsmetrics import Metrics, METRIC_QUANTILES
+from pistatspublisher import BatchPublisher
+from pistatsstore import StatsStore, handle_msg
+from pistatswindow import merged_quantile, WINDOWS
+
+# The percentiles compared with the saved results
+COMPARED_QUANTILE = 0.99
+
+
+class StandInQueue(object):
+    """
+    Stands in for a broker channel, queueing every published message for the
+    consumer
+    """
+
+    def __init__(self):
+        """
+        Create a new, empty StandInQueue object
+
+        :return: None
+        """
+        self.msgs = deque()
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.msgs.append((routing_key, body, properties))
+        return True
+
+
+def run_fleet(devices, rounds, fmt, batch_size):
+    """
+    Publishes a sample per device and round, consuming the queue after every round
+
+    :param devices: (int) The number of simulated publishers
+    :param rounds: (int) The number of samples each publisher takes
+    :param fmt: (str) The message format
+    :param batch_size: (int) The number of samples per message
+    :return: (tuple) The number of seconds taken, the publisher and the subscriber metrics
+    """
+    queue = StandInQueue()
+    publisher_metrics = Metrics("pistatsd")
+    viewer_metrics = Metrics("pistatsview")
+    publishers = [BatchPublisher(queue, "bench", "site%d.pi%d" % (i % 10, i), StatsEncoder(fmt), batch_size,
+                                 metrics=publisher_metrics) for i in range(devices)]
+    decoder = StatsDecoder()
+    store = StatsStore(WINDOWS)
+    msg = make_msg(3)
+
+    def run():
+        for round in range(rounds):
+            now = monotonic()
+            for publisher in publishers:
+                publisher.add(msg, now)
+            while queue.msgs:
+                routing_key, body, properties = queue.msgs.popleft()
+                viewer_metrics.count("messages_total")
+                sampled = properties.headers and properties.headers.get(SAMPLED_HEADER)
+                handle_msg(decoder, store, routing_key, properties.content_type, body, viewer_metrics)
+                if sampled:
+                    viewer_metrics.observe("end_to_end_seconds", max(0.0, time.time() - float(sampled)))
+    seconds = timeit.timeit(run, number=1)
+    return seconds, publisher_metrics, viewer_metrics
+
+
+def results(seconds, publisher_metrics, viewer_metrics):
+    """
+    :return: (dict) The messages per second, and the percentiles of every summary in microseconds
+    """
+    result = {"msgs_per_s": viewer_metrics.counters.get("messages_total", 0) / seconds}
+    for metrics in (publisher_metrics, viewer_metrics):
+        for name, summary in metrics.summaries.items():
+            for p in METRIC_QUANTILES:
+                key = "%s_%s_p%d_us" % (metrics.prefix, name.replace("_seconds", ""), p * 100)
+                result[key] = merged_quantile([summary.sketch], p) * 1e6
+    return result
+
+
+def compare(result, baseline, tolerance):
+    """
+    Prints the change of every result against the saved ones
+
+    :return: (list) The names of the results that regressed beyond the tolerance
+    """
+    regressions = []
+    for name in sorted(result):
+        if name not in baseline or baseline[name] == 0:
+            continue
+        change = (result[name] - baseline[name]) * 100.0 / baseline[name]
+        if name == "msgs_per_s":
+            regressed = change < -tolerance
+        else:
+            regressed = name.endswith("_p%d_us" % (COMPARED_QUANTILE * 100)) and change > tolerance
+        print "%-45s %12.2f %12.2f %+7.1f%%%s" % (name, baseline[name], result[name], change,
+                                                  "  REGRESSION" if regressed else "")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+# Application Entry Point
+# ^^^^^^^^^^^^^^^^^^^^^^^
+if __name__ == "__main__":
+    devices = 100
+    rounds = 200
+    fmt = "struct"
+    batch_size = 1
+    save_path = None
+    compare_path = None
+    tolerance = 20.0
+    for i in range(1, len(sys.argv) - 1):
+        if sys.argv[i] == "-d":
+            devices = int(sys.argv[i + 1])
+        elif sys.argv[i] == "-n":
+            rounds = int(sys.argv[i + 1])
+        elif sys.argv[i] == "-f":
+            fmt = sys.argv[i + 1]
+        elif sys.argv[i] == "-b":
+            batch_size = int(sys.argv[i + 1])
+        elif sys.argv[i] == "--save":
+            save_path = sys.argv[i + 1]
+        elif sys.argv[i] == "--compare":
+            compare_path = sys.argv[i + 1]
+        elif sys.argv[i] == "--tolerance":
+            tolerance = float(sys.argv[i + 1])
+
+    seconds, publisher_metrics, viewer_metrics = run_fleet(devices, rounds, fmt, batch_size)
+    result = results(seconds, publisher_metrics, viewer_metrics)
+    print "%d publisher(s), %d sample(s) each, %s format, %d sample(s) per message" % (devices, rounds, fmt, batch_size)
+    print "%-45s %12.0f" % ("msgs_per_s", result["msgs_per_s"])
+    for name in sorted(result):
+        if name != "msgs_per_s":
+            print "%-45s %12.2f" % (name, result[name])
+
+    if save_path is not None:
+        with open(save_path, "w") as saved:
+            json.dump(result, saved, indent=4, sort_keys=True)
+        print "Saved the results in " + save_path
+
+    if compare_path is not None:
+        with open(compare_path) as saved:
+            baseline = json.load(saved)
+        print
+        print "%-45s %12s %12s %8s" % ("result", "baseline", "current", "change")
+        regressions = compare(result, baseline, tolerance)
+        if regressions:
+            print "%d result(s) regressed by more than %g%%" % (len(regressions), tolerance)
+            sys.exit(1)
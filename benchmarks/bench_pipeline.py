@@ -0,0 +1,98 @@
+#!/usr/bin/python
+"""
+This file contains bench_pipeline.py which measures how many messages per
+second pistatsview.py decodes and aggregates, on the consumer and with a
+growing number of pistatspipeline.py worker processes
+
+$ python benchmarks/bench_pipeline.py [-d devices] [-n messages] [-w max_workers]
+"""
+
+import multiprocessing
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from bench_codec import make_msg
+from pistatscodec import StatsEncoder, StatsDecoder
+from pistatspipeline import ShardedPipeline
+from pistatsstore import StatsStore, handle_msg
+from pistatswindow import WINDOWS
+
+
+def make_msgs(devices, count):
+    """
+    Returns the messages a fleet of devices publishes, in arrival order
+
+    :param devices: (int) The number of devices publishing
+    :param count: (int) The total number of messages
+    :return: (tuple) The content type and a list of (routing key, body) pairs
+    """
+    encoders = [StatsEncoder("struct") for i in range(devices)]
+    msg = make_msg(3)
+    msgs = []
+    for i in range(count):
+        device = i % devices
+        msgs.append(("pi%d" % device, encoders[device].encode(msg)))
+    return encoders[0].content_type, msgs
+
+
+def bench_inline(content_type, msgs):
+    """
+    Decodes and aggregates the messages on the calling thread
+
+    :return: (float) The number of seconds taken
+    """
+    decoder = StatsDecoder()
+    store = StatsStore(WINDOWS)
+
+    def run():
+        for routing_key, body in msgs:
+            handle_msg(decoder, store, routing_key, content_type, body)
+    return timeit.timeit(run, number=1)
+
+
+def bench_workers(content_type, msgs, workers):
+    """
+    Decodes and aggregates the messages on a pool of worker processes
+
+    :return: (float) The number of seconds taken, including merging the
+             results of the workers
+    """
+    pipeline = ShardedPipeline(workers, spans=WINDOWS)
+    store = StatsStore(WINDOWS)
+
+    def run():
+        for routing_key, body in msgs:
+            pipeline.submit(routing_key, content_type, body)
+            if pipeline.submitted_msgs % 1000 == 0:
+                for device in pipeline.collect():
+                    store.merge(device)
+        for device in pipeline.close():
+            store.merge(device)
+    return timeit.timeit(run, number=1)
+
+
+# Application Entry Point
+# ^^^^^^^^^^^^^^^^^^^^^^^
+if __name__ == "__main__":
+    devices = 1000
+    count = 50000
+    max_workers = 4
+    for i in range(1, len(sys.argv) - 1):
+        if sys.argv[i] == "-d":
+            devices = int(sys.argv[i + 1])
+        elif sys.argv[i] == "-n":
+            count = int(sys.argv[i + 1])
+        elif sys.argv[i] == "-w":
+            max_workers = int(sys.argv[i + 1])
+
+    content_type, msgs = make_msgs(devices, count)
+    print "%d device(s), %d message(s), %d cpu(s)" % (devices, count, multiprocessing.cpu_count())
+    print "%-8s %12s" % ("workers", "msgs/s")
+    print "%-8s %12.0f" % ("inline", count / bench_inline(content_type, msgs))
+    workers = 1
+    while workers <= max_workers:
+        print "%-8d %12.0f" % (workers, count / bench_workers(content_type, msgs, workers))
+        workers *= 2
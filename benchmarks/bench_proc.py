@@ -0,0 +1,160 @@
+#!/usr/bin/python
+"""
+This file contains bench_proc.py which measures the cost of a single sample
+of the cpu and network interface statistics, comparing the samplers of
+pistatsproc.py to the original readers that reopened and split the /proc
+files on every tick. Both sides read the files and build the message that is
+published, the samplers reading the per core and per cpu state times from
+/proc/stat where the original readers only read /proc/uptime. The original
+readers are also extended to read the same columns as the samplers, the way
+they would have had to, so that both sides can be compared on the same message
+
+$ python benchmarks/bench_proc.py [-n iterations]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from pistatscommon import CPU_STATES, NET_COUNTERS
+from pistatsproc import CpuStatSampler, NetDevSampler, build_utilization_msg
+
+
+def legacy_sample():
+    """
+    Reads /proc/uptime and /proc/net/dev like the original pistatsd.py did,
+    converting the values back to numbers afterwards
+
+    :return: (tuple) The uptime, the idle time and a dictionary of the rx/tx
+             bytes of each interface
+    """
+    uptime = open("/proc/uptime", "r")
+    x = uptime.read().split()
+    uptime.close()
+
+    net = dict()
+    net_info = open("/proc/net/dev")
+    for iface in net_info:
+        if iface.find(':') != -1:
+            x2 = iface.split()
+            net[x2[0]] = {"rx": x2[1], "tx": x2[9]}
+    net_info.close()
+    return x[0], x[1], net
+
+
+class LegacyTick(object):
+    """
+    Samples and builds the utilization message like the original pistatsd.py
+    main loop did, from the previous sample
+    """
+
+    def __init__(self):
+        self.__last = legacy_sample()
+
+    def __call__(self):
+        current = legacy_sample()
+        last = self.__last
+        msg = {"cpu": 1 - ((float(current[1]) - float(last[1])) / ((float(current[0]) - float(last[0])) or 1.0)),
+               "net": dict()}
+        for iface in current[2].keys():
+            if iface in last[2]:
+                msg["net"][iface] = {"rx": int(float(current[2][iface]["rx"]) - float(last[2][iface]["rx"])),
+                                     "tx": int(float(current[2][iface]["tx"]) - float(last[2][iface]["tx"]))}
+        self.__last = current
+        return msg
+
+
+class LegacyStatTick(object):
+    """
+    Samples and builds the same utilization message as the samplers, the way
+    the original pistatsd.py read the files: reopening them and splitting
+    every line on every tick
+    """
+
+    def __init__(self, counters=NET_COUNTERS):
+        self.__columns = [(counter, NET_COUNTERS.index(counter) + 1) for counter in counters]
+        self.__last = self.__sample()
+
+    def __sample(self):
+        stat = open("/proc/stat", "r")
+        cpus = [map(float, line.split()[1:len(CPU_STATES) + 1]) for line in stat if line.startswith("cpu")]
+        stat.close()
+
+        net = dict()
+        net_info = open("/proc/net/dev")
+        for iface in net_info:
+            if iface.find(':') != -1:
+                x2 = iface.replace(":", " ").split()
+                net[x2[0]] = dict((counter, float(x2[column])) for counter, column in self.__columns)
+        net_info.close()
+        return cpus, net
+
+    def __call__(self):
+        current = self.__sample()
+        last = self.__last
+        utilizations = []
+        states = None
+        for row, previous in zip(current[0], last[0]):
+            deltas = [value - last_value for value, last_value in zip(row, previous)]
+            total = sum(deltas) or 1.0
+            utilizations.append(1 - (deltas[3] + deltas[4]) / total)
+            if states is None:
+                states = dict(zip(CPU_STATES, [delta / total for delta in deltas]))
+        msg = {"cpu": utilizations[0], "cpu_states": states, "cores": utilizations[1:], "net": dict()}
+        for iface, counters in current[1].items():
+            if iface in last[1]:
+                rates = dict((counter, value - last[1][iface][counter]) for counter, value in counters.items())
+                rates["rx"] = int(rates["rx"])
+                rates["tx"] = int(rates["tx"])
+                msg["net"][iface] = rates
+        self.__last = current
+        return msg
+
+
+class SamplerTick(object):
+    """
+    Samples and builds the utilization message like pistatsd.py does
+    """
+
+    def __init__(self, counters=NET_COUNTERS):
+        self.cpu_sampler = CpuStatSampler()
+        self.net_sampler = NetDevSampler(counters=counters)
+        self.cpu_sampler.sample()
+        self.net_sampler.sample()
+
+    def __call__(self):
+        self.cpu_sampler.sample()
+        self.net_sampler.sample()
+        return build_utilization_msg(self.cpu_sampler, self.net_sampler, 1.0)
+
+    def close(self):
+        self.cpu_sampler.close()
+        self.net_sampler.close()
+
+
+# Application Entry Point
+# ^^^^^^^^^^^^^^^^^^^^^^^
+if __name__ == "__main__":
+    iterations = 20000
+    for i in range(1, len(sys.argv) - 1):
+        if sys.argv[i] == "-n":
+            iterations = int(sys.argv[i + 1])
+
+    # The samplers publish every counter by default, and the same rx/tx
+    # bytes as the legacy readers with pistatsd.py --counters rx,tx. Each
+    # is run 5 times and the fastest run is kept, the others being slowed
+    # down by whatever else runs on the machine
+    samplers = [("sampler", SamplerTick()), ("rx,tx", SamplerTick(("rx", "tx")))]
+    readers = [("legacy", LegacyTick()), ("legacy-all", LegacyStatTick()),
+               ("legacy-rx,tx", LegacyStatTick(("rx", "tx")))] + samplers
+    print "%d sample(s), %d cpu(s), %d interface(s)" % (iterations, samplers[0][1].cpu_sampler.cores,
+                                                         len(samplers[0][1].net_sampler.ifaces))
+    print "%-12s %12s" % ("reader", "us/sample")
+    for name, sample in readers:
+        elapsed = min(timeit.repeat(sample, number=iterations, repeat=5))
+        print "%-12s %12.2f" % (name, elapsed * 1e6 / iterations)
+
+    for name, sample in samplers:
+        sample.close()
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+"""
+This file contains bench_record.py which measures the cost of recording the
+samples received by pistatsview.py, compared to aggregating them, and the
+time pistatsreplay.py takes to aggregate the recording
+
+$ python benchmarks/bench_record.py [-d devices] [-n samples] [-i interfaces]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from bench_codec import make_msg
+from pistatsrecord import SegmentRecorder, list_segments
+from pistatsreplay import aggregate_device
+from pistatsstore import StatsStore
+
+
+def bench_aggregate(devices, count, msg, recorder):
+    """
+    Aggregates samples into a store, optionally recording them
+
+    :return: (float) The number of microseconds per sample
+    """
+    store = StatsStore((), recorder)
+
+    def run():
+        for i in range(count):
+            store.aggregate("pi%d" % (i % devices), [msg])
+    return timeit.timeit(run, number=1) * 1e6 / count
+
+
+def bench_replay(directory):
+    """
+    Aggregates the 'cpu' and every 'rx' column of the recording like pistatsreplay.py does
+
+    :return: (tuple) The number of records read and the number of seconds taken
+    """
+    records = [0]
+
+    def run():
+        for routing_key, paths in list_segments(directory).items():
+            aggregates = aggregate_device(paths, ["cpu", "*.rx"], float("-inf"), float("inf"))
+            records[0] += aggregates["cpu"].count
+    seconds = timeit.timeit(run, number=1)
+    return records[0], seconds
+
+
+# Application Entry Point
+# ^^^^^^^^^^^^^^^^^^^^^^^
+if __name__ == "__main__":
+    devices = 100
+    count = 100000
+    ifaces = 3
+    for i in range(1, len(sys.argv) - 1):
+        if sys.argv[i] == "-d":
+            devices = int(sys.argv[i + 1])
+        elif sys.argv[i] == "-n":
+            count = int(sys.argv[i + 1])
+        elif sys.argv[i] == "-i":
+            ifaces = int(sys.argv[i + 1])
+
+    msg = make_msg(ifaces)
+    directory = tempfile.mkdtemp(prefix="bench_record")
+    try:
+        print "%d device(s), %d sample(s), %d interface(s)" % (devices, count, ifaces)
+        print "aggregate only      %8.2f us/sample" % (bench_aggregate(devices, count, msg, None))
+        recorder = SegmentRecorder(directory)
+        print "aggregate + record  %8.2f us/sample" % (bench_aggregate(devices, count, msg, recorder))
+        recorder.close()
+        records, seconds = bench_replay(directory)
+        print "replay              %8.0f records/s over %d segment(s)" % (records / seconds, recorder.segments)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+"""
+This file contains bench_summary.py which measures the cost of summarizing the
+samples pistatsd.py --summary takes at a fast rate, and the bytes it publishes
+per second compared to publishing every sample
+
+$ python benchmarks/bench_summary.py [-i interfaces] [--interval interval] [--summary period] [-n samples]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from bench_codec import make_msg
+from pistatscodec import StatsEncoder, FORMATS
+from pistatscommon import parse_duration
+from pistatspublisher import SampleSummarizer
+
+
+def bench_summarize(msg, interval, period, count):
+    """
+    Summarizes samples taken every interval
+
+    :return: (tuple) The number of microseconds per sample, and the summaries
+    """
+    summarizer = SampleSummarizer(period)
+    summaries = []
+
+    def run():
+        for i in range(count):
+            summaries.extend(summarizer.add(msg, i * interval))
+    return timeit.timeit(run, number=1) * 1e6 / count, summaries
+
+
+def bytes_per_second(fmt, msgs, seconds):
+    """
+    :return: (float) The number of bytes per second of the messages, encoded in a format
+    """
+    encoder = StatsEncoder(fmt)
+    return sum(len(encoder.encode(msg)) for msg in msgs) / seconds
+
+
+# Application Entry Point
+# ^^^^^^^^^^^^^^^^^^^^^^^
+if __name__ == "__main__":
+    ifaces = 3
+    interval = 0.05
+    period = 5.0
+    count = 20000
+    for i in range(1, len(sys.argv) - 1):
+        if sys.argv[i] == "-i":
+            ifaces = int(sys.argv[i + 1])
+        elif sys.argv[i] == "--interval":
+            interval = parse_duration(sys.argv[i + 1])
+        elif sys.argv[i] == "--summary":
+            period = parse_duration(sys.argv[i + 1])
+        elif sys.argv[i] == "-n":
+            count = int(sys.argv[i + 1])
+
+    msg = make_msg(ifaces)
+    cost, summaries = bench_summarize(msg, interval, period, count)
+    seconds = count * interval
+    print "%d interface(s), sampled every %gs, summarized every %gs" % (ifaces, interval, period)
+    print "summarize           %8.2f us/sample" % (cost)
+    for fmt in FORMATS:
+        print "%-8s raw       %8.0f bytes/s" % (fmt, bytes_per_second(fmt, [msg] * count, seconds))
+        print "%-8s summaries %8.0f bytes/s" % (fmt, bytes_per_second(fmt, summaries, seconds))
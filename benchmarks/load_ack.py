@@ -0,0 +1,145 @@
+#!/usr/bin/python
+"""
+This file contains load_ack.py which load tests the way pistatsview.py
+acknowledges its messages, against a local stand-in for the message broker
+
+The stand-in broker publishes faster than the viewer handles the messages,
+and pushes them into the viewer's receive buffer as long as the prefetch
+count allows it. Every basic.ack is marshalled into an AMQP frame, as pika
+would send it. For each acknowledgement setting, the load test reports the
+messages handled per second, the acknowledgement frames and bytes sent per
+message, and the peak number of messages buffered by the viewer.
+
+$ python benchmarks/load_ack.py [-d devices] [-n messages] [-r publish_ratio]
+"""
+
+import os
+import sys
+import timeit
+from collections import deque
+
+import pika.frame
+import pika.spec
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from bench_pipeline import make_msgs
+from pistatsack import BulkAcknowledger, PREFETCH_COUNT
+from pistatscodec import StatsDecoder
+from pistatsstore import StatsStore, handle_msg
+
+# Number of messages the viewer handles between two pushes of the broker
+HANDLE_SLICE = 10
+
+
+class StandInBroker(object):
+    """
+    Stands in for a broker channel, holding the messages published for the
+    viewer and tracking the ones it didn't acknowledge yet
+    """
+
+    def __init__(self, msgs, prefetch):
+        """
+        Create a new StandInBroker object
+
+        :param msgs: (list) The (routing key, body) pairs to deliver
+        :param prefetch: (int) The number of unacknowledged messages sent, None for no acknowledgements
+        :return: None
+        """
+        self.msgs = msgs
+        self.prefetch = prefetch
+        self.is_open = True
+        self.published = 0
+        self.delivered = 0
+        self.acked = 0
+        self.ack_frames = 0
+        self.ack_bytes = 0
+
+    def publish(self, count):
+        """
+        Makes more messages available for delivery, as the devices publish them
+
+        :param count: (int) The number of messages published
+        :return: None
+        """
+        self.published = min(len(self.msgs), self.published + count)
+
+    def push(self, buffer):
+        """
+        Delivers the published messages into the viewer's receive buffer, up to the prefetch count
+
+        :param buffer: (collections.deque) The viewer's receive buffer
+        :return: None
+        """
+        limit = self.published
+        if self.prefetch is not None:
+            limit = min(limit, self.acked + self.prefetch)
+        while self.delivered < limit:
+            routing_key, body = self.msgs[self.delivered]
+            self.delivered += 1
+            buffer.append((self.delivered, routing_key, body))
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        frame = pika.frame.Method(1, pika.spec.Basic.Ack(delivery_tag, multiple))
+        self.ack_bytes += len(frame.marshal())
+        self.ack_frames += 1
+        self.acked = delivery_tag if multiple else self.acked + 1
+
+
+def load_test(content_type, msgs, prefetch, ack_every, publish_ratio):
+    """
+    Consumes every message from a stand-in broker
+
+    :param content_type: (str) The content type of the messages
+    :param msgs: (list) The (routing key, body) pairs to consume
+    :param prefetch: (int) The prefetch count, None to consume without acknowledgements
+    :param ack_every: (int) The number of messages acknowledged at once
+    :param publish_ratio: (float) The number of messages published per message handled
+    :return: (tuple) The number of seconds taken, the broker and the peak size of the receive buffer
+    """
+    broker = StandInBroker(msgs, prefetch)
+    acknowledger = BulkAcknowledger(broker, ack_every, 0) if prefetch is not None else None
+    decoder = StatsDecoder()
+    store = StatsStore()
+    buffer = deque()
+    peak = [0]
+
+    def run():
+        while broker.delivered < len(msgs) or buffer:
+            broker.publish(int(HANDLE_SLICE * publish_ratio))
+            broker.push(buffer)
+            peak[0] = max(peak[0], len(buffer))
+            for i in range(min(HANDLE_SLICE, len(buffer))):
+                delivery_tag, routing_key, body = buffer.popleft()
+                handle_msg(decoder, store, routing_key, content_type, body)
+                if acknowledger is not None:
+                    acknowledger.ack(delivery_tag)
+        if acknowledger is not None:
+            acknowledger.flush()
+    return timeit.timeit(run, number=1), broker, peak[0]
+
+
+# Application Entry Point
+# ^^^^^^^^^^^^^^^^^^^^^^^
+if __name__ == "__main__":
+    devices = 100
+    count = 20000
+    publish_ratio = 4.0
+    for i in range(1, len(sys.argv) - 1):
+        if sys.argv[i] == "-d":
+            devices = int(sys.argv[i + 1])
+        elif sys.argv[i] == "-n":
+            count = int(sys.argv[i + 1])
+        elif sys.argv[i] == "-r":
+            publish_ratio = float(sys.argv[i + 1])
+
+    content_type, msgs = make_msgs(devices, count)
+    print "%d device(s), %d message(s), publishing %gx faster than handled" % (devices, count, publish_ratio)
+    print "%-10s %10s %10s %12s %12s %12s" % ("prefetch", "ack every", "msgs/s", "acks/msg", "ack B/msg", "peak buffer")
+    settings = [(None, 1), (PREFETCH_COUNT, 1), (PREFETCH_COUNT, 10), (PREFETCH_COUNT, 25), (PREFETCH_COUNT, 50),
+                (PREFETCH_COUNT, PREFETCH_COUNT)]
+    for prefetch, ack_every in settings:
+        seconds, broker, peak = load_test(content_type, msgs, prefetch, ack_every, publish_ratio)
+        print "%-10s %10s %10.0f %12.3f %12.2f %12d" % (prefetch or "none", ack_every if prefetch else "-",
+                                                         count / seconds, float(broker.ack_frames) / count,
+                                                         float(broker.ack_bytes) / count, peak)
@@ -0,0 +1,111 @@
+"""
+This file contains the acknowledger used by pistatsview.py to acknowledge the
+messages it consumed in bulk
+
+Rather than acknowledging every message on its own, the acknowledger waits
+until a number of messages were handled, or the oldest of them waited long
+enough, and acknowledges them all with a single basic.ack carrying the
+'multiple' flag. Since the broker doesn't send more than the prefetch count of
+unacknowledged messages, the number of messages the viewer holds stays bounded,
+and the messages that weren't acknowledged yet are redelivered to another
+consumer if the viewer crashes.
+"""
+
+from pistatscommon import monotonic
+
+# Default number of unacknowledged messages the broker may send to the viewer
+PREFETCH_COUNT = 100
+
+# Default number of handled messages acknowledged at once
+ACK_EVERY = 25
+
+# Default number of seconds a handled message waits for its acknowledgement
+ACK_TIME = 0.1
+
+
+class BulkAcknowledger(object):
+    """
+    Acknowledges the messages handled on a channel every few messages, or
+    every few milliseconds, whichever comes first
+    """
+
+    def __init__(self, channel, ack_every=ACK_EVERY, ack_time=ACK_TIME):
+        """
+        Create a new BulkAcknowledger object
+
+        :param channel: (pika.channel.Channel) The channel the messages are
+                        received from, blocking or not
+        :param ack_every: (int) The number of handled messages acknowledged
+                          at once. It must not exceed the prefetch count, or
+                          the broker stops sending before it is reached
+        :param ack_time: (float) The maximum number of seconds a handled
+                         message waits for its acknowledgement, 0 for no limit
+        :raises ValueError: if ack_every is lower than one
+        :return: None
+        """
+        if ack_every < 1:
+            raise ValueError("At least one message must be acknowledged at once")
+
+        self.__channel = channel
+        self.__ack_every = ack_every
+        self.__ack_time = ack_time
+        self.__connection = None
+
+        # The delivery tag of the last handled message, and the number of
+        # handled messages not acknowledged yet
+        self.__last_tag = None
+        self.__pending = 0
+        self.__pending_since = None
+
+        # Counters reported when the viewer exits
+        self.acked_msgs = 0
+        self.ack_frames = 0
+
+    def start(self, connection):
+        """
+        Starts the timer acknowledging the messages handled before a lull
+
+        :param connection: (pika.BlockingConnection) The connection, or the
+                           IOLoop, whose event loop drives the timer
+        :return: None
+        """
+        if self.__ack_time > 0:
+            self.__connection = connection
+            connection.add_timeout(self.__ack_time, self.__on_timer)
+
+    def ack(self, delivery_tag):
+        """
+        Records that a message was handled, acknowledging it along with the
+        previous ones once they are due
+
+        :param delivery_tag: (int) The delivery tag of the handled message.
+                             The messages of a channel must be handled in
+                             the order they were delivered
+        :return: None
+        """
+        self.__last_tag = delivery_tag
+        self.__pending += 1
+        if self.__pending == 1:
+            self.__pending_since = monotonic()
+        if (self.__pending >= self.__ack_every
+                or (self.__ack_time > 0 and monotonic() - self.__pending_since >= self.__ack_time)):
+            self.flush()
+
+    def flush(self):
+        """
+        Acknowledges every handled message, if the channel is still open
+
+        :return: None
+        """
+        if self.__pending == 0:
+            return
+        if self.__channel.is_open:
+            self.__channel.basic_ack(self.__last_tag, multiple=True)
+            self.acked_msgs += self.__pending
+            self.ack_frames += 1
+        self.__pending = 0
+
+    def __on_timer(self):
+        self.flush()
+        if self.__channel.is_open:
+            self.__connection.add_timeout(self.__ack_time, self.__on_timer)
@@ -0,0 +1,507 @@
+"""
+This file contains the alerting engine used by pistatsview.py to check the
+statistics of every device against threshold rules
+
+The rules are read from a file, one per line, such as:
+
+    # metric   op  threshold  [for duration] [on routing_key] [clear value]
+    cpu        >   90%        for 30s        on site1.*
+    cpu0       >   0.95
+    cpu.iowait >   20%        for 1m
+    eth0 tx    <   1000 B/s   on site1.rack2.#  clear 2 kB/s
+    * rx_drop  >   0 /s
+
+A metric is 'cpu', a core such as 'cpu0', a cpu state such as 'cpu.iowait',
+or an interface and one of its counters, such as 'eth0 tx'. The interface may
+be a shell style pattern such as 'eth*' or '*'. The routing key given after
+'on' may hold the topic exchange wildcards, '*' matching one dot separated word
+and '#' matching zero or more words, and defaults to every device.
+
+The rules are compiled once, and the rules applying to a device are resolved
+the first time it reports, so each message is only checked against the rules
+that apply to its device. An alert fires once the threshold was crossed for
+the whole duration, is only reported once while it lasts, and is resolved
+once the value crosses back the clear value, which defaults to the threshold
+minus HYSTERESIS of it, so that a value hovering around the threshold doesn't
+make the alert flap.
+"""
+
+import fnmatch
+import json
+import Queue
+import re
+import sys
+import threading
+import time
+
+from pistatscommon import parse_duration, is_pattern, topic_matches, monotonic, CPU_STATES, NET_COUNTERS
+from pistatsstore import CURRENT, METRIC_WIDTH, IFACE_OFFSETS
+
+# Share of the threshold the value must cross back for an alert to be resolved
+HYSTERESIS = 0.05
+
+# Number of seconds a webhook may take to accept an alert
+WEBHOOK_TIMEOUT = 2.0
+
+# Number of alerts that may wait to be posted to a webhook before new ones
+# are dropped
+WEBHOOK_QUEUE = 100
+
+# The comparison operators, and whether they alert on values above the threshold
+OPERATORS = {">": True, ">=": True, "<": False, "<=": False}
+
+# Multipliers of the units a threshold may be given in
+UNITS = {"%": 0.01, "B/s": 1.0, "kB/s": 1e3, "KB/s": 1e3, "MB/s": 1e6, "GB/s": 1e9, "/s": 1.0}
+
+# Kinds of metrics a rule checks
+METRIC_CPU = 0
+METRIC_CORE = 1
+METRIC_STATE = 2
+METRIC_NET = 3
+
+VALUE_PATTERN = re.compile(r"^([-+]?[0-9.]+(?:[eE][-+]?[0-9]+)?)(.*)$")
+
+
+def parse_value(text):
+    """
+    Converts a threshold given in a rule into a number
+
+    :param text: (str) The threshold and its optional unit, such as '0.9', '90%' or '1000 B/s'
+    :raises ValueError: if the value or its unit is unknown
+    :return: (float) The threshold
+    """
+    match = VALUE_PATTERN.match(text.replace(" ", ""))
+    if match is None:
+        raise ValueError("Not a number: " + text)
+    value, unit = float(match.group(1)), match.group(2)
+    if unit:
+        if unit not in UNITS:
+            raise ValueError("Unknown unit: " + unit)
+        value *= UNITS[unit]
+    return value
+
+
+class AlertRule(object):
+    """
+    A threshold rule, compiled from a line of the rules file
+    """
+
+    __slots__ = ("text", "kind", "index", "iface", "above", "inclusive", "threshold", "clear", "duration", "pattern")
+
+    def __init__(self, text):
+        """
+        Compile a rule
+
+        :param text: (str) The rule, such as 'cpu > 90% for 30s on site1.*'
+        :raises ValueError: if the rule is not well formed
+        :return: None
+        """
+        self.text = text
+        tokens = text.split()
+
+        # The metric, then the operator
+        if not tokens:
+            raise ValueError("Empty rule")
+        metric = tokens.pop(0)
+        self.index = None
+        self.iface = None
+        if metric == "cpu":
+            self.kind = METRIC_CPU
+        elif metric.startswith("cpu.") and metric[4:] in CPU_STATES:
+            self.kind = METRIC_STATE
+            self.index = CPU_STATES.index(metric[4:])
+        elif re.match(r"^cpu[0-9]+$", metric):
+            self.kind = METRIC_CORE
+            self.index = int(metric[3:])
+        elif tokens and tokens[0] in NET_COUNTERS:
+            self.kind = METRIC_NET
+            self.iface = metric
+            self.index = IFACE_OFFSETS[tokens.pop(0)]
+        else:
+            raise ValueError("Unknown metric: " + metric)
+
+        if not tokens or tokens[0] not in OPERATORS:
+            raise ValueError("Expected one of %s after the metric" %(" ".join(sorted(OPERATORS))))
+        operator = tokens.pop(0)
+        self.above = OPERATORS[operator]
+        self.inclusive = operator.endswith("=")
+
+        # The threshold, with its optional unit, up to the next keyword
+        clauses = {"for": None, "on": None, "clear": None}
+        current = []
+        value_tokens = current
+        for token in tokens:
+            if token in clauses and clauses[token] is None:
+                current = clauses[token] = []
+            else:
+                current.append(token)
+        if not value_tokens:
+            raise ValueError("Missing threshold")
+        self.threshold = parse_value(" ".join(value_tokens))
+
+        if clauses["clear"]:
+            self.clear = parse_value(" ".join(clauses["clear"]))
+        elif self.above:
+            self.clear = self.threshold - abs(self.threshold) * HYSTERESIS
+        else:
+            self.clear = self.threshold + abs(self.threshold) * HYSTERESIS
+
+        self.duration = parse_duration(" ".join(clauses["for"])) if clauses["for"] else 0.0
+        self.pattern = " ".join(clauses["on"]) if clauses["on"] else "#"
+        if clauses["for"] == [] or clauses["on"] == [] or clauses["clear"] == []:
+            raise ValueError("Missing value after 'for', 'on' or 'clear'")
+
+    def values(self, device):
+        """
+        Returns the current values of the device checked by this rule
+
+        :param device: (pistatsstore.DeviceStats) The device
+        :return: (list) The (interface, value) pairs, the interface being None for the cpu metrics
+        """
+        if self.kind == METRIC_CPU:
+            return [(None, device.cpu[CURRENT])]
+        if self.kind == METRIC_CORE:
+            if device.cores is not None and self.index < len(device.cores) / METRIC_WIDTH:
+                return [(None, device.cores[self.index * METRIC_WIDTH + CURRENT])]
+            return []
+        if self.kind == METRIC_STATE:
+            if device.cpu_states is not None:
+                return [(None, device.cpu_states[self.index * METRIC_WIDTH + CURRENT])]
+            return []
+        record = device.net.get(self.iface)
+        if record is not None:
+            return [(self.iface, record[self.index + CURRENT])]
+        return [(iface, record[self.index + CURRENT]) for iface, record in device.net.items()
+                if fnmatch.fnmatchcase(iface, self.iface)]
+
+    def breached(self, value):
+        """
+        :param value: (float) The value of the metric
+        :return: (bool) Whether the value crosses the threshold
+        """
+        if self.above:
+            return value >= self.threshold if self.inclusive else value > self.threshold
+        return value <= self.threshold if self.inclusive else value < self.threshold
+
+    def cleared(self, value):
+        """
+        :param value: (float) The value of the metric
+        :return: (bool) Whether the value crossed back the clear value
+        """
+        if self.above:
+            return value <= self.clear
+        return value >= self.clear
+
+
+def load_rules(path):
+    """
+    Reads and compiles a rules file, skipping blank lines and '#' comments
+
+    :param path: (str) The path of the rules file
+    :raises IOError: if the file couldn't be read
+    :raises ValueError: if a rule is not well formed, with its line number
+    :return: (list) The AlertRule objects, without duplicates
+    """
+    rules = []
+    seen = set()
+    with open(path) as rules_file:
+        for number, line in enumerate(rules_file, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                rule = AlertRule(line)
+            except ValueError, ve:
+                raise ValueError("%s:%d: %s" %(path, number, ve))
+            key = " ".join(line.split())
+            if key not in seen:
+                seen.add(key)
+                rules.append(rule)
+    return rules
+
+
+class StdoutSink(object):
+    """
+    Prints the alerts
+    """
+
+    def send(self, alert):
+        """
+        :param alert: (dict) The alert, as built by AlertEngine
+        :return: None
+        """
+        print format_alert(alert)
+
+    def close(self):
+        pass
+
+
+class FileSink(object):
+    """
+    Appends the alerts to a file, one per line
+    """
+
+    def __init__(self, path):
+        """
+        Create a new FileSink object
+
+        :param path: (str) The path of the file
+        :raises IOError: if the file couldn't be opened
+        :return: None
+        """
+        self.__file = open(path, "a")
+
+    def send(self, alert):
+        """
+        :param alert: (dict) The alert, as built by AlertEngine
+        :return: None
+        """
+        self.__file.write(format_alert(alert) + "\n")
+        self.__file.flush()
+
+    def close(self):
+        self.__file.close()
+
+
+class WebhookSink(object):
+    """
+    Posts the alerts to a webhook, as JSON documents. The alerts are posted
+    by a background thread, so that a slow or unreachable webhook never holds
+    up the viewer, and the alerts arriving while WEBHOOK_QUEUE of them wait to
+    be posted are dropped
+    """
+
+    def __init__(self, url):
+        """
+        Create a new WebhookSink object
+
+        :param url: (str) The URL of the webhook, such as 'http://localhost:8080/alerts'
+        :return: None
+        """
+        self.url = url
+        self.__alerts = Queue.Queue(WEBHOOK_QUEUE)
+        # Started on the first alert, most viewers never post one
+        self.__thread = None
+
+        # Counters reported when the sink is closed
+        self.posted = 0
+        self.dropped = 0
+
+    def send(self, alert):
+        """
+        Queues an alert to be posted
+
+        :param alert: (dict) The alert, as built by AlertEngine
+        :return: None
+        """
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__post_alerts)
+            # Don't keep the viewer alive for a webhook that doesn't answer
+            self.__thread.daemon = True
+            self.__thread.start()
+        try:
+            self.__alerts.put_nowait(alert)
+        except Queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """
+        Posts the queued alerts, waiting at most WEBHOOK_TIMEOUT for the
+        webhook to accept them, and drops the ones left
+
+        :return: None
+        """
+        if self.__thread is None:
+            return
+        try:
+            self.__alerts.put(None, timeout=WEBHOOK_TIMEOUT)
+        except Queue.Full:
+            pass
+        self.__thread.join(WEBHOOK_TIMEOUT)
+        if self.__thread.is_alive():
+            # Drop the alerts left, and let the alert being posted finish
+            while True:
+                try:
+                    alert = self.__alerts.get_nowait()
+                except Queue.Empty:
+                    break
+                if alert is not None:
+                    self.dropped += 1
+            self.__alerts.put(None)
+            self.__thread.join(WEBHOOK_TIMEOUT)
+        if self.dropped > 0:
+            print >> sys.stderr, "Warning: Dropped %d alert(s) that could not be posted to %s in time" \
+                %(self.dropped, self.url)
+
+    def __post_alerts(self):
+        # Loaded by the thread posting the alerts, only once there is one to post
+        import urllib2
+
+        while True:
+            alert = self.__alerts.get()
+            if alert is None:
+                break
+            request = urllib2.Request(self.url, json.dumps(alert), {"Content-Type": "application/json"})
+            try:
+                urllib2.urlopen(request, timeout=WEBHOOK_TIMEOUT).close()
+                self.posted += 1
+            except (urllib2.URLError, IOError), error:
+                print >> sys.stderr, "Warning: Could not post alert to %s: %s" %(self.url, error)
+
+
+def open_sink(target):
+    """
+    Opens the destination of the alerts given on the command line
+
+    :param target: (str) 'stdout', a webhook URL starting with 'http://' or 'https://', or a file path
+    :raises IOError: if the file couldn't be opened
+    :return: The sink, with send() and close() methods
+    """
+    if target == "stdout":
+        return StdoutSink()
+    if target.startswith("http://") or target.startswith("https://"):
+        return WebhookSink(target)
+    return FileSink(target)
+
+
+def format_alert(alert):
+    """
+    :param alert: (dict) The alert, as built by AlertEngine
+    :return: (str) The alert as a line of text
+    """
+    metric = alert["metric"] if alert["iface"] is None else alert["iface"] + " " + alert["metric"]
+    return "%s %s %s: %s = %g (%s)" %(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(alert["time"])),
+                                      alert["state"].upper(), alert["device"], metric, alert["value"], alert["rule"])
+
+
+class AlertEngine(object):
+    """
+    Checks every updated device against the rules that apply to it
+    """
+
+    def __init__(self, rules, sinks):
+        """
+        Create a new AlertEngine object
+
+        :param rules: (list) The AlertRule objects, as returned by load_rules()
+        :param sinks: (list) The destinations of the alerts
+        :return: None
+        """
+        self.__sinks = sinks
+        # The rules indexed by the routing key they apply to, and the ones applying to routing key patterns
+        # indexed by the first word of the pattern, None if it is a wildcard
+        self.__exact = dict()
+        self.__patterns = dict()
+        for rule in rules:
+            if is_pattern(rule.pattern):
+                first = rule.pattern.split(".", 1)[0]
+                self.__patterns.setdefault(None if is_pattern(first) else first, []).append(rule)
+            else:
+                self.__exact.setdefault(rule.pattern, []).append(rule)
+
+        # The rules applying to each device, resolved when it first reports
+        self.__device_rules = dict()
+        # The time each (rule, device, interface) started breaching, and whether its alert fired
+        self.__pending = dict()
+        self.__firing = set()
+
+        # Counters reported when the viewer exits
+        self.fired = 0
+        self.resolved = 0
+
+    def rules_for(self, routing_key):
+        """
+        Returns the rules applying to a device
+
+        :param routing_key: (str) The routing key of the device
+        :return: (list) The AlertRule objects
+        """
+        rules = self.__device_rules.get(routing_key)
+        if rules is None:
+            rules = list(self.__exact.get(routing_key, ()))
+            for first in (routing_key.split(".", 1)[0], None):
+                rules.extend(rule for rule in self.__patterns.get(first, ()) if topic_matches(rule.pattern, routing_key))
+            self.__device_rules[routing_key] = rules
+        return rules
+
+    def evaluate(self, device, now=None):
+        """
+        Checks the current values of a device against the rules that apply to it
+
+        :param device: (pistatsstore.DeviceStats) The device that was just updated
+        :param now: (float) The monotonic time of the values, None for now
+        :return: None
+        """
+        rules = self.rules_for(device.routing_key)
+        if not rules:
+            return
+        if now is None:
+            now = monotonic()
+
+        for rule in rules:
+            for iface, value in rule.values(device):
+                key = (rule, device.routing_key, iface)
+                if key in self.__firing:
+                    if rule.cleared(value):
+                        self.__firing.discard(key)
+                        self.resolved += 1
+                        self.__send("resolved", rule, device, iface, value)
+                elif rule.breached(value):
+                    since = self.__pending.get(key)
+                    if since is None:
+                        since = self.__pending[key] = now
+                    if now - since >= rule.duration:
+                        del self.__pending[key]
+                        self.__firing.add(key)
+                        self.fired += 1
+                        self.__send("firing", rule, device, iface, value)
+                elif key in self.__pending:
+                    del self.__pending[key]
+
+    def close(self):
+        """
+        Closes the destinations of the alerts
+
+        :return: None
+        """
+        for sink in self.__sinks:
+            sink.close()
+
+    def __send(self, state, rule, device, iface, value):
+        tokens = rule.text.split()
+        alert = {"state": state, "device": device.routing_key, "iface": iface,
+                 "metric": tokens[1] if rule.kind == METRIC_NET else tokens[0],
+                 "value": value, "rule": rule.text, "time": time.time()}
+        for sink in self.__sinks:
+            sink.send(alert)
+
+
+# Webhook Stub Entry Point
+# ^^^^^^^^^^^^^^^^^^^^^^^^
+if __name__ == "__main__":
+    import BaseHTTPServer
+
+    class _WebhookStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        # Prints every alert posted to the stub
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.getheader("Content-Length", 0)))
+            try:
+                print format_alert(json.loads(body))
+            except (ValueError, KeyError, TypeError):
+                print "Warning: ignoring malformed alert: " + body
+            sys.stdout.flush()
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    # Run a local webhook that prints the alerts it receives, to try --alert-to http://localhost:port/
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", port), _WebhookStubHandler)
+    print "Webhook stub listening on http://127.0.0.1:%d/" %(port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,352 @@
+"""
+This file contains the encoders and decoders for the utilization messages
+that pistatsd.py publishes and pistatsview.py consumes
+
+Three formats are supported:
+
+json     The original, indented JSON document
+compact  The same JSON document without any whitespace
+struct   A fixed-layout binary frame. Interface names are sent in a
+         dictionary that is only repeated when the set of interfaces changes
+         or every DICTIONARY_INTERVAL messages, so that late subscribers can
+         pick it up. Other frames reference the interfaces by index
+
+The format of a message is identified by the content type it is published
+with, so that a subscriber can decode messages from any publisher.
+
+Several samples can be sent in a single message: the JSON formats then carry a
+list of documents and the struct format carries consecutive frames.
+
+Samples flagged with 'delta' only hold the interfaces and counters that
+changed since they were last sent, the missing ones keep their last value.
+
+Samples holding a 'summary' carry the mean of the samples taken over a period
+as their values, along with the number of samples and the highest and lowest
+values of the period.
+"""
+
+import json
+import struct
+
+from pistatscommon import CPU_STATES, NET_COUNTERS
+
+FORMATS = ("json", "compact", "struct")
+
+JSON_CONTENT_TYPE = "application/json"
+STRUCT_CONTENT_TYPE = "application/x-pistats-struct"
+
+CONTENT_TYPES = {"json": JSON_CONTENT_TYPE,
+                 "compact": JSON_CONTENT_TYPE,
+                 "struct": STRUCT_CONTENT_TYPE}
+
+# Number of struct frames sent between two repetitions of the interface
+# dictionary
+DICTIONARY_INTERVAL = 30
+
+# Struct frame layout (network byte order)
+# ----------------------------------------
+# header:     version (B), flags (B), dictionary generation (H),
+#             dictionary size (H), interface entry count (H), core count (B),
+#             cpu utilization (d)
+# dictionary: only present if FLAG_DICTIONARY is set, one entry per
+#             interface: name length (B) followed by the utf-8 name
+# cpu states: only present if FLAG_CPU_STATES is set, the share of time spent
+#             in each of CPU_STATES (f)
+# summary:    only present if FLAG_SUMMARY is set, the number of samples
+#             summarized (H), the highest and lowest cpu utilization (dd)
+# cores:      the utilization of each core (f), followed by the highest and
+#             then the lowest utilization of each core if FLAG_SUMMARY is set
+# interfaces: one entry per interface sent: its dictionary index (H), a
+#             bitmap of the NET_COUNTERS sent (H), then the value of each
+#             counter sent, in NET_COUNTERS order: the 'rx' and 'tx' bytes
+#             (q) and the other rates (f). If FLAG_SUMMARY is set, the
+#             highest and then the lowest values follow, in the same layout
+STRUCT_VERSION = 3
+FLAG_DICTIONARY = 0x01
+FLAG_CPU_STATES = 0x02
+FLAG_DELTA = 0x04
+FLAG_SUMMARY = 0x08
+HEADER = struct.Struct("!BBHHHBd")
+SUMMARY = struct.Struct("!Hdd")
+NAME_LENGTH = struct.Struct("!B")
+STATES = struct.Struct("!%df" % len(CPU_STATES))
+IFACE_ENTRY = struct.Struct("!HH")
+COUNTER_FORMATS = dict((counter, "q" if counter in ("rx", "tx") else "f") for counter in NET_COUNTERS)
+
+# The struct and counter names of each counter bitmap met so far
+_counter_layouts = dict()
+
+
+def counter_layout(bitmap):
+    """
+    Returns the layout of the counters of an interface entry
+
+    :param bitmap: (int) The bitmap of the NET_COUNTERS sent
+    :return: (tuple) The struct.Struct packing the counters, and their names
+    """
+    layout = _counter_layouts.get(bitmap)
+    if layout is None:
+        names = tuple(counter for i, counter in enumerate(NET_COUNTERS) if bitmap & (1 << i))
+        layout = (struct.Struct("!" + "".join(COUNTER_FORMATS[name] for name in names)), names)
+        _counter_layouts[bitmap] = layout
+    return layout
+
+
+def counter_bitmap(counters):
+    """
+    Returns the bitmap of the NET_COUNTERS present in an interface entry
+
+    :param counters: (dict) The counters of the interface
+    :return: (int) The bitmap, unknown counters are left out
+    """
+    bitmap = 0
+    for i, counter in enumerate(NET_COUNTERS):
+        if counter in counters:
+            bitmap |= 1 << i
+    return bitmap
+
+
+class StatsEncoder(object):
+    """
+    Encodes utilization messages in one of the supported formats
+    """
+
+    def __init__(self, fmt="json", dictionary_interval=DICTIONARY_INTERVAL):
+        """
+        Create a new StatsEncoder object
+
+        :param fmt: (str) One of the names listed in FORMATS
+        :param dictionary_interval: (int) Number of struct frames sent
+                                    between two repetitions of the interface
+                                    dictionary
+        :raises ValueError: if fmt is not a supported format
+        :return: None
+        """
+        if fmt not in FORMATS:
+            raise ValueError("Unsupported message format: " + str(fmt))
+
+        self.format = fmt
+        self.content_type = CONTENT_TYPES[fmt]
+        self.__dictionary_interval = dictionary_interval
+        self.__ifaces = None
+        self.__index = dict()
+        self.__generation = 0
+        self.__dictionary = b""
+        self.__frames_since_dictionary = 0
+
+    def encode(self, utilization_msg):
+        """
+        Encodes a utilization message
+
+        :param utilization_msg: (dict) The message, holding the 'cpu'
+                                utilization, optionally the utilization of
+                                the 'cores' and the 'cpu_states' shares, and
+                                the 'rx'/'tx' throughput of each interface
+                                in 'net'
+        :return: (str) The encoded message body
+        """
+        if self.format == "json":
+            return json.dumps(utilization_msg, indent=4, sort_keys=True)
+        elif self.format == "compact":
+            return json.dumps(utilization_msg, separators=(",", ":"), sort_keys=True)
+        else:
+            return self.__encode_struct(utilization_msg)
+
+    def encode_batch(self, utilization_msgs):
+        """
+        Encodes several utilization messages into a single message body. A
+        batch of one is encoded like a single message
+
+        :param utilization_msgs: (list) The messages, in sampling order
+        :return: (str) The encoded message body
+        """
+        if len(utilization_msgs) == 1:
+            return self.encode(utilization_msgs[0])
+        elif self.format == "json":
+            return json.dumps(utilization_msgs, indent=4, sort_keys=True)
+        elif self.format == "compact":
+            return json.dumps(utilization_msgs, separators=(",", ":"), sort_keys=True)
+        else:
+            return b"".join(self.__encode_struct(msg) for msg in utilization_msgs)
+
+    def __encode_struct(self, utilization_msg):
+        net = utilization_msg["net"]
+        delta = utilization_msg.get("delta", False)
+
+        # Start a new dictionary generation when the set of interfaces
+        # changes. Delta samples only hold some of the interfaces, so they can
+        # only add interfaces to the dictionary
+        if delta:
+            ifaces = self.__ifaces
+            if ifaces is None or any(iface not in self.__index for iface in net):
+                ifaces = tuple(sorted(set(ifaces or ()) | set(net.keys())))
+        else:
+            ifaces = tuple(sorted(net.keys()))
+
+        if ifaces != self.__ifaces:
+            self.__ifaces = ifaces
+            self.__index = dict((iface, i) for i, iface in enumerate(ifaces))
+            self.__generation = (self.__generation + 1) & 0xffff
+            self.__dictionary = b"".join(encode_name(iface) for iface in ifaces)
+            self.__frames_since_dictionary = 0
+
+        flags = 0
+        if self.__frames_since_dictionary == 0:
+            flags |= FLAG_DICTIONARY
+        self.__frames_since_dictionary = (self.__frames_since_dictionary + 1) % self.__dictionary_interval
+
+        cpu_states = utilization_msg.get("cpu_states")
+        if cpu_states is not None:
+            flags |= FLAG_CPU_STATES
+        if delta:
+            flags |= FLAG_DELTA
+        summary = utilization_msg.get("summary")
+        if summary is not None:
+            flags |= FLAG_SUMMARY
+            high, low = summary["max"], summary["min"]
+        cores = utilization_msg.get("cores", ())
+
+        parts = [HEADER.pack(STRUCT_VERSION, flags, self.__generation, len(ifaces), len(net),
+                             len(cores), utilization_msg["cpu"])]
+        if flags & FLAG_DICTIONARY:
+            parts.append(self.__dictionary)
+        if flags & FLAG_CPU_STATES:
+            parts.append(STATES.pack(*[cpu_states[state] for state in CPU_STATES]))
+        if flags & FLAG_SUMMARY:
+            parts.append(SUMMARY.pack(min(summary["samples"], 0xffff), high["cpu"], low["cpu"]))
+        if cores:
+            cores_format = "!%df" % len(cores)
+            parts.append(struct.pack(cores_format, *cores))
+            if flags & FLAG_SUMMARY:
+                parts.append(struct.pack(cores_format, *high["cores"]))
+                parts.append(struct.pack(cores_format, *low["cores"]))
+        for iface, counters in net.items():
+            bitmap = counter_bitmap(counters)
+            layout, names = counter_layout(bitmap)
+            parts.append(IFACE_ENTRY.pack(self.__index[iface], bitmap))
+            parts.append(layout.pack(*[counters[name] for name in names]))
+            if flags & FLAG_SUMMARY:
+                parts.append(layout.pack(*[high["net"][iface][name] for name in names]))
+                parts.append(layout.pack(*[low["net"][iface][name] for name in names]))
+        return b"".join(parts)
+
+
+def encode_name(name):
+    """
+    Encodes an interface name as a dictionary entry
+
+    :param name: (str) The interface name
+    :return: (str) The length prefixed, utf-8 encoded name
+    """
+    if not isinstance(name, bytes):
+        name = name.encode("utf-8")
+    return NAME_LENGTH.pack(len(name)) + name
+
+
+class StatsDecoder(object):
+    """
+    Decodes utilization messages of any supported format, remembering the
+    interface dictionary of each publisher
+    """
+
+    def __init__(self):
+        """
+        Create a new StatsDecoder object
+
+        :return: None
+        """
+        # The last (generation, interface names) received per routing key
+        self.__dictionaries = dict()
+
+    def decode(self, routing_key, content_type, body):
+        """
+        Decodes a utilization message
+
+        :param routing_key: (str) The routing key the message was published
+                            with, identifying its publisher
+        :param content_type: (str) The content type of the message, None for
+                             publishers that predate content types
+        :param body: (str) The message body
+        :raises ValueError: if the message couldn't be parsed
+        :return: (list) The samples carried by the message, in sampling
+                 order, in the form given to StatsEncoder.encode()
+        """
+        if content_type == STRUCT_CONTENT_TYPE:
+            samples = []
+            offset = 0
+            while offset < len(body):
+                sample, offset = self.__decode_struct(routing_key, body, offset)
+                samples.append(sample)
+            return samples
+        elif content_type is None or content_type == JSON_CONTENT_TYPE:
+            samples = json.loads(body)
+            if not isinstance(samples, list):
+                samples = [samples]
+            return samples
+        else:
+            raise ValueError("Unsupported content type: " + str(content_type))
+
+    def __decode_struct(self, routing_key, body, offset):
+        # Unpack in place, without slicing the body
+        try:
+            version, flags, generation, count, entry_count, core_count, cpu = HEADER.unpack_from(body, offset)
+            if version != STRUCT_VERSION:
+                raise ValueError("Unsupported struct frame version: " + str(version))
+            offset += HEADER.size
+
+            if flags & FLAG_DICTIONARY:
+                names = []
+                for i in range(count):
+                    length, = NAME_LENGTH.unpack_from(body, offset)
+                    offset += NAME_LENGTH.size
+                    names.append(body[offset:offset + length].decode("utf-8"))
+                    offset += length
+                self.__dictionaries[routing_key] = (generation, names)
+            else:
+                dictionary = self.__dictionaries.get(routing_key)
+                if dictionary is None or dictionary[0] != generation:
+                    raise ValueError("No interface dictionary received yet for generation " + str(generation))
+                names = dictionary[1]
+
+            msg = {"cpu": cpu}
+            if flags & FLAG_CPU_STATES:
+                msg["cpu_states"] = dict(zip(CPU_STATES, STATES.unpack_from(body, offset)))
+                offset += STATES.size
+            if flags & FLAG_SUMMARY:
+                samples, cpu_max, cpu_min = SUMMARY.unpack_from(body, offset)
+                offset += SUMMARY.size
+                high = {"cpu": cpu_max, "net": dict()}
+                low = {"cpu": cpu_min, "net": dict()}
+                msg["summary"] = {"samples": samples, "max": high, "min": low}
+            if core_count:
+                cores_format = "!%df" % core_count
+                cores_size = struct.calcsize(cores_format)
+                msg["cores"] = list(struct.unpack_from(cores_format, body, offset))
+                offset += cores_size
+                if flags & FLAG_SUMMARY:
+                    high["cores"] = list(struct.unpack_from(cores_format, body, offset))
+                    low["cores"] = list(struct.unpack_from(cores_format, body, offset + cores_size))
+                    offset += 2 * cores_size
+
+            if flags & FLAG_DELTA:
+                msg["delta"] = True
+
+            net = dict()
+            for i in range(entry_count):
+                index, bitmap = IFACE_ENTRY.unpack_from(body, offset)
+                offset += IFACE_ENTRY.size
+                layout, counters = counter_layout(bitmap)
+                net[names[index]] = dict(zip(counters, layout.unpack_from(body, offset)))
+                offset += layout.size
+                if flags & FLAG_SUMMARY:
+                    high["net"][names[index]] = dict(zip(counters, layout.unpack_from(body, offset)))
+                    low["net"][names[index]] = dict(zip(counters, layout.unpack_from(body, offset + layout.size)))
+                    offset += 2 * layout.size
+
+        except struct.error, se:
+            raise ValueError("Truncated struct frame: " + str(se))
+        except IndexError:
+            raise ValueError("Interface index out of the dictionary")
+
+        msg["net"] = net
+        return msg, offset
@@ -0,0 +1,198 @@
+"""
+This file contains helpers shared by pistatsd.py and pistatsview.py
+"""
+
+import math
+import time
+
+# Suffixes accepted by parse_duration() and their value in seconds
+DURATION_UNITS = (("ms", 0.001), ("s", 1.0), ("m", 60.0), ("h", 3600.0))
+
+# Shortest sampling interval accepted by SampleScheduler
+MIN_INTERVAL = 0.01
+
+# The cpu states reported in /proc/stat, in column order. The guest times are
+# left out since the kernel already accounts them in user and nice
+CPU_STATES = ("user", "nice", "system", "idle", "iowait", "irq", "softirq", "steal")
+
+# The counters of each network interface reported in /proc/net/dev, in column
+# order. The received and transmitted bytes keep their original short names
+NET_COUNTERS = ("rx", "rx_packets", "rx_errs", "rx_drop", "rx_fifo", "rx_frame", "rx_compressed", "rx_multicast",
+                "tx", "tx_packets", "tx_errs", "tx_drop", "tx_fifo", "tx_colls", "tx_carrier", "tx_compressed")
+
+# The exchange the utilization messages are published to, for each exchange
+# type. The topic exchange has its own name since the broker refuses to
+# redeclare an existing exchange with another type
+EXCHANGE_TYPES = ("direct", "topic")
+EXCHANGE_NAMES = {"direct": "pi_utilization", "topic": "pi_utilization.topic"}
+
+# The type of the exchange shared by the viewers splitting the devices between
+# them, provided by the rabbitmq_consistent_hash_exchange plugin. It routes
+# every message of a routing key to the same viewer queue, and each viewer
+# binds its queue with the same weight
+SHARED_EXCHANGE_TYPE = "x-consistent-hash"
+SHARED_EXCHANGE_PLUGIN = "rabbitmq_consistent_hash_exchange"
+SHARED_WEIGHT = "1"
+
+# Header of the messages holding the wall-clock time their oldest sample was
+# taken at, from which the subscribers measure the end-to-end latency
+SAMPLED_HEADER = "sampled"
+
+
+def parse_duration(text):
+    """
+    Converts a duration given on the command line into seconds
+
+    :param text: (str) A duration such as '1s', '250ms', '2m', '1h' or a plain
+                 number of seconds such as '0.5'
+    :raises ValueError: if text is not a valid, non-negative duration
+    :return: (float) The duration in seconds
+    """
+    scale = 1.0
+    for suffix, unit in DURATION_UNITS:
+        if text.endswith(suffix):
+            text = text[:-len(suffix)]
+            scale = unit
+            break
+
+    seconds = float(text) * scale
+    if seconds < 0:
+        raise ValueError("Duration must not be negative: " + text)
+    return seconds
+
+
+def parse_broker(broker):
+    """
+    Splits a message broker address given on the command line
+
+    :param broker: (str) The broker address in the form host or host:port
+    :raises ValueError: if the port is not a number
+    :return: (tuple) The host and the port, None for the default port
+    """
+    host, separator, port = broker.partition(":")
+    if separator:
+        return host, int(port)
+    return host, None
+
+
+def is_pattern(routing_key):
+    """
+    Tells whether a routing key holds topic exchange wildcards, '*' matching
+    one dot separated word and '#' matching zero or more words
+
+    :param routing_key: (str) The routing key, such as 'site.rack.host' or 'site.*.#'
+    :return: (bool) Whether the routing key is a pattern
+    """
+    return "*" in routing_key or "#" in routing_key
+
+
+def topic_matches(pattern, routing_key):
+    """
+    Tells whether a routing key matches a pattern the way a topic exchange does
+
+    :param pattern: (str) The pattern, such as 'site1.*' or 'site1.#'
+    :param routing_key: (str) The routing key, such as 'site1.rack2.host3'
+    :return: (bool) Whether the routing key matches the pattern
+    """
+    def match(words, keys):
+        if not words:
+            return not keys
+        if words[0] == "#":
+            return any(match(words[1:], keys[i:]) for i in range(len(keys) + 1))
+        return bool(keys) and words[0] in ("*", keys[0]) and match(words[1:], keys[1:])
+    return match(pattern.split("."), routing_key.split("."))
+
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    # Python 2 has no monotonic clock, read CLOCK_MONOTONIC through libc
+    import ctypes
+    import ctypes.util
+
+    class _Timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    _CLOCK_MONOTONIC = 1
+    _clock_gettime = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c"),
+                                 use_errno=True).clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+    def monotonic():
+        """
+        Returns the value of a clock that cannot go backwards
+
+        :raises OSError: if the clock couldn't be read
+        :return: (float) The clock value in seconds
+        """
+        timespec = _Timespec()
+        if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(timespec)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "clock_gettime failed")
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+
+
+class SampleScheduler(object):
+    """
+    Paces a sampling loop at a fixed rate. Deadlines are computed on the
+    monotonic clock from the start of the loop, so the time spent sampling
+    and publishing doesn't add up to a drift
+    """
+
+    def __init__(self, interval, align=False):
+        """
+        Create a new SampleScheduler object
+
+        :param interval: (float) The number of seconds between two samples
+        :param align: (bool) Whether the samples are aligned on multiples of
+                      interval in wall-clock time, so that the samples of
+                      several devices can be correlated
+        :raises ValueError: if interval is shorter than MIN_INTERVAL
+        :return: None
+        """
+        if interval < MIN_INTERVAL:
+            raise ValueError("The sampling interval must be at least %gs" %(MIN_INTERVAL))
+
+        self.interval = interval
+        self.align = align
+        self.ticks = 0
+        self.missed_ticks = 0
+        self.__deadline = None
+
+    def start(self):
+        """
+        Sets the first deadline, one interval from now or on the next
+        wall-clock boundary if aligned
+
+        :return: None
+        """
+        now = monotonic()
+        if self.align:
+            # The monotonic clock is slewed along with the wall clock, so
+            # aligning the first deadline keeps the following ones aligned
+            wall = time.time()
+            self.__deadline = now + (math.floor(wall / self.interval) + 1) * self.interval - wall
+        else:
+            self.__deadline = now + self.interval
+
+    def wait(self):
+        """
+        Sleeps until the next deadline. If the deadline was missed, returns
+        immediately and skips the deadlines that passed meanwhile
+
+        :return: (int) The number of ticks skipped
+        """
+        if self.__deadline is None:
+            self.start()
+
+        now = monotonic()
+        if now < self.__deadline:
+            time.sleep(self.__deadline - now)
+            missed = 0
+        else:
+            missed = int((now - self.__deadline) / self.interval)
+
+        self.__deadline += (missed + 1) * self.interval
+        self.ticks += 1
+        self.missed_ticks += missed
+        return missed
@@ -2,14 +2,19 @@
 """
 This file contains pistatsd.py which will read the cpu and network interface
 statistics from the Raspberry Pi and publish them to a RabbitMQ exchange
+
+The pika module is only loaded once the arguments were checked, so that this
+file can be imported without it
 """
 
-import pika
-import pika.exceptions
 import signal
 import sys
-import time
-import json
+from pistatscodec import StatsEncoder, FORMATS
+from pistatscommon import parse_duration, monotonic, is_pattern, SampleScheduler, EXCHANGE_TYPES, EXCHANGE_NAMES, NET_COUNTERS
+from pistatspublisher import ReconnectingPublisher, DeltaSuppressor, SampleSummarizer, DRAIN_RATE
+from pistatsspool import SampleSpool, SPOOL_SAMPLES
+from pistatsmetrics import Metrics, MetricsServer
+from pistatsproc import CpuStatSampler, NetDevSampler, build_utilization_msg
 
 # Global variable that controls running the app
 publish_stats = True
@@ -27,208 +32,384 @@ def stop_stats_service(signal, frame):
     global publish_stats
     publish_stats = False
 
-def read_cpu_utilization():
+def open_channel(host, vhost, credentials, exchange, exchange_type):
     """
-    Returns a dictionary with the total uptime and idle time for the system
+    Connects to the message broker and declares the exchange
 
-    :return: (dict) The system 'uptime' and 'idle' time stored in keys using
-                    their respective names
+    :param host: (str) The message broker host name or IP address
+    :param vhost: (str) The virtual host to connect to
+    :param credentials: (pika.PlainCredentials) The credentials to use, None for the default ones
+    :param exchange: (str) The name of the exchange
+    :param exchange_type: (str) The type of the exchange
+    :raises pika.exceptions.AMQPError: if the broker couldn't be reached or refused the connection
+    :return: (tuple) The connection and the channel
     """
-    uptime = open("/proc/uptime","r")
-    # Read and parse out the uptime and idle time values
-    x = uptime.read()
-    x = x.split()
-    result = {"uptime": x[0],# store uptime value from reading /proc/uptime,
-              "idle": x[1]# idle value from reading /proc/uptime
-             }
-    return result
-
-def read_net_throughput():
+    import pika
+
+    message_broker = pika.BlockingConnection(pika.ConnectionParameters(
+        host, virtual_host=vhost, credentials=credentials))
+    channel = message_broker.channel()
+    channel.exchange_declare(exchange=exchange, type=exchange_type)
+    return message_broker, channel
+
+def main(argv):
     """
-    Returns a dictionary with the number of bytes each installed network
-    interface has transmitted (tx) and received (rx)
+    Samples and publishes the stats until the app is asked to quit
 
-    :return: (dict) A dictionary of network interfaces, where each network
-             interface contains dictionaries with the transmitted and received
-             bytes for the respective interface
+    :param argv: (list) The command line arguments, the program name first
+    :return: None
     """
-    result = dict()
-
-    net_info = open("/proc/net/dev")
-    # Parse out each network interface
-    # --------------------------------
-    # Since there can be multiple installed interfaces, you want to parse each
-    # line in /proc/net/dev, and use the interface name as keys in the result
-    for iface in net_info:
-        if(iface.find(':')!=-1):#":" was found meaning an interface
-            x = iface.split()#get the data in "blocks"
-            result[x[0]] = {"rx": x[1],# Read bytes received from net_info,
-                             "tx": x[9]# Read bytes sent from net_info
-                             }
-    return result
+    # Guard try clause to catch any errors that aren't expected
+    try:
+        #Set each of the default values
+        # The message broker host name or IP address
+        host = None
+        # The virtual host to connect to
+        vhost = "/" # Defaults to the root virtual host
+        # The credentials to use
+        credentials = None
+        # The topic to subscribe to
+        topic = None
+        # The format the messages are published in
+        msg_format = "json" # Defaults to the original JSON document
+        # The number of samples sent per message
+        batch_size = 1 # Defaults to one message per sample
+        # The maximum time a sample waits for its batch to fill up
+        batch_time = 0.0 # Defaults to no limit
+        # Whether the broker must confirm every message
+        confirm = False
+        # The number of seconds between two samples
+        interval = 1.0 # Defaults to one sample per second
+        # Whether the samples are aligned on wall-clock boundaries
+        align = False
+        # The number of samples between two full keyframes when only the
+        # changed network counters are sent
+        keyframe_interval = None # Defaults to sending every sample in full
+        # The interface counters sampled and published
+        counters = NET_COUNTERS # Defaults to every counter of /proc/net/dev
+        # The type of the exchange the samples are published to, and its name
+        exchange_type = "direct"
+        exchange = None # Defaults to the name used for the exchange type
+        # The number of seconds summarized per published summary, the samples
+        # being taken every interval
+        summary_period = None # Defaults to publishing every sample
+        # The CPU utilization from which the raw samples are published along
+        # with the summaries
+        burst_threshold = None # Defaults to only publishing the summaries
+        # The number of samples kept in memory while the broker is unreachable
+        spool_samples = SPOOL_SAMPLES
+        # The file the samples that don't fit in memory are spilled to
+        spill_path = None # Defaults to dropping them
+        # The number of spooled samples published per second once reconnected
+        drain_rate = DRAIN_RATE
+        # The number of seconds between two stats lines about the app itself
+        stats_interval = None # Defaults to no stats line
+        # The local port serving the metrics of the app in the Prometheus text format
+        metrics_port = None # Defaults to not serving them
 
-# Application Entry Point
-# ^^^^^^^^^^^^^^^^^^^^^^^
+        #parse through command line arguments and assign parameters
+        #if nothing is passed, defaults as set above are used
+        if argv:
+            for i in range(0,len(argv)):
+                if argv[i] == "-b":
+                    host = argv[i+1]
+                elif argv[i] == "-p":
+                    vhost = argv[i+1]
+                elif argv[i] == "-c":
+                    credentials = argv[i+1]
+                    credentials = credentials.split(':')
+                elif argv[i] == "-k":
+                    topic = argv[i+1]
+                elif argv[i] == "--format":
+                    msg_format = argv[i+1]
+                elif argv[i] == "--batch":
+                    batch_size = int(argv[i+1])
+                elif argv[i] == "--batch-time":
+                    batch_time = parse_duration(argv[i+1])
+                elif argv[i] == "--confirm":
+                    confirm = True
+                elif argv[i] == "--interval":
+                    interval = parse_duration(argv[i+1])
+                elif argv[i] == "--align":
+                    align = True
+                elif argv[i] == "--delta":
+                    keyframe_interval = int(argv[i+1])
+                elif argv[i] == "--counters":
+                    counters = tuple(argv[i+1].split(","))
+                elif argv[i] == "--exchange-type":
+                    exchange_type = argv[i+1]
+                elif argv[i] == "--exchange":
+                    exchange = argv[i+1]
+                elif argv[i] == "--summary":
+                    summary_period = parse_duration(argv[i+1])
+                elif argv[i] == "--burst":
+                    burst_threshold = float(argv[i+1])
+                elif argv[i] == "--spool":
+                    spool_samples = int(argv[i+1])
+                elif argv[i] == "--spill":
+                    spill_path = argv[i+1]
+                elif argv[i] == "--drain-rate":
+                    drain_rate = int(argv[i+1])
+                elif argv[i] == "--stats":
+                    stats_interval = parse_duration(argv[i+1])
+                elif argv[i] == "--metrics-port":
+                    metrics_port = int(argv[i+1])
 
-# Guard try clause to catch any errors that aren't expected
-try:
-    #Set each of the default values
-    # The message broker host name or IP address
-    host = None
-    # The virtual host to connect to
-    vhost = "/" # Defaults to the root virtual host
-    # The credentials to use
-    credentials = None
-    # The topic to subscribe to
-    topic = None
-
-    #parse through command line arguments and assign parameters
-    #if nothing is passed, defaults as set above are used
-    if sys.argv:
-        for i in range(0,len(sys.argv)):
-            if sys.argv[i] == "-b":
-                host = sys.argv[i+1]
-            elif sys.argv[i] == "-p":
-                vhost = sys.argv[i+1]
-            elif sys.argv[i] == "-c":
-                credentials = sys.argv[i+1]
-		credentials = credentials.split(':')
-		username = credentials[0]
-		password = credentials[1]
-		credentials = pika.PlainCredentials(username, password)
-            elif sys.argv[i] == "-k":
-                topic = sys.argv[i+1]
-
-    # Ensure that the user specified the required arguments
-    if host is None:
-        print "You must specify a message broker to connect to"
-        sys.exit()
+        # Ensure that the user specified the required arguments
+        if host is None:
+            print "You must specify a message broker to connect to"
+            sys.exit()
 
-    if topic is None:
-        print "You must specify a topic to subscribe to"
-        sys.exit()
-    # Setup signal handlers to shutdown this app when SIGINT or SIGTERM is
-    # sent to this app
-    signal_num = signal.SIGINT
-    try:
-        signal.signal(signal_num, stop_stats_service)
-        signal_num = signal.SIGTERM
-        signal.signal(signal_num, stop_stats_service)
+        if topic is None:
+            print "You must specify a topic to subscribe to"
+            sys.exit()
 
-    except ValueError, ve:
-        print "Warning: Graceful shutdown may not be possible: Unsupported " \
-                "Signal: " + signal_num    
+        if exchange_type not in EXCHANGE_TYPES:
+            print "You must specify one of the following exchange types: " + "|".join(EXCHANGE_TYPES)
+            sys.exit()
+        if exchange is None:
+            exchange = EXCHANGE_NAMES[exchange_type]
 
-    try:
-        # Connect to the message broker using the given broker address (host)
-        # Use the virtual host (vhost) and credential information (credentials),
-        # if provided
-        message_broker = pika.BlockingConnection(pika.ConnectionParameters(
-        host,virtual_host=vhost,credentials=credentials))
-        # Setup the channel and exchange
-        channel = message_broker.channel()
-        channel.exchange_declare(exchange='pi_utilization',type='direct')
+        if is_pattern(topic):
+            print "You must specify a routing key without the '*' and '#' wildcards"
+            sys.exit()
+
+        if msg_format not in FORMATS:
+            print "You must specify one of the following message formats: " + "|".join(FORMATS)
+            sys.exit()
+        encoder = StatsEncoder(msg_format)
+
+        if batch_size < 1:
+            print "You must specify a batch size of at least one sample"
+            sys.exit()
+
+        try:
+            scheduler = SampleScheduler(interval, align)
+        except ValueError, ve:
+            print "You must specify a proper sampling interval: " + str(ve)
+            sys.exit()
+
+        if any(counter not in NET_COUNTERS for counter in counters) or "rx" not in counters or "tx" not in counters:
+            print "You must specify interface counters among the following ones, including rx and tx: " + ",".join(NET_COUNTERS)
+            sys.exit()
+
+        suppressor = None
+        if keyframe_interval is not None:
+            try:
+                suppressor = DeltaSuppressor(keyframe_interval)
+            except ValueError, ve:
+                print "You must specify a proper keyframe interval: " + str(ve)
+                sys.exit()
+
+        summarizer = None
+        if summary_period is not None:
+            if suppressor is not None:
+                print "You must not combine --delta with --summary"
+                sys.exit()
+            if summary_period < scheduler.interval:
+                print "You must specify a summary period no shorter than the sampling interval"
+                sys.exit()
+            try:
+                summarizer = SampleSummarizer(summary_period, burst_threshold)
+            except ValueError, ve:
+                print "You must specify a proper summary period: " + str(ve)
+                sys.exit()
+        elif burst_threshold is not None:
+            print "You must specify a summary period to publish bursts of raw samples"
+            sys.exit()
+
+        if drain_rate < 1:
+            print "You must specify a drain rate of at least one sample per second"
+            sys.exit()
+        try:
+            spool = SampleSpool(spool_samples, spill_path)
+        except (ValueError, IOError), error:
+            print "You must specify a proper spool: " + str(error)
+            sys.exit()
+
+        # Only measure the app when the measures are reported
+        metrics = None
+        metrics_server = None
+        if stats_interval is not None or metrics_port is not None:
+            if stats_interval is not None and stats_interval <= 0:
+                print "You must specify a positive stats interval"
+                sys.exit()
+            metrics = Metrics("pistatsd")
+            if metrics_port is not None:
+                try:
+                    metrics_server = MetricsServer(metrics, metrics_port)
+                except Exception, error:
+                    print "You must specify a free port to serve the metrics on: " + str(error)
+                    sys.exit()
+                print "Serving the metrics on http://127.0.0.1:%d/metrics" %(metrics_port)
+        # Setup signal handlers to shutdown this app when SIGINT or SIGTERM is
+        # sent to this app
+        signal_num = signal.SIGINT
+        try:
+            signal.signal(signal_num, stop_stats_service)
+            signal_num = signal.SIGTERM
+            signal.signal(signal_num, stop_stats_service)
+
+        except ValueError, ve:
+            print "Warning: Graceful shutdown may not be possible: Unsupported " \
+                    "Signal: " + signal_num    
+
+        # Loaded only now, once the arguments are known to be fine
+        import pika
+        import pika.exceptions
+        if credentials is not None:
+            username = credentials[0]
+            password = credentials[1]
+            credentials = pika.PlainCredentials(username, password)
+
+        publisher = None
+        cpu_sampler = None
+        net_sampler = None
+        try:
+            # Connect to the message broker using the given broker address (host)
+            # Use the virtual host (vhost) and credential information (credentials),
+            # if provided
+            # Setup the channel and exchange, and the publisher that batches the
+            # samples into messages. Once connected, the publisher spools the
+            # samples and reconnects on its own whenever the broker goes away
+            publisher = ReconnectingPublisher(
+                lambda: open_channel(host, vhost, credentials, exchange, exchange_type),
+                exchange, topic, encoder, batch_size, batch_time, confirm, spool, drain_rate, metrics)
         
-        # Create a data structure to hold the stats read from the previous
-        # sampling time
-        last_stat_sample = {"cpu": None, "net": None}
-
-        # Set the initial values for the last stat data structure
-        last_stat_sample["cpu"] = read_cpu_utilization()
-        last_stat_sample["net"] = read_net_throughput()
-
-        # Sleep for one second
-        last_sample_time = time.time()
-        time.sleep(1.0)
-
-        # Loop until the application is asked to quit
-        while(publish_stats):
-            # Read cpu and net stats
-            current_stat_sample = {"cpu": None, "net": None}
-            current_stat_sample["cpu"] = read_cpu_utilization()
-            current_stat_sample["net"] = read_net_throughput()
-
-            current_sample_time = time.time()
-
-            # Calculate time from last sample taken
-            sample_period = current_sample_time - last_sample_time
-
-            # Setup the JSON message to send
-            utilization_msg = {"cpu": None, "net": dict()}
-
-            # Calculate CPU utilization during the sleep_time
-            utilization_msg["cpu"] = 1 - ((float(current_stat_sample["cpu"]["idle"])
-                                           - float(last_stat_sample["cpu"]["idle"]))
-                                          /(float(current_stat_sample["cpu"]["uptime"])
-                                            - float(last_stat_sample["cpu"]["uptime"])))                               
-
-            # Calculate the throughout for each installed network interface
-            # -------------------------------------------------------------
-            # General Note: sample_period is the amount of time between samples, and
-            # is in seconds. Therefore sample_period can be used to calculate the
-            # throughput in bytes/second
-            for iface in current_stat_sample["net"].keys():
-                rx = ((float(current_stat_sample["net"][iface]["rx"])-
-                     float(last_stat_sample["net"][iface]["rx"]))/sample_period)
-                tx = ((float(current_stat_sample["net"][iface]["tx"])-
-                     float(last_stat_sample["net"][iface]["tx"]))/sample_period)
-                rx = int(rx)
-                tx = int(tx)#truncate decimal portion (insignificant)
-                
-                utilization_msg["net"][iface[0:len(iface)-1]] = {"rx": rx,
-                                                 "tx": tx
-                                                }
-            #   Publish the message (utilization_msg) in JSON format to the
-            #   broker under the user specified topic.
-            data = json.dumps(utilization_msg,indent=4,sort_keys=True)#put dict into JSON format
-            
-            channel.basic_publish(exchange = 'pi_utilization', routing_key = topic,
-                                  body = data)
-            #print "Sent: ", data
-
-            # Save the current stats as the last stats
-            last_stat_sample = current_stat_sample
-            last_sample_time = current_sample_time
-
-            # Sleep and then loop
-            time.sleep(1.0)
-
-    except pika.exceptions.ProbableAccessDeniedError, pade:
-        print >> sys.stderr, "Error: A Probable Access Denied Error occured: " + str(pade.message)
-        print "Please enter a valid virtual host in the format '-p validhost'"
-
-    except pika.exceptions.ProbableAuthenticationError, aue:
-        print >> sys.stderr, "Error: A Probable Authentication error occured: " + str(aue.message)
-        print "Please enter a valid username/password in the format '-c username:password'"
+            # Open the samplers, which keep the stats read at the current and
+            # at the previous sampling time
+            cpu_sampler = CpuStatSampler()
+            net_sampler = NetDevSampler(counters=counters)
+
+            # Set the initial values for the previous sampling time
+            cpu_sampler.sample()
+            net_sampler.sample()
+
+            # Sleep until the first sampling deadline
+            last_sample_time = monotonic()
+            scheduler.start()
+            scheduler.wait()
+            next_stats_time = monotonic() + stats_interval if stats_interval is not None else None
+
+            # Loop until the application is asked to quit
+            while(publish_stats):
+                if metrics is not None:
+                    tick_start = monotonic()
+
+                # Read cpu and net stats
+                cpu_sampler.sample()
+                net_sampler.sample()
+
+                current_sample_time = monotonic()
+
+                # Calculate time from last sample taken
+                sample_period = current_sample_time - last_sample_time
+
+                # Setup the JSON message to send, with the CPU utilization and the
+                # rate of every network interface counter during sample_period
+                utilization_msg = build_utilization_msg(cpu_sampler, net_sampler, sample_period)
+
+                # Only keep the counters that changed since they were last sent,
+                # unless this sample is a keyframe
+                if suppressor is not None:
+                    utilization_msg = suppressor.filter(utilization_msg)
+
+                if metrics is not None:
+                    metrics.observe("sample_seconds", monotonic() - tick_start)
+                    metrics.count("samples_total")
+
+                #   Publish the message (utilization_msg) in the user specified
+                #   format to the broker under the user specified topic, once
+                #   its batch is due. When summarizing, only the summaries and
+                #   the bursts of raw samples are published
+                if summarizer is not None:
+                    for due_msg in summarizer.add(utilization_msg, current_sample_time):
+                        publisher.add(due_msg, current_sample_time)
+                else:
+                    publisher.add(utilization_msg, current_sample_time)
+                #print "Sent: ", data
+
+                # Save the current sampling time as the last one, the samplers
+                # keep the current stats as the last ones on their own
+                last_sample_time = current_sample_time
+
+                # Report the measures of the app once they are due
+                if next_stats_time is not None and current_sample_time >= next_stats_time:
+                    print "Stats: " + metrics.stats_line(current_sample_time)
+                    sys.stdout.flush()
+                    next_stats_time = max(next_stats_time + stats_interval, current_sample_time)
+
+                # Sleep until the next sampling deadline and then loop
+                scheduler.wait()
+
+        except pika.exceptions.ProbableAccessDeniedError, pade:
+            print >> sys.stderr, "Error: A Probable Access Denied Error occured: " + str(pade.message)
+            print "Please enter a valid virtual host in the format '-p validhost'"
+
+        except pika.exceptions.ProbableAuthenticationError, aue:
+            print >> sys.stderr, "Error: A Probable Authentication error occured: " + str(aue.message)
+            print "Please enter a valid username/password in the format '-c username:password'"
         
-    except pika.exceptions.AMQPConnectionError, acoe:
-        print >> sys.stderr, "Error: An AMQP Connection Error occured: " + str(acoe.message)
-        print "Please enter a valid RabbitMQ host name in the format '-b WabbitHost'"
+        except pika.exceptions.AMQPConnectionError, acoe:
+            print >> sys.stderr, "Error: An AMQP Connection Error occured: " + str(acoe.message)
+            print "Please enter a valid RabbitMQ host name in the format '-b WabbitHost'"
 
-    except pika.exceptions.AMQPChannelError, ache:
-        print >> sys.stderr, "Error: An AMQP Channel Error occured: " + str(ache.message)
+        except pika.exceptions.AMQPChannelError, ache:
+            print >> sys.stderr, "Error: An AMQP Channel Error occured: " + str(ache.message)
     
-    except pika.exceptions.ChannelError, ce:
-        print >> sys.stderr, "Error: A channel error occured: " + str(ce.message)
-    except pika.exceptions.AMQPError, ae:
-        print >> sys.stderr, "Error: An AMQP Error occured: " + str(ae.message)
-    #General catch-all handler as last resort
-    except Exception, eee:
-        print >> sys.stderr, "Error: An unexpected exception occured: " + str(eee.message)
+        except pika.exceptions.ChannelError, ce:
+            print >> sys.stderr, "Error: A channel error occured: " + str(ce.message)
+        except pika.exceptions.AMQPError, ae:
+            print >> sys.stderr, "Error: An AMQP Error occured: " + str(ae.message)
+        #General catch-all handler as last resort
+        except Exception, eee:
+            print >> sys.stderr, "Error: An unexpected exception occured: " + str(eee.message)
     
-    finally:
-        # Attempt to gracefully shutdown the connection to the message broker
-        print "Application Shutting Down..."
-        if channel is not None:
-            channel.close()
-        if message_broker is not None:
-            message_broker.close()
+        finally:
+            # Attempt to gracefully shutdown the connection to the message broker
+            print "Application Shutting Down..."
+            if publisher is not None:
+                # Publish the samples still waiting for their batch to fill up,
+                # along with the summary of the last period
+                try:
+                    if summarizer is not None:
+                        summary_msg = summarizer.flush()
+                        if summary_msg is not None:
+                            publisher.add(summary_msg, monotonic())
+                    publisher.flush()
+                except pika.exceptions.AMQPError:
+                    print >> sys.stderr, "Warning: Could not publish the last batch of samples"
+                publisher.close()
+                print "Published %d sample(s) in %d message(s), %d unconfirmed" %(
+                    publisher.published_samples, publisher.published_msgs, publisher.unconfirmed_msgs)
+                print "Lost the broker %d time(s), reconnected %d time(s), replayed %d sample(s), spilled %d and dropped %d sample(s)" %(
+                    publisher.lost_connections, publisher.reconnects, publisher.replayed_samples,
+                    publisher.spilled_samples, publisher.dropped_samples)
+                if summarizer is not None:
+                    print "Summarized %d sample(s) in %d summary(ies), published %d raw sample(s) in bursts" %(
+                        summarizer.summarized_samples, summarizer.summaries, summarizer.raw_samples)
+            else:
+                # Keep the samples spilled by a previous run for the next one
+                spool.close()
+            print "Sampled %d tick(s) every %gs, missed %d tick(s)" %(
+                scheduler.ticks, scheduler.interval, scheduler.missed_ticks)
+            if metrics_server is not None:
+                metrics_server.close()
+            if cpu_sampler is not None:
+                cpu_sampler.close()
+            if net_sampler is not None:
+                net_sampler.close()
+            sys.exit()
+    except NameError, ne:
+        print "Error: A NameError has occured: It is likely that an invalid command line"
+        print "argument was passed.Please check your arguments and try again"
+        print "Error message: " + ne.message
+        sys.exit()
+    except Exception, ee:
+        print "Error: An unexpected error occurred: " + ee.message
         sys.exit()
-except NameError, ne:
-    print "Error: A NameError has occured: It is likely that an invalid command line"
-    print "argument was passed.Please check your arguments and try again"
-    print "Error message: " + ne.message
-    sys.exit()
-except Exception, ee:
-    print "Error: An unexpected error occurred: " + ee.message
-    sys.exit()
+
+# Application Entry Point
+# ^^^^^^^^^^^^^^^^^^^^^^^
+if __name__ == "__main__":
+    main(sys.argv)
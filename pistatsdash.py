@@ -0,0 +1,596 @@
+"""
+This file contains the full-screen dashboard displayed by pistatsview.py
+--dashboard instead of printing tables
+
+The dashboard lists one device per row, with its CPU utilization and the bytes
+its interfaces receive and transmit per second, sorted by routing key or by
+one of these metrics and split into pages. The selected device can be shown in
+a detail pane, and a sparkline of the recent CPU utilization of every device
+can be kept in memory and displayed along its row.
+
+A redraw only formats the rows visible on the screen, and only the rows whose
+device was updated, or that changed place, since they were last drawn. curses
+then sends the terminal only the characters that changed. A redraw therefore
+costs the same however many devices report and however often. The devices
+are kept sorted in chunks, so that a new device is put in place by moving the
+devices of its chunk only. When sorted by a metric, only the devices updated
+since are moved again every RESORT_INTERVAL, which also keeps the rows from
+jumping around while they are read.
+"""
+
+import curses
+import locale
+import sys
+from array import array
+from bisect import bisect_left, insort
+from collections import deque
+
+from pistatscommon import monotonic, CPU_STATES
+from pistatsstore import IFACE_OFFSETS, CURRENT, MAX, MIN, METRIC_WIDTH
+from pistatswindow import QUANTILES
+
+# Number of seconds between two reads of the keyboard
+INPUT_INTERVAL = 0.1
+
+# Number of seconds between two sorts of the devices by a metric
+RESORT_INTERVAL = 5.0
+
+# Number of devices per chunk of the sorted devices, a chunk is split in two
+# once twice as long
+SORT_CHUNK = 500
+
+# Number of CPU utilization values kept per device for its sparkline
+SPARK_POINTS = 20
+
+# The orders the devices can be listed in, cycled through with the 's' key
+SORT_KEYS = ("key", "cpu", "rx", "tx")
+
+# Number of lines printed while the dashboard is displayed that are printed
+# again once it is closed, since they would otherwise be lost
+LOG_LINES = 100
+
+# The characters of a sparkline, from the lowest to the highest value
+SPARK_BLOCKS = u"\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588"
+SPARK_ASCII = "_.-=+*#@"
+
+# Number of lines at the top and at the bottom of the screen that are not device rows
+HEADER_LINES = 2
+FOOTER_LINES = 1
+
+KEYS_HELP = "q:quit s:sort r:reverse j/k:select n/p:page enter:detail"
+
+
+def format_percent(value):
+    """
+    :param value: (float) A share, such as a CPU utilization between 0 and 1
+    :return: (str) The share as a percentage, such as ' 12.5%'
+    """
+    return "%5.1f%%" %(value * 100)
+
+
+def format_rate(value):
+    """
+    :param value: (float) A number of bytes per second
+    :return: (str) The rate in the largest unit it reaches, such as '1.2MB/s'
+    """
+    for unit in ("B/s", "kB/s", "MB/s"):
+        if abs(value) < 1000:
+            return "%.1f%s" %(value, unit)
+        value /= 1000.0
+    return "%.1fGB/s" %(value)
+
+
+def device_rates(device):
+    """
+    :param device: (pistatsstore.DeviceStats) The device
+    :return: (tuple) The current bytes per second received and transmitted by all its interfaces
+    """
+    rx = 0.0
+    tx = 0.0
+    rx_offset = IFACE_OFFSETS["rx"] + CURRENT
+    tx_offset = IFACE_OFFSETS["tx"] + CURRENT
+    for record in device.net.values():
+        rx += record[rx_offset]
+        tx += record[tx_offset]
+    return rx, tx
+
+
+def sort_value(device, sort_key):
+    """
+    :param device: (pistatsstore.DeviceStats) The device
+    :param sort_key: (str) One of SORT_KEYS
+    :return: The value the device is sorted on
+    """
+    if sort_key == "key":
+        return device.routing_key
+    if sort_key == "cpu":
+        return device.cpu[CURRENT]
+    rx, tx = device_rates(device)
+    return rx if sort_key == "rx" else tx
+
+
+def sparkline(values, blocks):
+    """
+    :param values: (list) The values between 0 and 1, oldest first
+    :param blocks: (sequence) The characters drawing the lowest to the highest values
+    :return: The sparkline, of the same type as blocks
+    """
+    top = len(blocks) - 1
+    return blocks[:0].join(blocks[min(top, max(0, int(value * len(blocks))))] for value in values)
+
+
+class _History(object):
+    # The last SPARK_POINTS CPU utilization values of a device, in a ring
+
+    __slots__ = ("values", "next", "count")
+
+    def __init__(self):
+        self.values = array("f", [0.0] * SPARK_POINTS)
+        self.next = 0
+        self.count = 0
+
+    def add(self, value):
+        self.values[self.next] = value
+        self.next = (self.next + 1) % SPARK_POINTS
+        self.count = min(self.count + 1, SPARK_POINTS)
+
+    def points(self):
+        start = (self.next - self.count) % SPARK_POINTS
+        return [self.values[(start + i) % SPARK_POINTS] for i in range(self.count)]
+
+
+class _SortedList(object):
+    # A list kept sorted in chunks, so that an item is added or removed by only moving the items of its chunk
+
+    def __init__(self, items=()):
+        items = sorted(items)
+        self.__chunks = [items[i:i + SORT_CHUNK] for i in range(0, len(items), SORT_CHUNK)]
+        self.__maxes = [chunk[-1] for chunk in self.__chunks]
+        self.__len = len(items)
+
+    def __len__(self):
+        return self.__len
+
+    def add(self, item):
+        chunks = self.__chunks
+        maxes = self.__maxes
+        if not chunks:
+            chunks.append([item])
+            maxes.append(item)
+        else:
+            i = bisect_left(maxes, item)
+            if i == len(chunks):
+                # Past the end of the last chunk
+                i -= 1
+                chunks[i].append(item)
+                maxes[i] = item
+            else:
+                insort(chunks[i], item)
+            chunk = chunks[i]
+            if len(chunk) > 2 * SORT_CHUNK:
+                chunks[i:i + 1] = [chunk[:SORT_CHUNK], chunk[SORT_CHUNK:]]
+                maxes[i:i + 1] = [chunk[SORT_CHUNK - 1], chunk[-1]]
+        self.__len += 1
+
+    def remove(self, item):
+        i = bisect_left(self.__maxes, item)
+        chunk = self.__chunks[i]
+        del chunk[bisect_left(chunk, item)]
+        if not chunk:
+            del self.__chunks[i]
+            del self.__maxes[i]
+        else:
+            self.__maxes[i] = chunk[-1]
+        self.__len -= 1
+
+    def index(self, item):
+        i = bisect_left(self.__maxes, item)
+        return sum(len(chunk) for chunk in self.__chunks[:i]) + bisect_left(self.__chunks[i], item)
+
+    def range(self, start, stop):
+        # Returns the items from index start up to index stop, walking the chunks once
+        items = []
+        for chunk in self.__chunks:
+            if start < len(chunk):
+                items.extend(chunk[max(start, 0):stop])
+            start -= len(chunk)
+            stop -= len(chunk)
+            if stop <= 0:
+                break
+        return items
+
+
+class _LogWriter(object):
+    # Stands in for stdout and stderr while the dashboard is displayed, keeping the lines printed
+
+    def __init__(self, dashboard):
+        self.__dashboard = dashboard
+        self.__partial = ""
+        self.softspace = 0
+
+    def write(self, text):
+        lines = (self.__partial + text).split("\n")
+        self.__partial = lines.pop()
+        for line in lines:
+            self.__dashboard.log(line)
+
+    def flush(self):
+        pass
+
+
+class DashboardRenderer(object):
+    """
+    Displays the devices on a full-screen dashboard, redrawn once per refresh
+    interval. It is used like pistatsrender.StatsRenderScheduler
+    """
+
+    def __init__(self, connection, refresh, store, metrics=None, sparklines=False, on_quit=None):
+        """
+        Create a new DashboardRenderer object, the screen is only taken over by start()
+
+        :param connection: (pika.BlockingConnection) The connection, or the IOLoop, whose event loop drives the
+                           redraw and keyboard timers
+        :param refresh: (float) The number of seconds between two redraws, 0 redraws as often as the keyboard is read
+        :param store: (pistatsstore.StatsStore) The store the devices are looked up in when redrawn
+        :param metrics: (pistatsmetrics.Metrics) Times every redraw, None to time nothing
+        :param sparklines: (bool) Whether the recent CPU utilization of every device is kept and displayed
+        :param on_quit: (callable) Called without arguments when the 'q' key is pressed
+        :return: None
+        """
+        self.__connection = connection
+        self.__refresh = max(refresh, INPUT_INTERVAL)
+        self.__store = store
+        self.__metrics = metrics
+        self.__on_quit = on_quit
+        self.__screen = None
+        self.__blocks = SPARK_ASCII
+        self.__encoding = None
+        self.__stdout = None
+        self.__stderr = None
+
+        # The update each device was last marked dirty at, keyed by routing key
+        self.__stamps = dict()
+        self.__stamp = 0
+        self.__history = dict() if sparklines else None
+
+        # The (sort value, routing key) of the devices in ascending order, the sort value of each device, the
+        # devices updated since they were last sorted, and when they were
+        self.__sort_key = SORT_KEYS[0]
+        self.__reverse = False
+        self.__order = _SortedList()
+        self.__sort_values = dict()
+        self.__unsorted = set()
+        self.__sorted_at = None
+
+        # The index of the selected device in display order, and whether its detail pane is shown
+        self.__selected = 0
+        self.__detail = False
+
+        # What is drawn on each line of the screen, to skip the lines that didn't change
+        self.__lines = []
+        self.__row_ids = []
+        self.__detail_id = None
+        self.__detail_lines = []
+        self.__next_frame = 0.0
+
+        # The lines printed while the dashboard is displayed, the last one being shown at the bottom
+        self.logged = deque(maxlen=LOG_LINES)
+
+    def start(self):
+        """
+        Takes over the terminal and starts the redraw and keyboard timers
+
+        :raises curses.error: if the terminal can't be controlled
+        :return: None
+        """
+        locale.setlocale(locale.LC_ALL, "")
+        self.__encoding = locale.getpreferredencoding()
+        if self.__encoding.lower().replace("-", "") == "utf8":
+            self.__blocks = SPARK_BLOCKS
+
+        self.__screen = curses.initscr()
+        curses.noecho()
+        curses.cbreak()
+        self.__screen.keypad(1)
+        self.__screen.nodelay(1)
+        try:
+            curses.curs_set(0)
+        except curses.error:
+            pass
+
+        # Anything printed meanwhile, such as the stats lines or the alerts, would be drawn over the dashboard
+        self.__stdout = sys.stdout
+        self.__stderr = sys.stderr
+        sys.stdout = sys.stderr = _LogWriter(self)
+
+        self.__invalidate()
+        self.__connection.add_timeout(INPUT_INTERVAL, self.__on_tick)
+
+    def mark_dirty(self, key):
+        """
+        Records that a device was updated and needs to be redrawn
+
+        :param key: (str) The routing key of the device that was updated. The device is only looked up in the
+                    store when redrawn, since merging the results of a worker replaces it
+        :return: None
+        """
+        if key not in self.__stamps:
+            # A new device is put in place right away, an updated one by the next sort
+            value = self.__sort_values[key] = sort_value(self.__store.devices[key], self.__sort_key)
+            self.__order.add((value, key))
+        elif self.__sort_key != "key":
+            self.__unsorted.add(key)
+        self.__stamp += 1
+        self.__stamps[key] = self.__stamp
+        if self.__history is not None:
+            history = self.__history.get(key)
+            if history is None:
+                history = self.__history[key] = _History()
+            history.add(self.__store.devices[key].cpu[CURRENT])
+
+    def log(self, line):
+        """
+        Shows a printed line at the bottom of the dashboard
+
+        :param line: (str) The line, without its line feed
+        :return: None
+        """
+        self.logged.append(line)
+
+    def render(self):
+        """
+        Redraws the lines of the screen that changed since the last redraw
+
+        :return: None
+        """
+        screen = self.__screen
+        if screen is None:
+            return
+        metrics = self.__metrics
+        if metrics is not None:
+            start = monotonic()
+
+        # The windows of the devices that stopped reporting only move on when expired, mark them updated
+        now = monotonic()
+        for key in self.__store.expire_windows(now):
+            if key in self.__stamps:
+                self.__stamp += 1
+                self.__stamps[key] = self.__stamp
+        if self.__unsorted and (self.__sorted_at is None or now - self.__sorted_at >= RESORT_INTERVAL):
+            self.__resort(now)
+
+        height, width = screen.getmaxyx()
+        list_lines, detail_lines = self.__layout(height)
+        count = len(self.__order)
+        self.__selected = min(self.__selected, max(0, count - 1))
+        page = self.__selected / list_lines
+        first = page * list_lines
+
+        self.__draw(0, "pistatsview  %d device(s)  sorted by %s%s  page %d/%d" %(
+            count, self.__sort_key, " (descending)" if self.__reverse else "", page + 1, max(1, (count + list_lines - 1) / list_lines)))
+        title = "%-32s %7s %7s %7s %11s %11s" %("Device", "CPU", "High", "Low", "Rx", "Tx")
+        if self.__history is not None:
+            title += "  Recent CPU"
+        self.__draw(1, title, curses.A_BOLD)
+
+        # Only format the rows whose device, or place, changed
+        keys = self.__keys_at(first, list_lines)
+        for line in range(list_lines):
+            index = first + line
+            key = keys[line] if line < len(keys) else None
+            row_id = (key, self.__stamps.get(key), index == self.__selected)
+            if self.__row_ids[line] != row_id:
+                self.__row_ids[line] = row_id
+                if key is None:
+                    self.__draw(HEADER_LINES + line, "")
+                else:
+                    self.__draw(HEADER_LINES + line, self.__format_row(self.__store.devices[key]),
+                                curses.A_REVERSE if row_id[2] else 0)
+
+        if detail_lines:
+            key = self.__keys_at(self.__selected, 1)[0] if count else None
+            detail_id = (key, self.__stamps.get(key), detail_lines)
+            if self.__detail_id != detail_id:
+                self.__detail_id = detail_id
+                self.__detail_lines = self.__format_detail(self.__store.devices[key]) if key is not None else []
+                top = HEADER_LINES + list_lines
+                self.__draw(top, "-" * width, curses.A_BOLD)
+                for line in range(1, detail_lines):
+                    text = self.__detail_lines[line - 1] if line - 1 < len(self.__detail_lines) else ""
+                    self.__draw(top + line, text)
+
+        self.__draw(height - 1, self.logged[-1] if self.logged else KEYS_HELP)
+        screen.noutrefresh()
+        curses.doupdate()
+        if metrics is not None:
+            metrics.observe("render_seconds", monotonic() - start)
+
+    def close(self):
+        """
+        Gives the terminal back, and prints the lines printed while the dashboard was displayed
+
+        :return: None
+        """
+        if self.__screen is None:
+            return
+        sys.stdout = self.__stdout
+        sys.stderr = self.__stderr
+        self.__screen.keypad(0)
+        curses.nocbreak()
+        curses.echo()
+        curses.endwin()
+        self.__screen = None
+        for line in self.logged:
+            print line
+        self.logged.clear()
+
+    def __layout(self, height):
+        # Returns the number of device rows, and of detail pane lines, that fit on the screen
+        lines = max(1, height - HEADER_LINES - FOOTER_LINES)
+        detail_lines = lines / 2 if self.__detail and lines > 2 else 0
+        if len(self.__row_ids) != lines - detail_lines:
+            self.__row_ids = [None] * (lines - detail_lines)
+        return lines - detail_lines, detail_lines
+
+    def __keys_at(self, index, count):
+        # Returns the routing keys of the devices from an index on, in display order
+        if self.__reverse:
+            end = len(self.__order) - index
+            entries = self.__order.range(max(0, end - count), end)
+            entries.reverse()
+        else:
+            entries = self.__order.range(index, index + count)
+        return [key for value, key in entries]
+
+    def __sort(self, now):
+        # Sorts all the devices on the current sort key, keeping the selected device selected
+        selected = self.__keys_at(self.__selected, 1)[0] if len(self.__order) else None
+        sort_key = self.__sort_key
+        devices = self.__store.devices
+        for key in self.__sort_values:
+            self.__sort_values[key] = sort_value(devices[key], sort_key)
+        self.__order = _SortedList((value, key) for key, value in self.__sort_values.iteritems())
+        self.__unsorted.clear()
+        self.__sorted(now, selected)
+
+    def __resort(self, now):
+        # Moves the devices updated since the last sort to their new place, keeping the selected device selected
+        selected = self.__keys_at(self.__selected, 1)[0] if len(self.__order) else None
+        sort_key = self.__sort_key
+        devices = self.__store.devices
+        for key in self.__unsorted:
+            value = sort_value(devices[key], sort_key)
+            if value != self.__sort_values[key]:
+                self.__order.remove((self.__sort_values[key], key))
+                self.__order.add((value, key))
+                self.__sort_values[key] = value
+        self.__unsorted.clear()
+        self.__sorted(now, selected)
+
+    def __sorted(self, now, selected):
+        self.__sorted_at = now
+        if selected is not None:
+            index = self.__order.index((self.__sort_values[selected], selected))
+            self.__selected = len(self.__order) - 1 - index if self.__reverse else index
+        self.__row_ids = [None] * len(self.__row_ids)
+
+    def __format_row(self, device):
+        rx, tx = device_rates(device)
+        cpu = device.cpu
+        row = "%-32s %7s %7s %7s %11s %11s" %(device.routing_key[:32], format_percent(cpu[CURRENT]),
+                                              format_percent(cpu[MAX]), format_percent(cpu[MIN]),
+                                              format_rate(rx), format_rate(tx))
+        if self.__history is not None:
+            history = self.__history.get(device.routing_key)
+            if history is not None:
+                spark = sparkline(history.points(), self.__blocks)
+                if isinstance(spark, unicode):
+                    row = row.decode(self.__encoding, "replace")
+                row += "  " + spark
+        return row
+
+    def __format_detail(self, device):
+        cpu = device.cpu
+        lines = ["%s  CPU %s  high %s  low %s  %d update(s)" %(
+            device.routing_key, format_percent(cpu[CURRENT]), format_percent(cpu[MAX]),
+            format_percent(cpu[MIN]), device.updates)]
+        if device.cores is not None:
+            lines.append("Cores   " + "  ".join("CPU%d %s" %(core, format_percent(device.cores[core * METRIC_WIDTH + CURRENT]))
+                                                for core in range(len(device.cores) / METRIC_WIDTH)))
+        if device.cpu_states is not None:
+            lines.append("States  " + "  ".join("%s %s" %(state, format_percent(device.cpu_states[i * METRIC_WIDTH + CURRENT]))
+                                                for i, state in enumerate(CPU_STATES)))
+        for iface in sorted(device.net.keys()):
+            record = device.net[iface]
+            lines.append("%-7s " %(iface) + "  ".join("%s %s (high %s, low %s)" %(
+                mode, format_rate(record[IFACE_OFFSETS[mode] + CURRENT]), format_rate(record[IFACE_OFFSETS[mode] + MAX]),
+                format_rate(record[IFACE_OFFSETS[mode] + MIN])) for mode in ("rx", "tx")))
+        for key in sorted(device.windows.keys()):
+            display = format_percent if key[0] == "CPU" else format_rate
+            for (label, span), window in zip(device.spans, device.windows[key]):
+                lines.append("%-4s %-10s %-4s mean %s  low %s  high %s  %s" %(
+                    key[0], key[1], label, display(window.mean()), display(window.min()), display(window.max()),
+                    "  ".join("p%g %s" %(p * 100, display(window.quantile(p))) for p in QUANTILES)))
+        return lines
+
+    def __draw(self, y, text, attr=0):
+        # Draws a line of the screen, unless it already shows the same text
+        if y >= len(self.__lines) or self.__lines[y] == (text, attr):
+            return
+        self.__lines[y] = (text, attr)
+        width = self.__screen.getmaxyx()[1]
+        if isinstance(text, unicode):
+            text = text[:width - 1].encode(self.__encoding, "replace")
+        else:
+            text = text[:width - 1]
+        try:
+            self.__screen.move(y, 0)
+            self.__screen.clrtoeol()
+            self.__screen.addstr(y, 0, text, attr)
+        except curses.error:
+            # The screen shrank meanwhile, it is redrawn once the resize is read
+            pass
+
+    def __invalidate(self):
+        # Forgets what is drawn, so that the whole screen is drawn again
+        height, width = self.__screen.getmaxyx()
+        self.__lines = [None] * height
+        self.__row_ids = [None] * len(self.__row_ids)
+        self.__detail_id = None
+        self.__screen.erase()
+
+    def __on_key(self, key, page_size):
+        # Applies a key press to the view, returns whether the view changed
+        count = len(self.__order)
+        if key == ord("q"):
+            if self.__on_quit is not None:
+                self.__on_quit()
+            return False
+        elif key == ord("s"):
+            self.__sort_key = SORT_KEYS[(SORT_KEYS.index(self.__sort_key) + 1) % len(SORT_KEYS)]
+            # Highest values first, but routing keys in alphabetical order
+            self.__reverse = self.__sort_key != "key"
+            self.__sort(monotonic())
+        elif key == ord("r"):
+            self.__reverse = not self.__reverse
+            if self.__order:
+                self.__selected = count - 1 - self.__selected
+        elif key in (curses.KEY_DOWN, ord("j")):
+            self.__selected = min(self.__selected + 1, max(0, count - 1))
+        elif key in (curses.KEY_UP, ord("k")):
+            self.__selected = max(self.__selected - 1, 0)
+        elif key in (curses.KEY_NPAGE, ord("n"), ord(" ")):
+            self.__selected = min(self.__selected + page_size, max(0, count - 1))
+        elif key in (curses.KEY_PPAGE, ord("p")):
+            self.__selected = max(self.__selected - page_size, 0)
+        elif key in (curses.KEY_HOME, ord("g")):
+            self.__selected = 0
+        elif key in (curses.KEY_END, ord("G")):
+            self.__selected = max(0, count - 1)
+        elif key in (curses.KEY_ENTER, ord("\n"), ord("\r"), ord("d")):
+            self.__detail = not self.__detail
+            self.__invalidate()
+        elif key == curses.KEY_RESIZE:
+            self.__invalidate()
+        else:
+            return False
+        return True
+
+    def __on_tick(self):
+        if self.__screen is None:
+            return
+        changed = False
+        page_size = len(self.__row_ids) or 1
+        while True:
+            key = self.__screen.getch()
+            if key == -1:
+                break
+            changed = self.__on_key(key, page_size) or changed
+            if self.__screen is None:
+                return
+
+        now = monotonic()
+        if changed or now >= self.__next_frame:
+            self.render()
+            self.__next_frame = now + self.__refresh
+        self.__connection.add_timeout(INPUT_INTERVAL, self.__on_tick)
@@ -0,0 +1,290 @@
+"""
+This file contains the asynchronous consumer used by pistatsview.py to
+subscribe to several message brokers at once
+
+Every broker gets its own pika.SelectConnection, and all the connections
+share a single IOLoop. Messages are handed over to the shared aggregation and
+display path in small slices, so that no broker can starve the others, and
+are only acknowledged, in bulk, once they were handled. Since every broker
+channel is limited to 'prefetch' unacknowledged messages, a slow display makes
+the brokers hold back their messages instead of growing the viewer's memory.
+"""
+
+import errno
+import select
+import sys
+from collections import deque
+
+import pika
+from pika.adapters.select_connection import IOLoop
+
+from pistatsack import BulkAcknowledger, PREFETCH_COUNT, ACK_EVERY, ACK_TIME
+from pistatscommon import parse_broker, SHARED_EXCHANGE_TYPE, SHARED_EXCHANGE_PLUGIN, SHARED_WEIGHT
+
+# Number of messages handled before giving the IOLoop back to the brokers
+DRAIN_SLICE = 50
+
+
+class BrokerConsumer(object):
+    """
+    Consumes the utilization messages of a single broker on a shared IOLoop
+    """
+
+    def __init__(self, fan_in, broker, vhost, credentials):
+        """
+        Create a new BrokerConsumer object and start connecting to the broker
+
+        :param fan_in: (FanInConsumer) The consumer the messages are handed over to
+        :param broker: (str) The broker address in the form host or host:port
+        :param vhost: (str) The virtual host to connect to
+        :param credentials: (pika.PlainCredentials) The credentials to use, None for the default ones
+        :return: None
+        """
+        self.broker = broker
+        self.channel = None
+        self.acknowledger = None
+        self.closed = False
+        self.__fan_in = fan_in
+        # Whether the exchange of the share group is being declared, which fails without its plugin
+        self.__declaring_group = False
+
+        host, port = parse_broker(broker)
+        parameters = pika.ConnectionParameters(host=host, virtual_host=vhost, credentials=credentials)
+        if port is not None:
+            parameters.port = port
+
+        self.connection = pika.SelectConnection(parameters,
+                                                on_open_callback=self.__on_connection_open,
+                                                on_open_error_callback=self.__on_connection_error,
+                                                on_close_callback=self.__on_connection_closed,
+                                                stop_ioloop_on_close=False,
+                                                custom_ioloop=fan_in.ioloop)
+
+    def close(self):
+        """
+        Closes the connection to the broker
+
+        :return: None
+        """
+        if self.closed:
+            return
+        if self.acknowledger is not None:
+            self.acknowledger.flush()
+        if self.connection.is_open:
+            self.connection.close()
+        else:
+            # Still connecting, abandon the connection
+            self.__set_closed()
+
+    def __on_connection_open(self, connection):
+        connection.channel(on_open_callback=self.__on_channel_open)
+
+    def __on_connection_error(self, connection, error_message=None):
+        print >> sys.stderr, "Error: Could not connect to message broker %s: %s" %(self.broker, error_message)
+        self.__set_closed()
+
+    def __on_connection_closed(self, connection, reply_code, reply_text):
+        if not self.__fan_in.stopping:
+            print >> sys.stderr, "Error: Connection to message broker %s closed: (%s) %s" %(self.broker, reply_code, reply_text)
+        self.__set_closed()
+
+    def __set_closed(self):
+        if not self.closed:
+            self.closed = True
+            self.__fan_in.on_consumer_closed(self)
+
+    def __on_channel_open(self, channel):
+        self.channel = channel
+        self.acknowledger = BulkAcknowledger(channel, self.__fan_in.ack_every, self.__fan_in.ack_time)
+        self.acknowledger.start(self.__fan_in.ioloop)
+        channel.add_on_close_callback(self.__on_channel_closed)
+        channel.exchange_declare(self.__on_exchange_declared, exchange=self.__fan_in.exchange,
+                                 type=self.__fan_in.exchange_type)
+
+    def __on_channel_closed(self, channel, reply_code, reply_text):
+        if not self.__fan_in.stopping:
+            print >> sys.stderr, "Error: Channel to message broker %s closed: (%s) %s" %(self.broker, reply_code, reply_text)
+            if self.__declaring_group:
+                # Most likely since the broker doesn't know the exchange type
+                print >> sys.stderr, "Share groups need the %s plugin on the broker, enable it with " \
+                    "'rabbitmq-plugins enable %s'" %(SHARED_EXCHANGE_PLUGIN, SHARED_EXCHANGE_PLUGIN)
+        self.close()
+
+    def __on_exchange_declared(self, frame):
+        if self.__fan_in.share_group is None:
+            # Creating an exclusive queue NOTE that will only exists as long as the client is connected
+            self.channel.queue_declare(self.__on_queue_declared, exclusive=True)
+        else:
+            # Split the devices with the other viewers through a shared exchange, deleted once the last one leaves
+            self.__declaring_group = True
+            self.channel.exchange_declare(self.__on_shared_exchange_declared, exchange=self.__fan_in.share_group,
+                                          type=SHARED_EXCHANGE_TYPE, auto_delete=True)
+
+    def __on_shared_exchange_declared(self, frame):
+        self.__declaring_group = False
+        for topic in self.__fan_in.topics:
+            self.channel.exchange_bind(None, self.__fan_in.share_group, self.__fan_in.exchange, routing_key=topic,
+                                       nowait=True)
+        self.channel.queue_declare(self.__on_queue_declared, exclusive=True)
+
+    def __on_queue_declared(self, method_frame):
+        queue_name = method_frame.method.queue
+        if self.__fan_in.share_group is None:
+            for topic in self.__fan_in.topics:
+                self.channel.queue_bind(None, queue_name, self.__fan_in.exchange, routing_key=topic, nowait=True)
+        else:
+            self.channel.queue_bind(None, queue_name, self.__fan_in.share_group, routing_key=SHARED_WEIGHT,
+                                    nowait=True)
+        self.channel.basic_qos(lambda frame: self.channel.basic_consume(self.__on_message, queue=queue_name),
+                               prefetch_count=self.__fan_in.prefetch)
+
+    def __on_message(self, channel, delivery_info, msg_properties, msg):
+        self.__fan_in.enqueue(self.acknowledger, channel, delivery_info, msg_properties, msg)
+
+
+class FanInConsumer(object):
+    """
+    Consumes the utilization messages of several brokers on a single IOLoop
+    and hands them over, one at a time, to a message handler
+    """
+
+    def __init__(self, brokers, vhost, credentials, exchange, topics, on_message, prefetch=PREFETCH_COUNT,
+                 ack_every=ACK_EVERY, ack_time=ACK_TIME, exchange_type="direct", share_group=None, defer_acks=False):
+        """
+        Create a new FanInConsumer object
+
+        :param brokers: (list) The broker addresses, in the form host or host:port
+        :param vhost: (str) The virtual host to connect to on every broker
+        :param credentials: (pika.PlainCredentials) The credentials to use, None for the default ones
+        :param exchange: (str) The exchange to bind to
+        :param topics: (list) The routing keys, or the patterns of a topic exchange, to subscribe to
+        :param on_message: (callable) The message handler, called like a pika consumer callback
+        :param prefetch: (int) The number of unacknowledged messages each broker may send
+        :param ack_every: (int) The number of handled messages acknowledged at once, at most prefetch
+        :param ack_time: (float) The maximum number of seconds a handled message waits for its acknowledgement
+        :param exchange_type: (str) The type of the exchange, 'direct' or 'topic'
+        :param share_group: (str) The name of the exchange splitting the devices between the viewers given the
+                            same name, None to receive every message
+        :param defer_acks: (bool) Whether the message handler acknowledges the messages itself once they were
+                           handled, with the acknowledger returned by acknowledger_of(), rather than on return
+        :raises ValueError: if ack_every is lower than one or greater than prefetch
+        :return: None
+        """
+        if not 1 <= ack_every <= prefetch:
+            raise ValueError("The number of messages acknowledged at once must be between 1 and the prefetch count")
+
+        self.ioloop = IOLoop()
+        self.exchange = exchange
+        self.exchange_type = exchange_type
+        self.share_group = share_group
+        self.topics = topics
+        self.prefetch = prefetch
+        self.ack_every = ack_every
+        self.ack_time = ack_time
+        self.stopping = False
+        self.__defer_acks = defer_acks
+        self.__brokers = brokers
+        self.__vhost = vhost
+        self.__credentials = credentials
+        self.__on_message = on_message
+        self.__consumers = []
+        # Messages received but not handled yet, bounded by prefetch per broker
+        self.__pending = deque()
+        self.__draining = False
+
+    def run(self):
+        """
+        Connects to every broker and runs the IOLoop until stop() is called
+        or all connections are closed
+
+        :return: None
+        """
+        for broker in self.__brokers:
+            self.__consumers.append(BrokerConsumer(self, broker, self.__vhost, self.__credentials))
+
+        # Connections that failed right away are already closed
+        while not all(consumer.closed for consumer in self.__consumers):
+            try:
+                self.ioloop.start()
+            except (IOError, OSError, select.error), error:
+                # pika's pollers don't retry a poll interrupted by a signal
+                if error.args[0] != errno.EINTR:
+                    raise
+
+    def stop(self, signal=None, frame=None):
+        """
+        Closes every broker connection, which stops the IOLoop once they are all closed
+
+        :param signal: (int) A number if a intercepted signal caused this
+                        handler to be run, otherwise None
+        :param frame: A Stack Frame object, if an intercepted signal caused this handler to be run
+        :return: None
+        """
+        self.stopping = True
+        for consumer in self.__consumers:
+            consumer.close()
+        self.on_consumer_closed(None)
+
+    def on_consumer_closed(self, consumer):
+        """
+        Stops the IOLoop once every broker connection is closed, or leaves it
+        stopped if it isn't running yet
+
+        :param consumer: (BrokerConsumer) The consumer whose connection was closed
+        :return: None
+        """
+        if all(consumer.closed for consumer in self.__consumers):
+            self.ioloop.stop()
+
+    def acknowledgers(self):
+        """
+        Returns the acknowledgers of the brokers whose channel was opened
+
+        :return: (list) The pistatsack.BulkAcknowledger of each broker
+        """
+        return [consumer.acknowledger for consumer in self.__consumers if consumer.acknowledger is not None]
+
+    def acknowledger_of(self, channel):
+        """
+        Returns the acknowledger of a broker channel
+
+        :param channel: (pika.channel.Channel) The channel a message was received from
+        :return: (pistatsack.BulkAcknowledger) The acknowledger of the channel, None if it is unknown
+        """
+        for consumer in self.__consumers:
+            if consumer.channel is channel:
+                return consumer.acknowledger
+        return None
+
+    def enqueue(self, acknowledger, channel, delivery_info, msg_properties, msg):
+        """
+        Queues a received message for the message handler
+
+        :param acknowledger: (pistatsack.BulkAcknowledger) Acknowledges the message once it was handled
+        :param channel: (pika.channel.Channel) The channel object this message was received from
+        :param delivery_info: (pika.spec.Basic.Deliver) Delivery information related to the message
+        :param msg_properties: (pika.spec.BasicProperties) Additional metadata about the message
+        :param msg: The message received from the broker
+        :return: None
+        """
+        self.__pending.append((acknowledger, channel, delivery_info, msg_properties, msg))
+        if not self.__draining:
+            self.__draining = True
+            self.ioloop.add_timeout(0, self.__drain)
+
+    def __drain(self):
+        # Handle a slice of the pending messages, then let the IOLoop serve
+        # the sockets and timers before handling the next slice
+        pending = self.__pending
+        for i in range(min(DRAIN_SLICE, len(pending))):
+            acknowledger, channel, delivery_info, msg_properties, msg = pending.popleft()
+            try:
+                self.__on_message(channel, delivery_info, msg_properties, msg)
+            finally:
+                if not self.__defer_acks:
+                    acknowledger.ack(delivery_info.delivery_tag)
+
+        if pending:
+            self.ioloop.add_timeout(0, self.__drain)
+        else:
+            self.__draining = False
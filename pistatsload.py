@@ -0,0 +1,608 @@
+#!/usr/bin/python
+"""
+This file contains pistatsload.py which simulates a fleet of Raspberry Pis
+publishing their utilization, to capacity plan the broker and pistatsview.py
+
+Every virtual device builds its messages like pistatsd.py does, from
+synthetic cpu and network statistics or from the samples recorded by
+pistatsview.py --record, and publishes them at its own rate. Thousands of
+devices run in a single process, driven by one timer queue, and the devices
+can be spread over several processes.
+
+The messages are published to a RabbitMQ broker, or, without one, handed to an
+in-process stand-in that decodes and aggregates them like pistatsview.py does,
+inline or on its worker pool, so the viewer's scaling can be measured
+reproducibly on a single machine.
+"""
+
+import heapq
+import multiprocessing
+import random
+import signal
+import sys
+import time
+from collections import deque
+
+from pistatscodec import StatsEncoder, StatsDecoder, FORMATS
+from pistatscommon import parse_duration, monotonic, CPU_STATES, NET_COUNTERS, EXCHANGE_TYPES, EXCHANGE_NAMES, \
+    SAMPLED_HEADER
+from pistatsmetrics import Metrics, METRIC_QUANTILES
+from pistatsproc import build_utilization_msg
+from pistatspublisher import BatchPublisher
+from pistatswindow import merged_quantile
+
+# Number of devices per rack in the generated routing keys, 'prefix.rackN.piM'
+RACK_DEVICES = 40
+
+# The share of the samples the synthetic cpu spikes in
+SPIKE_CHANCE = 0.01
+
+
+class SyntheticCpuSampler(object):
+    """
+    Makes up the cpu statistics of a device, as a random walk of the
+    utilization of each core with occasional spikes
+    """
+
+    def __init__(self, cores, rng):
+        """
+        Create a new SyntheticCpuSampler object
+
+        :param cores: (int) The number of cores
+        :param rng: (random.Random) The random number generator
+        :return: None
+        """
+        self.__rng = rng
+        self.__cores = [rng.uniform(0.05, 0.5) for core in range(cores)]
+        self.__current = list(self.__cores)
+
+    def sample(self):
+        """
+        Moves on to the next sample
+
+        :return: None
+        """
+        rng = self.__rng
+        for i in range(len(self.__cores)):
+            self.__cores[i] = min(1.0, max(0.0, self.__cores[i] + rng.gauss(0.0, 0.02)))
+            self.__current[i] = 1.0 if rng.random() < SPIKE_CHANCE else self.__cores[i]
+
+    def utilization(self):
+        """
+        :return: (tuple) The overall utilization, the share of time spent in
+                 each of CPU_STATES and the utilization of each core, like
+                 pistatsproc.CpuStatSampler.utilization()
+        """
+        cpu = sum(self.__current) / len(self.__current)
+        states = [0.0] * len(CPU_STATES)
+        states[CPU_STATES.index("user")] = cpu * 0.7
+        states[CPU_STATES.index("system")] = cpu * 0.25
+        states[CPU_STATES.index("softirq")] = cpu * 0.05
+        states[CPU_STATES.index("idle")] = 1.0 - cpu
+        return cpu, states, list(self.__current)
+
+
+class SyntheticNetSampler(object):
+    """
+    Makes up the network interface statistics of a device, as a random walk
+    of the bytes received and transmitted by each interface
+    """
+
+    def __init__(self, ifaces, rng):
+        """
+        Create a new SyntheticNetSampler object
+
+        :param ifaces: (int) The number of interfaces, named 'eth0', 'eth1'...
+        :param rng: (random.Random) The random number generator
+        :return: None
+        """
+        self.__rng = rng
+        self.ifaces = ["eth%d" %(i) for i in range(ifaces)]
+        self.__bytes = [[rng.uniform(1e3, 1e6), rng.uniform(1e3, 1e6)] for iface in self.ifaces]
+
+    def sample(self):
+        """
+        Moves on to the next sample
+
+        :return: None
+        """
+        rng = self.__rng
+        for rates in self.__bytes:
+            rates[0] = max(0.0, rates[0] * rng.uniform(0.8, 1.25))
+            rates[1] = max(0.0, rates[1] * rng.uniform(0.8, 1.25))
+
+    def rates(self, period):
+        """
+        :param period: (float) The number of seconds between the last two samples, unused
+        :return: (dict) The rate per second of every counter of each
+                 interface, like pistatsproc.NetDevSampler.rates()
+        """
+        result = dict()
+        for iface, (rx, tx) in zip(self.ifaces, self.__bytes):
+            counters = dict.fromkeys(NET_COUNTERS, 0.0)
+            counters["rx"] = int(rx)
+            counters["tx"] = int(tx)
+            counters["rx_packets"] = rx / 800
+            counters["tx_packets"] = tx / 800
+            result[iface] = counters
+        return result
+
+
+class TraceSampler(object):
+    """
+    Replays the samples pistatsview.py --record recorded for a device, in a
+    loop. It stands in for both the cpu and the network interface samplers
+    """
+
+    def __init__(self, trace, start=0):
+        """
+        Create a new TraceSampler object
+
+        :param trace: (list) The samples, as returned by load_trace()
+        :param start: (int) The index of the first sample replayed
+        :return: None
+        """
+        self.__trace = trace
+        self.__index = start % len(trace)
+
+    def sample(self):
+        """
+        Moves on to the next recorded sample
+
+        :return: None
+        """
+        self.__index = (self.__index + 1) % len(self.__trace)
+
+    def utilization(self):
+        """
+        :return: (tuple) The recorded utilization, shares of time and core utilization
+        """
+        cpu, states, cores, net = self.__trace[self.__index]
+        return cpu, states, cores
+
+    def rates(self, period):
+        """
+        :param period: (float) The number of seconds between the last two samples, unused
+        :return: (dict) The recorded rates of each interface
+        """
+        return self.__trace[self.__index][3]
+
+
+def load_trace(paths):
+    """
+    Reads the samples recorded for a device
+
+    :param paths: (list) The segments of the device, as returned by pistatsrecord.list_segments()
+    :return: (list) The (cpu, cpu states, cores, net) tuple of every recorded sample
+    """
+    # Imported here so that the synthetic fleet doesn't need the recording code
+    from pistatsrecord import SegmentReader
+
+    trace = []
+    for path in paths:
+        reader = SegmentReader(path)
+        try:
+            columns = dict((name, reader.column(name)) for name in reader.columns[1:])
+        finally:
+            reader.close()
+        cores = sorted((int(name[4:]), name) for name in columns if name.startswith("core"))
+        ifaces = dict()
+        for name in columns:
+            if "." in name and not name.startswith("state."):
+                iface, counter = name.rsplit(".", 1)
+                ifaces.setdefault(iface, []).append(counter)
+        for row in range(len(columns["cpu"])):
+            states = [columns["state." + state][row] if "state." + state in columns else 0.0 for state in CPU_STATES]
+            net = dict((iface, dict((counter, columns[iface + "." + counter][row]) for counter in counters))
+                       for iface, counters in ifaces.items())
+            for counters in net.values():
+                counters["rx"] = int(counters.get("rx", 0))
+                counters["tx"] = int(counters.get("tx", 0))
+            trace.append((columns["cpu"][row], states, [columns[name][row] for index, name in cores], net))
+    return trace
+
+
+class StandInProperties(object):
+    """
+    The properties of a message published on a StandInChannel, standing in
+    for pika.BasicProperties
+    """
+
+    def __init__(self, content_type=None, headers=None):
+        """
+        Create a new StandInProperties object
+
+        :param content_type: (str) The content type of the message, None for JSON
+        :param headers: (dict) The headers of the message, None for none
+        :return: None
+        """
+        self.content_type = content_type
+        self.headers = headers
+
+
+class StandInChannel(object):
+    """
+    Stands in for a broker channel, queueing the published messages for the
+    in-process consumer
+    """
+
+    # The publishers build the properties of their messages with this rather than with pika
+    basic_properties = StandInProperties
+
+    def __init__(self):
+        """
+        Create a new, empty StandInChannel object
+
+        :return: None
+        """
+        self.msgs = deque()
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.msgs.append((routing_key, body, properties))
+        return True
+
+
+class StandInConsumer(object):
+    """
+    Decodes and aggregates the messages of a StandInChannel the way
+    pistatsview.py does, inline or on a pistatspipeline.py worker pool
+    """
+
+    def __init__(self, channel, workers):
+        """
+        Create a new StandInConsumer object
+
+        :param channel: (StandInChannel) The channel the devices publish on
+        :param workers: (int) The number of worker processes, 0 to handle the messages inline
+        :return: None
+        """
+        # Imported here so that publishing to a broker doesn't need the viewer code
+        from pistatspipeline import ShardedPipeline
+        from pistatsstore import StatsStore, handle_msg
+        from pistatswindow import WINDOWS
+
+        self.__channel = channel
+        self.metrics = Metrics("pistatsview")
+        self.__handle_msg = handle_msg
+        self.__decoder = StatsDecoder()
+        self.store = StatsStore(WINDOWS)
+        self.pipeline = ShardedPipeline(workers, spans=WINDOWS, metrics=self.metrics) if workers > 0 else None
+        # The number of seconds spent consuming, and waiting for the workers once the fleet stopped
+        self.busy = 0.0
+        self.drain = 0.0
+
+    def consume(self):
+        """
+        Handles every message queued so far
+
+        :return: None
+        """
+        start = monotonic()
+        msgs = self.__channel.msgs
+        metrics = self.metrics
+        while msgs:
+            routing_key, body, properties = msgs.popleft()
+            metrics.count("messages_total")
+            sampled = properties.headers and properties.headers.get(SAMPLED_HEADER)
+            if self.pipeline is not None:
+                self.pipeline.submit(routing_key, properties.content_type, body)
+            else:
+                self.__handle_msg(self.__decoder, self.store, routing_key, properties.content_type, body, metrics)
+            if sampled:
+                metrics.observe("end_to_end_seconds", max(0.0, time.time() - float(sampled)))
+        if self.pipeline is not None:
+            self.pipeline.flush()
+            for device in self.pipeline.collect():
+                self.store.merge(device)
+        self.busy += monotonic() - start
+
+    def close(self):
+        """
+        Waits for the workers to handle the messages they were handed
+
+        :return: None
+        """
+        if self.pipeline is not None:
+            start = monotonic()
+            for device in self.pipeline.close():
+                self.store.merge(device)
+            self.drain = monotonic() - start
+
+
+def parse_range(text, convert):
+    """
+    Parses a value, or a range of values the devices pick from at random
+
+    :param text: (str) The value, such as '2', or the range, such as '1:4'
+    :param convert: (callable) Converts each bound, such as int or float
+    :raises ValueError: if the bounds are not well formed
+    :return: (tuple) The low and high bounds
+    """
+    low, separator, high = text.partition(":")
+    low = convert(low)
+    high = convert(high) if separator else low
+    if low > high:
+        raise ValueError("Empty range: " + text)
+    return low, high
+
+
+def run_fleet(options, first, count, results):
+    """
+    Runs virtual devices until the duration elapsed, and reports their counters
+
+    :param options: (dict) The options of the load generator
+    :param first: (int) The index of the first device run by this process
+    :param count: (int) The number of devices run by this process
+    :param results: (multiprocessing.Queue) Receives the counters once done, None to return them
+    :return: (dict) The counters and percentiles, if results is None
+    """
+    rng = random.Random(options["seed"] + first)
+    metrics = Metrics("pistatsload")
+
+    connection = None
+    consumer = None
+    if options["broker"] is not None:
+        import pika
+        credentials = pika.PlainCredentials(*options["credentials"]) if options["credentials"] else None
+        connection = pika.BlockingConnection(pika.ConnectionParameters(
+            options["broker"], virtual_host=options["vhost"], credentials=credentials))
+        channel = connection.channel()
+        channel.exchange_declare(exchange=options["exchange"], type=options["exchange_type"])
+    else:
+        channel = StandInChannel()
+        consumer = StandInConsumer(channel, options["workers"])
+
+    # The samplers, publisher and period of every device, and the time each one samples next
+    traces = options["traces"]
+    devices = []
+    due = []
+    now = 0.0 if options["fast"] else monotonic()
+    for index in range(first, first + count):
+        if traces:
+            sampler = TraceSampler(traces[index % len(traces)], rng.randint(0, 1 << 30))
+            cpu_sampler = net_sampler = sampler
+        else:
+            cpu_sampler = SyntheticCpuSampler(rng.randint(*options["cores"]), rng)
+            net_sampler = SyntheticNetSampler(rng.randint(*options["ifaces"]), rng)
+        routing_key = "%s.rack%d.pi%d" %(options["prefix"], index / RACK_DEVICES, index)
+        publisher = BatchPublisher(channel, options["exchange"], routing_key, StatsEncoder(options["format"]),
+                                   options["batch"], metrics=metrics)
+        period = 1.0 / rng.uniform(*options["rate"])
+        devices.append((cpu_sampler, net_sampler, publisher, period))
+        # Spread the first samples over a period, as a fleet that was started at different times
+        due.append((now + rng.uniform(0, period), len(devices) - 1))
+    heapq.heapify(due)
+
+    end = now + options["duration"]
+    while due and due[0][0] < end:
+        due_time, device = heapq.heappop(due)
+        if options["fast"]:
+            now = due_time
+        else:
+            now = monotonic()
+            if due_time > now:
+                time.sleep(due_time - now)
+                now = monotonic()
+            metrics.observe("lag_seconds", now - due_time)
+
+        cpu_sampler, net_sampler, publisher, period = devices[device]
+        cpu_sampler.sample()
+        if net_sampler is not cpu_sampler:
+            net_sampler.sample()
+        publisher.add(build_utilization_msg(cpu_sampler, net_sampler, period), now)
+        metrics.count("samples_total")
+        heapq.heappush(due, (due_time + period, device))
+
+        # Hand the messages over to the stand-in consumer as they are published
+        if consumer is not None and len(channel.msgs) >= options["consume_every"]:
+            consumer.consume()
+
+    for cpu_sampler, net_sampler, publisher, period in devices:
+        publisher.flush()
+    if consumer is not None:
+        consumer.consume()
+        consumer.close()
+    if connection is not None:
+        connection.close()
+
+    # The viewer's summaries are named apart from the generator's, decode and aggregate against encode and publish
+    summaries = dict(metrics.summaries)
+    result = {"counters": dict(metrics.counters), "handled": 0, "busy": 0.0, "drain": 0.0}
+    if consumer is not None:
+        summaries.update(consumer.metrics.summaries)
+        result.update(handled=consumer.metrics.counters.get("messages_total", 0), busy=consumer.busy,
+                      drain=consumer.drain)
+    result["quantiles"] = dict((name, [merged_quantile([summary.sketch], p) for p in METRIC_QUANTILES])
+                               for name, summary in summaries.items())
+    if results is None:
+        return result
+    results.put(result)
+
+
+def _fleet_main(options, first, count, results):
+    # Interrupts are handled by the parent process, which stops the children
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run_fleet(options, first, count, results)
+
+
+def main(argv):
+    """
+    Runs the fleet for the given duration and reports how it performed
+
+    :param argv: (list) The command line arguments, the program name first
+    :return: None
+    """
+    # Guard try clause to catch any errors that aren't expected
+    try:
+        options = {
+            # The message broker, None to publish to the in-process stand-in
+            "broker": None,
+            "vhost": "/",
+            # The user name and password, None for the default ones
+            "credentials": None,
+            "exchange_type": "direct",
+            "exchange": None,
+            # The number of devices, the processes they are spread over, and the stand-in workers
+            "devices": 1000,
+            "processes": 1,
+            "workers": 0,
+            # The samples per second, cores and interfaces of each device, picked in the given ranges
+            "rate": (1.0, 1.0),
+            "cores": (4, 4),
+            "ifaces": (3, 3),
+            # The messages of each device
+            "format": "struct",
+            "batch": 1,
+            "prefix": "loadgen",
+            # The recorded samples replayed instead of the synthetic ones
+            "traces": None,
+            # How long the fleet runs, and whether it runs as fast as possible instead of in real time
+            "duration": 10.0,
+            "fast": False,
+            "seed": 0,
+            # The number of messages queued before the stand-in consumes them
+            "consume_every": 100,
+        }
+        trace_directory = None
+
+        usage = "Usage: %s [-b message_broker] [-p virtual_host] [-c username:password] [--exchange-type direct|topic] [--exchange name] [-n devices] [--processes count] [--workers count] [--rate samples_per_second[:max]] [--cores count[:max]] [--ifaces count[:max]] [--format json|compact|struct] [--batch samples] [-k routing_key_prefix] [--trace directory] [--duration duration] [--fast] [--seed seed]" %(argv[0])
+
+        # Parse the command line arguments
+        i = 1
+        try:
+            while i < len(argv):
+                option = argv[i]
+                if option == "--fast":
+                    options["fast"] = True
+                    i += 1
+                    continue
+                value = argv[i + 1]
+                if option == "-b":
+                    options["broker"] = value
+                elif option == "-p":
+                    options["vhost"] = value
+                elif option == "-c":
+                    username, separator, password = value.partition(":")
+                    options["credentials"] = (username, password)
+                elif option == "--exchange-type":
+                    if value not in EXCHANGE_TYPES:
+                        raise ValueError("Unknown exchange type: " + value)
+                    options["exchange_type"] = value
+                elif option == "--exchange":
+                    options["exchange"] = value
+                elif option == "-n":
+                    options["devices"] = int(value)
+                elif option == "--processes":
+                    options["processes"] = int(value)
+                elif option == "--workers":
+                    options["workers"] = int(value)
+                elif option == "--rate":
+                    options["rate"] = parse_range(value, float)
+                elif option == "--cores":
+                    options["cores"] = parse_range(value, int)
+                elif option == "--ifaces":
+                    options["ifaces"] = parse_range(value, int)
+                elif option == "--format":
+                    if value not in FORMATS:
+                        raise ValueError("Unknown format: " + value)
+                    options["format"] = value
+                elif option == "--batch":
+                    options["batch"] = int(value)
+                elif option == "-k":
+                    options["prefix"] = value
+                elif option == "--trace":
+                    trace_directory = value
+                elif option == "--duration":
+                    options["duration"] = parse_duration(value)
+                elif option == "--seed":
+                    options["seed"] = int(value)
+                else:
+                    raise ValueError("Unknown option: " + option)
+                i += 2
+        except (IndexError, ValueError), ve:
+            print >> sys.stderr, usage
+            print >> sys.stderr, "Please enter proper options, now quitting! " + str(ve)
+            sys.exit(-1)
+
+        if (options["devices"] < 1 or options["processes"] < 1 or options["workers"] < 0 or options["batch"] < 1
+                or options["rate"][0] <= 0 or options["cores"][0] < 1 or options["ifaces"][0] < 0):
+            print >> sys.stderr, usage
+            print >> sys.stderr, "Error: The counts and rates must be positive"
+            sys.exit(-1)
+        if options["broker"] is None and options["processes"] > 1:
+            print >> sys.stderr, "Error: The in-process stand-in broker only runs in a single process, use --workers"
+            sys.exit(-1)
+        if options["exchange"] is None:
+            options["exchange"] = EXCHANGE_NAMES[options["exchange_type"]]
+
+        if trace_directory is not None:
+            from pistatsrecord import list_segments
+            options["traces"] = [load_trace(paths) for routing_key, paths in sorted(list_segments(trace_directory).items())]
+            options["traces"] = [trace for trace in options["traces"] if trace]
+            if not options["traces"]:
+                print >> sys.stderr, "Error: No samples were recorded in " + trace_directory
+                sys.exit(-1)
+            print "Replaying the samples of %d recorded device(s)" %(len(options["traces"]))
+
+        print "Running %d device(s) over %d process(es) for %gs%s, publishing to %s" %(
+            options["devices"], options["processes"], options["duration"], " as fast as possible" if options["fast"] else "",
+            options["broker"] or "the in-process stand-in broker")
+
+        # Spread the devices over the processes, the first one running in this process
+        start = time.time()
+        share = options["devices"] / options["processes"]
+        ranges = [(p * share, share + (options["devices"] % options["processes"] if p == options["processes"] - 1 else 0))
+                  for p in range(options["processes"])]
+        results = multiprocessing.Queue()
+        children = [multiprocessing.Process(target=_fleet_main, args=(options, first, count, results))
+                    for first, count in ranges[1:]]
+        for child in children:
+            child.start()
+        try:
+            fleet = [run_fleet(options, ranges[0][0], ranges[0][1], None)]
+            fleet.extend(results.get() for child in children)
+        except KeyboardInterrupt:
+            # The children ignore interrupts, stop them along with this process
+            for child in children:
+                child.terminate()
+            raise
+        for child in children:
+            child.join()
+        elapsed = time.time() - start
+
+        # Report the counters of the whole fleet, and the percentiles of the slowest process
+        counters = dict()
+        for result in fleet:
+            for name, value in result["counters"].items():
+                counters[name] = counters.get(name, 0) + value
+        seconds = options["duration"] if not options["fast"] else elapsed
+        print "Published %d sample(s) in %d message(s), %d byte(s), in %.1fs" %(
+            counters.get("samples_total", 0), counters.get("messages_total", 0), counters.get("bytes_total", 0), elapsed)
+        print "%.0f sample(s)/s, %.0f message(s)/s over %gs" %(
+            counters.get("samples_total", 0) / seconds, counters.get("messages_total", 0) / seconds, seconds)
+        if options["broker"] is None:
+            handled = sum(result["handled"] for result in fleet)
+            busy = sum(result["busy"] for result in fleet)
+            if options["workers"] > 0:
+                # The workers decode and aggregate in other processes, only their backlog tells whether they kept up
+                print "Handed %d message(s) over to %d worker(s) in %.2fs, they were done %.2fs after the fleet stopped" %(
+                    handled, options["workers"], busy, sum(result["drain"] for result in fleet))
+            else:
+                print "The stand-in viewer handled %d message(s) in %.2fs, %.0f message(s)/s at most" %(
+                    handled, busy, handled / busy if busy else 0.0)
+        names = sorted(set(name for result in fleet for name in result["quantiles"]))
+        for name in names:
+            worst = [max(result["quantiles"][name][q] for result in fleet if name in result["quantiles"])
+                     for q in range(len(METRIC_QUANTILES))]
+            print "%-30s %s" %(name.replace("_seconds", " (ms)"),
+                               "  ".join("p%d %8.3f" %(p * 100, value * 1000) for p, value in zip(METRIC_QUANTILES, worst)))
+
+    except KeyboardInterrupt:
+        print >> sys.stderr, "Interrupted, now quitting!"
+        sys.exit(-1)
+
+
+# Application Entry Point
+# ^^^^^^^^^^^^^^^^^^^^^^^
+if __name__ == "__main__":
+    main(sys.argv)
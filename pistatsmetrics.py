@@ -0,0 +1,249 @@
+"""
+This file contains the metrics pistatsd.py and pistatsview.py keep about
+themselves, such as the number of messages handled and the time spent
+encoding, decoding and aggregating them, and the ways to report them: a stats
+line printed periodically, or a local HTTP endpoint serving them in the
+Prometheus text format
+
+Counters only count up, and gauges hold the last value they were set to, such
+as the length of a queue. Summaries count timings or latencies, in seconds, in
+QuantileSketch objects, so that their percentiles are estimated in a fixed
+amount of memory, both since the start and since the last stats line.
+"""
+
+from pistatscommon import monotonic
+from pistatswindow import QuantileSketch, merged_quantile
+
+# The percentiles displayed for every summary
+METRIC_QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Summary(object):
+    """
+    Counts observed values and estimates their percentiles
+    """
+
+    __slots__ = ("count", "total", "sketch", "recent")
+
+    def __init__(self):
+        """
+        Create a new, empty Summary object
+
+        :return: None
+        """
+        self.count = 0
+        self.total = 0.0
+        # The values since the start, and since the last stats line
+        self.sketch = QuantileSketch()
+        self.recent = QuantileSketch()
+
+    def observe(self, value):
+        """
+        :param value: (float) The observed value, such as a number of seconds
+        :return: None
+        """
+        self.count += 1
+        self.total += value
+        self.sketch.add(value)
+        self.recent.add(value)
+
+    def merge(self, other):
+        """
+        Counts the values observed by another summary as well
+
+        :param other: (Summary) The summary, left unchanged
+        :return: None
+        """
+        self.count += other.count
+        self.total += other.total
+        self.sketch.merge(other.sketch)
+        self.recent.merge(other.recent)
+
+
+class Metrics(object):
+    """
+    Holds the counters, gauges and summaries of a program, under a common prefix
+    """
+
+    def __init__(self, prefix):
+        """
+        Create a new Metrics object
+
+        :param prefix: (str) The prefix of every metric name, such as 'pistatsd'
+        :return: None
+        """
+        self.prefix = prefix
+        self.counters = dict()
+        self.gauges = dict()
+        self.summaries = dict()
+        # The counter values at the last stats line, to compute their rates
+        self.__last_counters = dict()
+        self.__last_time = monotonic()
+
+    def count(self, name, value=1):
+        """
+        Adds to a counter, creating it on first use
+
+        :param name: (str) The name of the counter, such as 'messages_total'
+        :param value: (int) The amount added
+        :return: None
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        """
+        Sets a gauge, creating it on first use
+
+        :param name: (str) The name of the gauge, such as 'spool_samples'
+        :param value: (float) The current value
+        :return: None
+        """
+        self.gauges[name] = value
+
+    def observe(self, name, value):
+        """
+        Adds a value to a summary, creating it on first use
+
+        :param name: (str) The name of the summary, such as 'encode_seconds'
+        :param value: (float) The observed value
+        :return: None
+        """
+        summary = self.summaries.get(name)
+        if summary is None:
+            summary = self.summaries[name] = Summary()
+        summary.observe(value)
+
+    def merge(self, other):
+        """
+        Adds the counters and summaries of another Metrics object, such as the
+        ones measured by a worker process, and takes its gauges
+
+        :param other: (Metrics) The metrics, left unchanged
+        :return: None
+        """
+        for name, value in other.counters.iteritems():
+            self.count(name, value)
+        self.gauges.update(other.gauges)
+        for name, summary in other.summaries.iteritems():
+            merged = self.summaries.get(name)
+            if merged is None:
+                merged = self.summaries[name] = Summary()
+            merged.merge(summary)
+
+    def stats_line(self, now):
+        """
+        Returns the rate of every counter, the value of every gauge and the
+        percentiles of every summary since the last stats line, and starts a
+        new interval
+
+        :param now: (float) The monotonic time
+        :return: (str) The stats line, such as
+                 'messages/s=100.0 encode_ms=p50:0.012,p95:0.020,p99:0.031'
+        """
+        elapsed = now - self.__last_time
+        self.__last_time = now
+
+        fields = []
+        for name in sorted(self.counters):
+            value = self.counters[name]
+            if elapsed > 0:
+                rate = (value - self.__last_counters.get(name, 0)) / elapsed
+                fields.append("%s/s=%.1f" %(name.replace("_total", ""), rate))
+            self.__last_counters[name] = value
+        for name in sorted(self.gauges):
+            fields.append("%s=%g" %(name, self.gauges[name]))
+        for name in sorted(self.summaries):
+            sketch = self.summaries[name].recent
+            if sketch.count:
+                fields.append("%s=%s" %(name.replace("_seconds", "_ms"), ",".join(
+                    "p%d:%.3f" %(p * 100, merged_quantile([sketch], p) * 1000) for p in METRIC_QUANTILES)))
+                sketch.clear()
+        return " ".join(fields)
+
+    def prometheus_text(self):
+        """
+        Returns every metric since the start in the Prometheus text format
+
+        :return: (str) The metrics, counters, gauges then summaries
+        """
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            full_name = self.prefix + "_" + name
+            lines.append("# TYPE %s counter" %(full_name))
+            lines.append("%s %d" %(full_name, value))
+        for name, value in sorted(self.gauges.items()):
+            full_name = self.prefix + "_" + name
+            lines.append("# TYPE %s gauge" %(full_name))
+            lines.append("%s %g" %(full_name, value))
+        for name, summary in sorted(self.summaries.items()):
+            full_name = self.prefix + "_" + name
+            lines.append("# TYPE %s summary" %(full_name))
+            for p in METRIC_QUANTILES:
+                lines.append('%s{quantile="%g"} %.9f' %(full_name, p, merged_quantile([summary.sketch], p)))
+            lines.append("%s_sum %.9f" %(full_name, summary.total))
+            lines.append("%s_count %d" %(full_name, summary.count))
+        return "\n".join(lines) + "\n"
+
+
+def _metrics_handler(BaseHTTPServer):
+    # Returns the handler serving the metrics of the server's Metrics object on any path. It is only defined
+    # once a server is started, so that the programs that don't serve the metrics don't load BaseHTTPServer
+
+    class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            # The metrics are updated by the main thread meanwhile, retry if a summary grew while it was read
+            for attempt in range(3):
+                try:
+                    body = self.server.metrics.prometheus_text()
+                    break
+                except RuntimeError:
+                    continue
+            else:
+                self.send_error(503)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return _MetricsHandler
+
+
+class MetricsServer(object):
+    """
+    Serves metrics in the Prometheus text format on a local port, from a
+    background thread
+    """
+
+    def __init__(self, metrics, port, address="127.0.0.1"):
+        """
+        Create a new MetricsServer object and start serving
+
+        :param metrics: (Metrics) The metrics to serve
+        :param port: (int) The port to listen on
+        :param address: (str) The address to listen on, local only by default
+        :raises socket.error: if the port couldn't be bound
+        :return: None
+        """
+        import BaseHTTPServer
+        import threading
+
+        self.__server = BaseHTTPServer.HTTPServer((address, port), _metrics_handler(BaseHTTPServer))
+        self.__server.metrics = metrics
+        self.__thread = threading.Thread(target=self.__server.serve_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def close(self):
+        """
+        Stops serving
+
+        :return: None
+        """
+        self.__server.shutdown()
+        self.__server.server_close()
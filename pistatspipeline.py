@@ -0,0 +1,295 @@
+"""
+This file contains the decode and aggregation pipeline used by pistatsview.py
+to spread the work of many devices over several worker processes
+
+The consumer only hands the raw messages over. Each message is routed to the
+worker owning its routing key, so the samples of a device are always decoded
+and aggregated in order, by the same worker. The workers send the devices
+they updated back, and the consumer merges them into the displayed stats. The
+rolling windows are only kept by the consumer: the workers log the values
+each sample adds to them, so that a device is sent back as a few arrays
+whatever the windows hold. Along with the devices, each worker reports the
+last message it handled, so that the consumer only acknowledges the messages
+whose results it merged. Worker processes are used rather than threads, since the decoding and
+aggregation is pure Python and would be serialized by the GIL.
+"""
+
+import cPickle
+import multiprocessing
+import signal
+import sys
+import Queue
+from collections import deque
+
+from pistatscodec import StatsDecoder
+from pistatscommon import monotonic
+from pistatsmetrics import Metrics
+from pistatsrecord import SegmentRecorder
+from pistatsstore import StatsStore, handle_msg
+
+# Number of messages handed over to a worker at once
+BATCH_SIZE = 64
+
+# Number of batches that may wait for each worker before submit() blocks
+QUEUE_BATCHES = 16
+
+# Number of seconds a busy worker collects updated devices before sending
+# them back, so that a device updated by several batches is only sent once
+RESULT_INTERVAL = 0.1
+
+# Number of seconds the consumer waits on a worker before checking that it
+# is still alive
+WORKER_TIMEOUT = 1.0
+
+
+def _worker_main(shard, messages, results, spans, record_directory, timed):
+    # Interrupts are handled by the consumer, which closes the pipeline
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    decoder = StatsDecoder()
+    # Each worker records the devices it owns
+    recorder = SegmentRecorder(record_directory) if record_directory is not None else None
+    # The windows are kept by the consumer, the devices only log the values added to them
+    store = StatsStore(spans, recorder, log_windows=True)
+    metrics = Metrics("pistatsview") if timed else None
+    updated = dict()
+    # The sequence number of the last message handled since the last results were sent, and the number of
+    # messages that failed meanwhile
+    handled = None
+    failed = 0
+    last_sent = monotonic()
+    while True:
+        item = messages.get()
+        if item is None:
+            break
+
+        last_seq, batch = item
+        for routing_key, content_type, msg in batch:
+            # A message that breaks the aggregation must not stop the worker, and the devices it owns
+            try:
+                device = handle_msg(decoder, store, routing_key, content_type, msg, metrics)
+            except Exception, error:
+                print >> sys.stderr, "Warning: Discarding a message of %s that couldn't be handled: %r" %(routing_key, error)
+                failed += 1
+                continue
+            if device is not None:
+                updated[routing_key] = device
+        handled = last_seq
+
+        # Send the results once idle, or once in a while when busy
+        if messages.empty() or monotonic() - last_sent >= RESULT_INTERVAL:
+            # Pickle the devices right away, the queue would only pickle
+            # them later on, while the next batch may be updating them
+            results.put(cPickle.dumps((shard, handled, updated.values(), metrics, failed), cPickle.HIGHEST_PROTOCOL))
+            for device in updated.itervalues():
+                del device.window_log[:]
+            updated = dict()
+            handled = None
+            failed = 0
+            metrics = Metrics("pistatsview") if timed else None
+            last_sent = monotonic()
+
+    if handled is not None:
+        results.put(cPickle.dumps((shard, handled, updated.values(), metrics, failed), cPickle.HIGHEST_PROTOCOL))
+    if recorder is not None:
+        recorder.close()
+
+    # Tell the consumer that this worker won't send anything else
+    results.put(shard)
+
+
+class ShardedPipeline(object):
+    """
+    Decodes and aggregates messages on a pool of worker processes, sharded
+    by routing key
+    """
+
+    def __init__(self, workers, batch_size=BATCH_SIZE, spans=(), record_directory=None, metrics=None,
+                 flush_every=None):
+        """
+        Create a new ShardedPipeline object and start its workers
+
+        :param workers: (int) The number of worker processes
+        :param batch_size: (int) The number of messages handed over to a
+                           worker at once
+        :param spans: (tuple) The rolling windows kept for each metric, as
+                      (label, seconds) pairs. The workers only log the values
+                      added to them, for the consumer's store to merge
+        :param record_directory: (str) The directory the workers record the
+                                 samples in, None to record nothing
+        :param metrics: (pistatsmetrics.Metrics) Receives the time the workers
+                        spent decoding and aggregating, None to time nothing
+        :param flush_every: (int) The number of messages waiting in partially
+                            filled batches that makes submit() hand them all
+                            over, None to wait for flush(). Messages that are
+                            only acknowledged once handled must not wait long,
+                            since the broker stops sending once prefetch of
+                            them are unacknowledged
+        :raises ValueError: if workers or batch_size is lower than one
+        :return: None
+        """
+        if workers < 1:
+            raise ValueError("The pipeline needs at least one worker")
+        if batch_size < 1:
+            raise ValueError("The batch size must be at least one message")
+
+        self.workers = workers
+        self.__batch_size = batch_size
+        self.__flush_every = flush_every
+        self.__metrics = metrics
+        self.__batches = [[] for i in range(workers)]
+        self.__waiting = 0
+        # The sequence number of the last message in the batch of each worker, and of the last message each
+        # worker handled, and the (sequence number, worker, tag) of the messages not handled yet
+        self.__last_seqs = [0] * workers
+        self.__handled_seqs = [0] * workers
+        self.__tags = deque()
+        # One bounded queue per worker, so that a busy worker makes submit()
+        # block instead of growing the queue
+        self.__queues = [multiprocessing.Queue(QUEUE_BATCHES) for i in range(workers)]
+        self.__results = multiprocessing.Queue()
+        self.__processes = []
+        for i in range(workers):
+            process = multiprocessing.Process(target=_worker_main, args=(i, self.__queues[i], self.__results, spans,
+                                                                         record_directory, metrics is not None))
+            process.daemon = True
+            process.start()
+            self.__processes.append(process)
+        # The workers that didn't tell they were done yet, and the ones that exited without telling
+        self.__running = set(range(workers))
+        self.__dead = set()
+
+        # Counters reported when the pipeline is closed
+        self.submitted_msgs = 0
+        self.merged_devices = 0
+        self.failed_msgs = 0
+
+    def submit(self, routing_key, content_type, msg, tag=None):
+        """
+        Queues a message for the worker owning its routing key
+
+        :param routing_key: (str) The routing key the message was published with
+        :param content_type: (str) The content type of the message, None for JSON
+        :param msg: (str) The message body
+        :param tag: (object) Returned by handled() once the worker handled the
+                    message, such as what acknowledges it. None to not track it
+        :raises RuntimeError: if the worker owning the routing key exited
+        :return: None
+        """
+        shard = hash(routing_key) % self.workers
+        batch = self.__batches[shard]
+        batch.append((routing_key, content_type, msg))
+        self.submitted_msgs += 1
+        self.__last_seqs[shard] = self.submitted_msgs
+        if tag is not None:
+            self.__tags.append((self.submitted_msgs, shard, tag))
+        self.__waiting += 1
+        if len(batch) >= self.__batch_size:
+            self.__hand_over(shard)
+        if self.__flush_every is not None and self.__waiting >= self.__flush_every:
+            self.flush()
+
+    def flush(self):
+        """
+        Hands the partially filled batches over to their workers
+
+        :raises RuntimeError: if a worker given messages exited
+        :return: None
+        """
+        for shard in range(self.workers):
+            if self.__batches[shard]:
+                self.__hand_over(shard)
+
+    def collect(self, block=False):
+        """
+        Returns the devices the workers updated since the last call
+
+        :param block: (bool) Whether to wait until every worker has exited. The
+                      workers that exited unexpectedly are reported and no
+                      longer waited for
+        :return: (list) The updated pistatsstore.DeviceStats, oldest first
+        """
+        devices = []
+        while self.__running:
+            try:
+                result = self.__results.get(block, WORKER_TIMEOUT)
+            except Queue.Empty:
+                self.__check_workers()
+                if block:
+                    continue
+                break
+            if isinstance(result, int):
+                self.__running.discard(result)
+                continue
+            shard, handled, updated, metrics, failed = cPickle.loads(result)
+            self.__handled_seqs[shard] = handled
+            self.failed_msgs += failed
+            devices.extend(updated)
+            if metrics is not None and self.__metrics is not None:
+                self.__metrics.merge(metrics)
+        self.merged_devices += len(devices)
+        return devices
+
+    def handled(self):
+        """
+        Returns the tags of the messages the workers handled, once their
+        results were returned by collect() or close()
+
+        :return: (list) The tags given to submit(), in the order the messages were submitted
+        """
+        tags = []
+        pending = self.__tags
+        while pending and pending[0][0] <= self.__handled_seqs[pending[0][1]]:
+            tags.append(pending.popleft()[2])
+        return tags
+
+    def close(self):
+        """
+        Hands the remaining messages over, stops the workers once they are
+        done and returns the devices they updated meanwhile
+
+        :return: (list) The updated pistatsstore.DeviceStats, oldest first
+        """
+        for shard in range(self.workers):
+            # The messages of a worker that exited are lost
+            try:
+                if self.__batches[shard]:
+                    self.__hand_over(shard)
+                self.__put(shard, None)
+            except RuntimeError:
+                pass
+        # The results must be read before joining, or a worker could wait
+        # forever for its results to be sent
+        devices = self.collect(block=True)
+        for process in self.__processes:
+            process.join()
+        return devices
+
+    def __hand_over(self, shard):
+        batch = self.__batches[shard]
+        self.__batches[shard] = []
+        self.__waiting -= len(batch)
+        self.__put(shard, (self.__last_seqs[shard], batch))
+
+    def __put(self, shard, item):
+        # Wait for room in the queue of a worker, as long as the worker is alive
+        while True:
+            if shard in self.__dead:
+                raise RuntimeError("Pipeline worker %d exited unexpectedly" %(shard))
+            try:
+                self.__queues[shard].put(item, True, WORKER_TIMEOUT)
+                return
+            except Queue.Full:
+                self.__check_workers()
+
+    def __check_workers(self):
+        for shard in list(self.__running):
+            process = self.__processes[shard]
+            if not process.is_alive():
+                print >> sys.stderr, "Warning: Pipeline worker %d exited unexpectedly with code %s, the messages it " \
+                    "was handed are lost" %(shard, process.exitcode)
+                self.__running.discard(shard)
+                self.__dead.add(shard)
+                # Nobody reads the queue anymore, don't wait for it to be flushed on exit
+                self.__queues[shard].cancel_join_thread()
@@ -0,0 +1,378 @@
+"""
+This file contains the samplers used by pistatsd.py to read the cpu and
+network interface statistics from /proc
+
+Each sampler keeps its /proc file open and rereads it from the start into a
+reusable buffer on every tick. Only the lines holding the needed columns are
+copied out of the buffer, as a single string split once per tick, and the
+needed fields are picked out of them all at once and converted straight into
+preallocated numeric arrays. Splitting the buffer itself would allocate a
+bytearray per field, which costs more than the copy. Every sampler holds two sets of arrays,
+'current' and 'previous', which are swapped on each tick so that the deltas
+between two samples can be computed without allocating new containers.
+"""
+
+import io
+import operator
+from array import array
+from itertools import izip
+
+from pistatscommon import CPU_STATES, NET_COUNTERS
+
+# Initial size of the buffer a /proc file is read into, grown as needed
+BUFFER_SIZE = 4096
+
+# Number of cpu state columns parsed from each cpu row of /proc/stat and the
+# columns counted as idle
+STATE_FIELDS = len(CPU_STATES)
+STATE_IDLE = CPU_STATES.index("idle")
+STATE_IOWAIT = CPU_STATES.index("iowait")
+
+# Number of whitespace separated fields per interface in /proc/net/dev, once
+# the ':' following the interface name is blanked out
+NET_DEV_FIELDS = len(NET_COUNTERS) + 1
+
+
+class ProcFile(object):
+    """
+    A /proc file that is kept open and reread into a reusable buffer
+    """
+
+    def __init__(self, path, size=BUFFER_SIZE):
+        """
+        Create a new ProcFile object
+
+        :param path: (str) The path of the file to read
+        :param size: (int) The initial size of the buffer
+        :raises IOError: if the file couldn't be opened
+        :return: None
+        """
+        self.path = path
+        self.__file = io.FileIO(path, "r")
+        self.__buffer = bytearray(size)
+
+    def read(self):
+        """
+        Rereads the whole file into the buffer, without copying it
+
+        :return: (tuple) The buffer and the length of the file content at its
+                 start. The buffer is reused, its content is only valid until
+                 the next call to read()
+        """
+        while True:
+            self.__file.seek(0)
+            length = self.__file.readinto(self.__buffer)
+
+            # A full buffer may have truncated the file, grow it and retry
+            if length < len(self.__buffer):
+                return self.__buffer, length
+            self.__buffer = bytearray(2 * len(self.__buffer))
+
+    def close(self):
+        """
+        Closes the file
+
+        :return: None
+        """
+        self.__file.close()
+
+
+class CpuStatSampler(object):
+    """
+    Samples the time spent in each cpu state, for all cpus together and for
+    each core, from /proc/stat
+    """
+
+    def __init__(self, path="/proc/stat"):
+        """
+        Create a new CpuStatSampler object
+
+        :param path: (str) The path of the kernel statistics file
+        :raises IOError: if the file couldn't be opened
+        :return: None
+        """
+        self.__file = ProcFile(path)
+        # The number of cpu rows and of fields per row last read, and the
+        # function picking the state fields out of them
+        self.__shape = None
+        self.__state_fields = None
+        # The number of cores, excluding the aggregated 'cpu' row, and
+        # whether they changed during the last sample
+        self.cores = 0
+        self.cores_changed = True
+        # One row of len(CPU_STATES) times per cpu, the aggregated row first,
+        # in clock ticks
+        self.current = array("d")
+        self.previous = array("d")
+
+    def sample(self):
+        """
+        Reads the cpu state times into 'current', after moving the values of
+        the last sample to 'previous'
+
+        :return: None
+        """
+        self.previous, self.current = self.current, self.previous
+
+        # The cpu rows come first, only split them and leave the rest of the
+        # file, such as the interrupt counters, alone
+        data, length = self.__file.read()
+        if self.__shape is not None:
+            # The rows most likely kept their shape: split that many fields,
+            # and check that the last row and the next line start where the
+            # shape says they do
+            rows, width = self.__shape
+            count = rows * width
+            fields = str(buffer(data, 0, length)).split(None, count)
+            if (len(fields) > count and fields[count - width].startswith("cpu")
+                    and not fields[count].startswith("cpu")):
+                # Older kernels report fewer states, the missing ones read as this zero
+                fields[count] = "0"
+                current = self.current
+                del current[:]
+                current.fromlist(map(float, self.__state_fields(fields)))
+                self.cores_changed = False
+                return
+
+        rows = 0
+        end = 0
+        while end < length and data.startswith(b"cpu", end, length):
+            end = data.find(b"\n", end, length) + 1 or length
+            rows += 1
+        fields = str(buffer(data, 0, end)).split()
+        shape = (rows, len(fields) / rows if rows else 0)
+        fields.append("0")
+
+        if shape == self.__shape:
+            self.current[:] = array("d", map(float, self.__state_fields(fields)))
+            self.cores_changed = False
+            return
+
+        # The cores changed, or this is the first read: the fresh read
+        # becomes the previous sample of the cores, whose deltas would
+        # otherwise span the time since boot. The aggregated row is still
+        # comparable to the last sample
+        last = self.previous
+        self.__resize(shape)
+        self.current[:] = array("d", map(float, self.__state_fields(fields)))
+        self.previous[:] = self.current
+        if len(last) >= STATE_FIELDS:
+            self.previous[:STATE_FIELDS] = last[:STATE_FIELDS]
+        self.cores_changed = True
+
+    def utilization(self):
+        """
+        Computes the cpu utilization between the last two samples
+
+        :return: (tuple) The overall utilization, the share of time spent in
+                 each of CPU_STATES and the utilization of each core, as
+                 fractions between 0 and 1. The utilization of the cores is
+                 None if they changed during the last sample
+        """
+        # Compute the deltas of all rows in one pass
+        deltas = map(operator.sub, self.current, self.previous)
+
+        utilizations = []
+        states = None
+        for row in range(self.cores + 1):
+            offset = row * STATE_FIELDS
+            row_deltas = deltas[offset:offset + STATE_FIELDS]
+            total = sum(row_deltas)
+            if total <= 0:
+                # No tick elapsed since the last sample
+                utilizations.append(0.0)
+                if row == 0:
+                    states = [0.0] * STATE_FIELDS
+                continue
+
+            idle = row_deltas[STATE_IDLE] + row_deltas[STATE_IOWAIT]
+            utilizations.append(1 - idle / total)
+            if row == 0:
+                states = [delta / total for delta in row_deltas]
+
+        return utilizations[0], states, utilizations[1:] if not self.cores_changed else None
+
+    def __resize(self, shape):
+        # Pick the state columns of every row, in CPU_STATES order, skipping
+        # the cpu names
+        rows, width = shape
+        zero = rows * width
+        indexes = [row * width + 1 + state if state < width - 1 else zero
+                   for row in range(rows) for state in range(STATE_FIELDS)]
+        self.__state_fields = operator.itemgetter(*indexes) if indexes else lambda fields: ()
+
+        self.__shape = shape
+        self.cores = rows - 1
+        self.current = array("d", [0.0]) * len(indexes)
+        self.previous = array("d", [0.0]) * len(indexes)
+
+    def close(self):
+        """
+        Closes the kernel statistics file
+
+        :return: None
+        """
+        self.__file.close()
+
+
+class NetDevSampler(object):
+    """
+    Samples the counters of each network interface from /proc/net/dev
+    """
+
+    def __init__(self, path="/proc/net/dev", counters=NET_COUNTERS):
+        """
+        Create a new NetDevSampler object
+
+        :param path: (str) The path of the network device file
+        :param counters: (tuple) The NET_COUNTERS sampled, which must include
+                         the 'rx' and 'tx' bytes. Only their columns are parsed
+        :raises ValueError: if a counter is unknown, or 'rx' or 'tx' is missing
+        :raises IOError: if the file couldn't be opened
+        :return: None
+        """
+        unknown = [counter for counter in counters if counter not in NET_COUNTERS]
+        if unknown:
+            raise ValueError("Unknown interface counter(s): " + ", ".join(unknown))
+        if "rx" not in counters or "tx" not in counters:
+            raise ValueError("The 'rx' and 'tx' counters are always sampled")
+
+        self.__file = ProcFile(path)
+        # The counters sampled, in NET_COUNTERS order, and their column in
+        # each interface row
+        self.counters = tuple(counter for counter in NET_COUNTERS if counter in counters)
+        self.__columns = [NET_COUNTERS.index(counter) + 1 for counter in self.counters]
+        # The raw interface names, as read from the file, used to detect
+        # interfaces being added or removed, and the function picking the
+        # sampled counters out of the fields
+        self.__raw_ifaces = []
+        self.__counter_fields = lambda fields: ()
+        # Indexes of the interfaces that appeared during the last resize
+        self.__added = ()
+        # The interface names, in file order, indexing the arrays below
+        self.ifaces = []
+        # One row of values per interface, one per sampled counter
+        self.current = array("d")
+        self.previous = array("d")
+
+    def sample(self):
+        """
+        Reads the counters of every interface into 'current', after moving
+        the values of the last sample to 'previous'
+
+        :return: None
+        """
+        self.previous, self.current = self.current, self.previous
+
+        data, length = self.__file.read()
+        # Skip the two header lines and blank out the ':' after each name,
+        # which isn't followed by a space once the counters grow large
+        start = data.find(b"\n", data.find(b"\n", 0, length) + 1, length) + 1
+        fields = str(buffer(data, start, length - start)).replace(":", " ").split()
+
+        raw_ifaces = fields[0::NET_DEV_FIELDS]
+        if raw_ifaces != self.__raw_ifaces:
+            self.__resize(raw_ifaces)
+
+        current = self.current
+        del current[:]
+        current.fromlist(map(float, self.__counter_fields(fields)))
+
+        # Interfaces that just appeared have no previous sample, start them
+        # with a zero delta
+        width = len(self.counters)
+        for i in self.__added:
+            self.previous[i * width:(i + 1) * width] = current[i * width:(i + 1) * width]
+        self.__added = ()
+
+    def rates(self, period):
+        """
+        Computes the rate of every sampled counter between the last two samples
+
+        :param period: (float) The number of seconds between the samples
+        :return: (dict) The rates per second of each interface, keyed by
+                 interface name and then by counter name. The 'rx' and 'tx'
+                 byte rates are truncated to integers
+        """
+        # The dictionaries are built anew, since the messages holding them are
+        # kept for batching, summarizing or delta suppression
+        counters = self.counters
+        width = len(counters)
+        rates = [delta / period for delta in map(operator.sub, self.current, self.previous)]
+
+        result = dict()
+        offset = 0
+        for iface in self.ifaces:
+            iface_rates = dict(izip(counters, rates[offset:offset + width]))
+            iface_rates["rx"] = int(iface_rates["rx"])
+            iface_rates["tx"] = int(iface_rates["tx"])#truncate decimal portion (insignificant)
+            result[iface] = iface_rates
+            offset += width
+        return result
+
+    def __resize(self, raw_ifaces):
+        # Carry the last sample of the interfaces that are still present over
+        # to their new index
+        old_index = dict((iface, i) for i, iface in enumerate(self.ifaces))
+        ifaces = [bytes(iface).decode("ascii", "replace") for iface in raw_ifaces]
+        width = len(self.counters)
+        count = len(ifaces) * width
+
+        previous = array("d", [0.0]) * count
+        added = []
+        for i, iface in enumerate(ifaces):
+            j = old_index.get(iface)
+            if j is None:
+                added.append(i)
+            else:
+                previous[i * width:(i + 1) * width] = self.previous[j * width:(j + 1) * width]
+
+        # Pick the sampled counters of every interface, in interface order
+        indexes = [i * NET_DEV_FIELDS + column for i in range(len(ifaces)) for column in self.__columns]
+        self.__counter_fields = operator.itemgetter(*indexes) if indexes else lambda fields: ()
+
+        self.__raw_ifaces = raw_ifaces
+        self.ifaces = ifaces
+        self.current = array("d", [0.0]) * count
+        self.previous = previous
+        self.__added = added
+
+    def close(self):
+        """
+        Closes the network device file
+
+        :return: None
+        """
+        self.__file.close()
+
+
+def build_utilization_msg(cpu_sampler, net_sampler, period):
+    """
+    Builds the utilization message published for the last sample of the
+    samplers, as pistatsd.py sends it
+
+    :param cpu_sampler: (CpuStatSampler) The sampler of the cpu statistics,
+                        or any object with the same utilization() method
+    :param net_sampler: (NetDevSampler) The sampler of the network interface
+                        statistics, or any object with the same rates() method
+    :param period: (float) The number of seconds between the last two samples
+    :return: (dict) The message, holding the 'cpu' utilization, the
+             'cpu_states' shares, the utilization of the 'cores', unless
+             they just changed, and the rates of every sampled counter of
+             each interface in 'net'
+    """
+    # Calculate CPU utilization during the period, overall, per cpu state
+    # and per core
+    cpu, cpu_states, cores = cpu_sampler.utilization()
+
+    # Calculate the throughput and the rate of every other counter for each
+    # installed network interface. The period is in seconds, so the rates
+    # are per second
+    msg = {"cpu": cpu,
+           "cpu_states": dict(zip(CPU_STATES, cpu_states)),
+           "net": net_sampler.rates(period)}
+    # The cores are left out for the sample during which they changed, their
+    # utilization is unknown until the next one
+    if cores is not None:
+        msg["cores"] = cores
+    return msg
@@ -0,0 +1,650 @@
+"""
+This file contains the publisher used by pistatsd.py to send its samples to
+the message broker, optionally batching several samples into one message and
+waiting for the broker to confirm each message, and the stages that reduce the
+samples before they are published
+
+The pika module is only loaded once a publisher is created for a broker
+channel, so that the stages can be used, and measured, without it, and a
+channel standing in for a broker can be published on without it
+"""
+
+import collections
+import random
+import sys
+import time
+
+from pistatscommon import CPU_STATES, SAMPLED_HEADER, monotonic
+from pistatsspool import SampleSpool
+
+# Number of seconds waited before the first attempt to reconnect to the
+# broker, doubled after every failed attempt up to MAX_RECONNECT_BACKOFF
+RECONNECT_BACKOFF = 1.0
+MAX_RECONNECT_BACKOFF = 60.0
+
+# Number of spooled samples published per second once reconnected, and per message
+DRAIN_RATE = 1000
+DRAIN_BATCH = 100
+
+# The most raw samples published per summary period when the CPU spikes,
+# including the ones taken just before the spike
+BURST_SAMPLES = 20
+
+
+class BatchPublisher(object):
+    """
+    Collects samples until a batch is full, or its oldest sample is old
+    enough, and publishes the whole batch as a single message
+    """
+
+    def __init__(self, channel, exchange, routing_key, encoder, batch_size=1,
+                 batch_time=0.0, confirm=False, metrics=None):
+        """
+        Create a new BatchPublisher object
+
+        :param channel: (pika.adapters.blocking_connection.BlockingChannel)
+                        The channel to publish on. A channel standing in for
+                        a broker can have a 'basic_properties' attribute,
+                        used instead of pika.BasicProperties
+        :param exchange: (str) The exchange to publish to
+        :param routing_key: (str) The routing key identifying this device
+        :param encoder: (pistatscodec.StatsEncoder) Encodes the batches
+        :param batch_size: (int) The number of samples sent per message
+        :param batch_time: (float) The maximum number of seconds a sample
+                           waits for its batch to fill up, 0 for no limit
+        :param confirm: (bool) Whether the broker must confirm every message.
+                        The confirmation is awaited once per batch
+        :param metrics: (pistatsmetrics.Metrics) Counts the messages and times
+                        encoding and publishing them, None to count nothing
+        :raises ValueError: if batch_size is lower than one
+        :return: None
+        """
+        if batch_size < 1:
+            raise ValueError("The batch size must be at least one sample")
+
+        self.__channel = channel
+        self.__exchange = exchange
+        self.__routing_key = routing_key
+        self.__encoder = encoder
+        self.__batch_size = batch_size
+        self.__batch_time = batch_time
+        self.__confirm = confirm
+        self.__metrics = metrics
+        # Tag every message with its content type so that subscribers can
+        # tell the message formats apart
+        self.__basic_properties = getattr(channel, "basic_properties", None)
+        if self.__basic_properties is None:
+            import pika
+            self.__basic_properties = pika.BasicProperties
+        self.__properties = self.__basic_properties(content_type=encoder.content_type)
+
+        self.__batch = []
+        self.__batch_start = None
+        # The wall-clock time the oldest sample of the batch was added at
+        self.__batch_sampled = None
+
+        # Counters reported when the publisher is closed
+        self.published_msgs = 0
+        self.published_samples = 0
+        self.unconfirmed_msgs = 0
+
+        if confirm:
+            self.__channel.confirm_delivery()
+
+    def add(self, utilization_msg, sample_time):
+        """
+        Adds a sample to the current batch, publishing the batch once it is
+        due
+
+        :param utilization_msg: (dict) The sample to publish
+        :param sample_time: (float) The time the sample was taken at
+        :return: None
+        """
+        if not self.__batch:
+            self.__batch_start = sample_time
+            self.__batch_sampled = time.time()
+        self.__batch.append(utilization_msg)
+
+        if (len(self.__batch) >= self.__batch_size
+                or (self.__batch_time > 0 and sample_time - self.__batch_start >= self.__batch_time)):
+            self.flush()
+
+    def flush(self):
+        """
+        Publishes the current batch, if it holds any sample. The batch is
+        kept if publishing fails
+
+        :return: None
+        """
+        if not self.__batch:
+            return
+
+        self.publish(self.__batch, self.__batch_sampled)
+        self.__batch = []
+
+    def publish(self, samples, sampled=None):
+        """
+        Publishes samples as a single message, bypassing the current batch
+
+        :param samples: (list) The samples, in sampling order
+        :param sampled: (float) The wall-clock time the oldest sample was
+                        taken at, sent along so that subscribers can measure
+                        the end-to-end latency. None to send no time, e.g.
+                        for samples replayed after an outage
+        :return: None
+        """
+        metrics = self.__metrics
+        if metrics is not None:
+            start = monotonic()
+        data = self.__encoder.encode_batch(samples)
+        if metrics is not None:
+            encoded = monotonic()
+
+        properties = self.__properties
+        if sampled is not None:
+            properties = self.__basic_properties(content_type=self.__encoder.content_type,
+                                                 headers={SAMPLED_HEADER: repr(sampled)})
+        delivered = self.__channel.basic_publish(exchange=self.__exchange,
+                                                 routing_key=self.__routing_key,
+                                                 body=data, properties=properties)
+        self.published_msgs += 1
+        self.published_samples += len(samples)
+        if self.__confirm and not delivered:
+            self.unconfirmed_msgs += 1
+
+        if metrics is not None:
+            metrics.observe("encode_seconds", encoded - start)
+            metrics.observe("publish_seconds", monotonic() - encoded)
+            if sampled is not None:
+                metrics.observe("sample_to_publish_seconds", max(0.0, time.time() - sampled))
+            metrics.count("messages_total")
+            metrics.count("bytes_total", len(data))
+
+    def take_batch(self):
+        """
+        Removes the samples of the current batch, e.g. to keep them once the
+        channel is lost
+
+        :return: (list) The samples, in sampling order
+        """
+        batch = self.__batch
+        self.__batch = []
+        return batch
+
+    def reopen(self, channel):
+        """
+        Publishes on another channel, e.g. once reconnected to the broker
+
+        :param channel: (pika.adapters.blocking_connection.BlockingChannel)
+                        The channel to publish on
+        :return: None
+        """
+        self.__channel = channel
+        if self.__confirm:
+            self.__channel.confirm_delivery()
+
+
+class ReconnectingPublisher(object):
+    """
+    Publishes samples through a BatchPublisher, and keeps publishing across
+    broker restarts: once the connection is lost, the samples are spooled and
+    the connection is reopened with an exponential backoff. Once reconnected,
+    the spooled samples are published first, in bulk but at a limited rate so
+    that a recovering broker isn't flooded by the whole fleet at once
+    """
+
+    def __init__(self, connect, exchange, routing_key, encoder, batch_size=1,
+                 batch_time=0.0, confirm=False, spool=None, drain_rate=DRAIN_RATE,
+                 metrics=None):
+        """
+        Create a new ReconnectingPublisher object and open its first
+        connection
+
+        :param connect: (callable) Opens a connection to the broker and
+                        declares the exchange, returning the connection and
+                        the channel
+        :param exchange: (str) The exchange to publish to
+        :param routing_key: (str) The routing key identifying this device
+        :param encoder: (pistatscodec.StatsEncoder) Encodes the batches
+        :param batch_size: (int) The number of samples sent per message
+        :param batch_time: (float) The maximum number of seconds a sample
+                           waits for its batch to fill up, 0 for no limit
+        :param confirm: (bool) Whether the broker must confirm every message
+        :param spool: (pistatsspool.SampleSpool) Keeps the samples while
+                      disconnected, None for an in-memory spool of
+                      SPOOL_SAMPLES samples
+        :param drain_rate: (int) The number of spooled samples published per
+                           second once reconnected
+        :param metrics: (pistatsmetrics.Metrics) Counts the messages and times
+                        encoding and publishing them, counts the outages and
+                        the spooled samples, and holds the spool length in
+                        the 'spool_samples' gauge. None to count nothing
+        :raises ValueError: if batch_size or drain_rate is lower than one
+        :raises pika.exceptions.AMQPError: if the first connection fails, so
+                that misconfigurations are reported at once
+        :return: None
+        """
+        if drain_rate < 1:
+            raise ValueError("The drain rate must be at least one sample per second")
+
+        import pika.exceptions
+
+        self.__connect = connect
+        # The errors telling that the connection or the channel to the broker is lost
+        self.__connection_errors = (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError)
+        self.__spool = spool if spool is not None else SampleSpool()
+        self.__drain_rate = drain_rate
+        self.__connection = None
+        self.__backoff = RECONNECT_BACKOFF
+        self.__next_attempt = None
+        # The number of spooled samples that may be published, refilled at drain_rate
+        self.__allowance = 0.0
+        self.__last_drain = None
+        self.__metrics = metrics
+        # The spool counters already added to the metrics
+        self.__counted_dropped = 0
+        self.__counted_spilled = 0
+
+        # Counters reported when pistatsd.py exits, and added to the metrics as they change
+        self.lost_connections = 0
+        self.reconnects = 0
+        self.replayed_samples = 0
+
+        self.__connection, channel = connect()
+        self.__publisher = BatchPublisher(channel, exchange, routing_key, encoder,
+                                          batch_size, batch_time, confirm, metrics)
+
+    @property
+    def published_msgs(self):
+        return self.__publisher.published_msgs
+
+    @property
+    def published_samples(self):
+        return self.__publisher.published_samples
+
+    @property
+    def unconfirmed_msgs(self):
+        return self.__publisher.unconfirmed_msgs
+
+    @property
+    def dropped_samples(self):
+        return self.__spool.dropped_samples
+
+    @property
+    def spilled_samples(self):
+        return self.__spool.spilled_samples
+
+    def add(self, utilization_msg, sample_time):
+        """
+        Publishes a sample once its batch is due, or spools it while the
+        broker is unreachable or older samples are still spooled
+
+        :param utilization_msg: (dict) The sample to publish
+        :param sample_time: (float) The monotonic time the sample was taken at
+        :return: None
+        """
+        if self.__connection is None:
+            self.__spool.append(utilization_msg)
+            self.__reconnect(sample_time)
+            self.__count_spool()
+        elif len(self.__spool):
+            # Keep the samples in order behind the ones still spooled
+            self.__spool.append(utilization_msg)
+            self.__drain(sample_time)
+            self.__count_spool()
+        else:
+            try:
+                self.__publisher.add(utilization_msg, sample_time)
+            except self.__connection_errors, error:
+                self.__lost(error, sample_time)
+
+    def flush(self):
+        """
+        Publishes the current batch, and the spooled samples regardless of
+        the drain rate, if connected
+
+        :return: None
+        """
+        if self.__connection is None:
+            return
+        try:
+            self.__publisher.flush()
+            while len(self.__spool):
+                samples = self.__spool.peek(DRAIN_BATCH)
+                if samples:
+                    self.__publisher.publish(samples)
+                self.__spool.discard()
+                self.__replayed(len(samples))
+        except self.__connection_errors, error:
+            self.__lost(error, None)
+        self.__count_spool()
+
+    def close(self):
+        """
+        Closes the connection and the spool. The samples that could not be
+        published are left in the spill file, if any, or counted as dropped
+
+        :return: None
+        """
+        for sample in self.__publisher.take_batch():
+            self.__spool.append(sample)
+        self.__spool.dropped_samples += self.__spool.close()
+        if self.__connection is not None:
+            self.__close_connection(self.__connection)
+            self.__connection = None
+        self.__count_spool()
+
+    def __lost(self, error, now):
+        print >> sys.stderr, "Warning: Lost the connection to the message broker: " + (str(error) or type(error).__name__)
+        self.lost_connections += 1
+        if self.__metrics is not None:
+            self.__metrics.count("publisher_lost_connections_total")
+        for sample in self.__publisher.take_batch():
+            self.__spool.append(sample)
+        self.__close_connection(self.__connection)
+        self.__connection = None
+        self.__backoff = RECONNECT_BACKOFF
+        self.__next_attempt = now
+
+    def __reconnect(self, now):
+        if self.__next_attempt is not None and now < self.__next_attempt:
+            return
+        connection = None
+        try:
+            connection, channel = self.__connect()
+            self.__publisher.reopen(channel)
+        except self.__connection_errors:
+            if connection is not None:
+                self.__close_connection(connection)
+            # Spread the attempts of the devices restarted by the same outage
+            self.__next_attempt = now + self.__backoff * random.uniform(0.5, 1.0)
+            self.__backoff = min(self.__backoff * 2, MAX_RECONNECT_BACKOFF)
+            return
+
+        self.__connection = connection
+        print "Reconnected to the message broker, replaying %d spooled sample(s)" %(len(self.__spool))
+        self.reconnects += 1
+        if self.__metrics is not None:
+            self.__metrics.count("publisher_reconnects_total")
+        self.__allowance = 0.0
+        self.__last_drain = now
+        self.__drain(now)
+
+    def __close_connection(self, connection):
+        # The connection may already be broken, closing it is only a courtesy to the broker
+        try:
+            connection.close()
+        except (self.__connection_errors + (IOError,)):
+            pass
+
+    def __drain(self, now):
+        # Refill the allowance at drain_rate, up to one second worth of samples
+        if self.__last_drain is None:
+            self.__last_drain = now
+        self.__allowance = min(self.__drain_rate, self.__allowance + (now - self.__last_drain) * self.__drain_rate)
+        self.__last_drain = now
+        try:
+            while len(self.__spool) and self.__allowance >= 1:
+                samples = self.__spool.peek(min(DRAIN_BATCH, int(self.__allowance)))
+                if samples:
+                    self.__publisher.publish(samples)
+                self.__spool.discard()
+                self.__allowance -= len(samples)
+                self.__replayed(len(samples))
+        except self.__connection_errors, error:
+            self.__lost(error, now)
+
+    def __replayed(self, count):
+        self.replayed_samples += count
+        if self.__metrics is not None:
+            self.__metrics.count("publisher_replayed_samples_total", count)
+
+    def __count_spool(self):
+        # Adds the samples the spool spilled or dropped since last time to the metrics, and its length
+        metrics = self.__metrics
+        if metrics is None:
+            return
+        spool = self.__spool
+        if spool.spilled_samples != self.__counted_spilled:
+            metrics.count("publisher_spilled_samples_total", spool.spilled_samples - self.__counted_spilled)
+            self.__counted_spilled = spool.spilled_samples
+        if spool.dropped_samples != self.__counted_dropped:
+            metrics.count("publisher_dropped_samples_total", spool.dropped_samples - self.__counted_dropped)
+            self.__counted_dropped = spool.dropped_samples
+        metrics.gauge("spool_samples", len(spool))
+
+
+class DeltaSuppressor(object):
+    """
+    Removes the interfaces and counters whose value did not change since
+    they were last sent from the samples, sending a full keyframe every few
+    samples so that subscribers that missed a message or joined late catch up
+    """
+
+    def __init__(self, keyframe_interval):
+        """
+        Create a new DeltaSuppressor object
+
+        :param keyframe_interval: (int) The number of samples between two
+                                  keyframes, 1 sends every sample in full
+        :raises ValueError: if keyframe_interval is lower than one
+        :return: None
+        """
+        if keyframe_interval < 1:
+            raise ValueError("The keyframe interval must be at least one sample")
+
+        self.__keyframe_interval = keyframe_interval
+        self.__samples_since_keyframe = 0
+        # The last value sent for each counter, keyed by interface name
+        self.__last_sent = dict()
+
+    def filter(self, utilization_msg):
+        """
+        Reduces a sample to the values that changed since they were last sent
+
+        :param utilization_msg: (dict) The full sample
+        :return: (dict) The sample itself if it is a keyframe, otherwise a
+                 copy flagged with 'delta' whose 'net' only holds the changed
+                 counters of the changed interfaces
+        """
+        net = utilization_msg["net"]
+        keyframe = self.__samples_since_keyframe == 0
+        self.__samples_since_keyframe = (self.__samples_since_keyframe + 1) % self.__keyframe_interval
+
+        if keyframe:
+            self.__last_sent = dict((iface, dict(counters)) for iface, counters in net.items())
+            return utilization_msg
+
+        changed_net = dict()
+        for iface, counters in net.items():
+            last_sent = self.__last_sent.get(iface)
+            if last_sent is None:
+                last_sent = self.__last_sent[iface] = dict()
+            changed = dict()
+            for counter, value in counters.items():
+                if last_sent.get(counter) != value:
+                    last_sent[counter] = value
+                    changed[counter] = value
+            if changed:
+                changed_net[iface] = changed
+
+        delta_msg = dict(utilization_msg)
+        delta_msg["net"] = changed_net
+        delta_msg["delta"] = True
+        return delta_msg
+
+
+class SampleSummarizer(object):
+    """
+    Reduces the samples taken at a fast rate to one summary per period,
+    holding the mean of every value along with the highest and lowest ones, so
+    that short spikes are caught without publishing every sample. Optionally,
+    the raw samples around a CPU spike are published as well
+    """
+
+    def __init__(self, period, burst_threshold=None, burst_samples=BURST_SAMPLES):
+        """
+        Create a new SampleSummarizer object
+
+        :param period: (float) The number of seconds summarized per summary
+        :param burst_threshold: (float) The CPU utilization from which the raw
+                                samples are published too, None to only
+                                publish the summaries
+        :param burst_samples: (int) The most raw samples published per period,
+                              including the ones taken just before the spike
+        :raises ValueError: if period is not positive or burst_samples is
+                            lower than one
+        :return: None
+        """
+        if period <= 0:
+            raise ValueError("The summary period must be positive")
+        if burst_samples < 1:
+            raise ValueError("The burst must hold at least one sample")
+
+        self.__period = period
+        self.__burst_threshold = burst_threshold
+        self.__burst_samples = burst_samples
+        # The last raw samples, published if the CPU spikes, and whether it still does
+        self.__recent = collections.deque(maxlen=burst_samples)
+        self.__bursting = False
+        self.__start = None
+        self.__reset()
+
+        # Counters reported when pistatsd.py exits
+        self.summarized_samples = 0
+        self.summaries = 0
+        self.raw_samples = 0
+
+    def add(self, utilization_msg, sample_time):
+        """
+        Adds a sample to the current period
+
+        :param utilization_msg: (dict) The full sample
+        :param sample_time: (float) The time the sample was taken at
+        :return: (list) The samples due for publishing: the raw samples of a
+                 burst, then the summary once the period is over
+        """
+        if self.__start is None:
+            self.__start = sample_time
+        self.__accumulate(utilization_msg)
+
+        due = []
+        if self.__burst_threshold is not None:
+            if utilization_msg["cpu"] >= self.__burst_threshold:
+                # Send the samples leading to the spike, then the spike itself
+                if not self.__bursting:
+                    self.__bursting = True
+                    # Only the latest ones fit in the burst along with the spike
+                    leading = list(self.__recent)[max(0, len(self.__recent) - (self.__burst_left - 1)):]
+                    due.extend(leading)
+                    self.__burst_left -= len(leading)
+                    self.__recent.clear()
+                if self.__burst_left > 0:
+                    due.append(utilization_msg)
+                    self.__burst_left -= 1
+            else:
+                self.__bursting = False
+                self.__recent.append(utilization_msg)
+            self.raw_samples += len(due)
+
+        if sample_time - self.__start >= self.__period:
+            due.append(self.flush())
+            self.__start = sample_time
+        return due
+
+    def flush(self):
+        """
+        Summarizes the samples of the current period and starts a new one
+
+        :return: (dict) The summary, a sample holding the mean values and a
+                 'summary' field with the number of samples and the highest
+                 and lowest values, None if no sample was added
+        """
+        count = self.__count
+        if count == 0:
+            return None
+
+        cpu_sum, cpu_max, cpu_min = self.__cpu
+        msg = {"cpu": cpu_sum / count, "net": dict()}
+        high = {"cpu": cpu_max, "net": dict()}
+        low = {"cpu": cpu_min, "net": dict()}
+        if self.__cores:
+            msg["cores"] = [core[0] / self.__cores_count for core in self.__cores]
+            high["cores"] = [core[1] for core in self.__cores]
+            low["cores"] = [core[2] for core in self.__cores]
+        if self.__states_count:
+            msg["cpu_states"] = dict((state, total / self.__states_count)
+                                     for state, total in zip(CPU_STATES, self.__states))
+        for iface, (iface_count, counters) in self.__net.items():
+            msg["net"][iface] = dict((counter, values[0] / iface_count) for counter, values in counters.items())
+            high["net"][iface] = dict((counter, values[1]) for counter, values in counters.items())
+            low["net"][iface] = dict((counter, values[2]) for counter, values in counters.items())
+            # The byte rates are sent as integers
+            for counter in ("rx", "tx"):
+                if counter in counters:
+                    msg["net"][iface][counter] = int(msg["net"][iface][counter])
+        msg["summary"] = {"samples": count, "max": high, "min": low}
+
+        self.summarized_samples += count
+        self.summaries += 1
+        self.__reset()
+        return msg
+
+    def __reset(self):
+        # The running sum, max and min of every value of the period
+        self.__count = 0
+        self.__cpu = [0.0, float("-inf"), float("inf")]
+        self.__cores = None
+        self.__cores_count = 0
+        self.__states = [0.0] * len(CPU_STATES)
+        self.__states_count = 0
+        self.__net = dict()
+        self.__burst_left = self.__burst_samples
+
+    def __accumulate(self, utilization_msg):
+        self.__count += 1
+        accumulate(self.__cpu, utilization_msg["cpu"])
+
+        cores = utilization_msg.get("cores")
+        if cores:
+            # Start over if the number of cores changed during the period
+            if self.__cores is None or len(self.__cores) != len(cores):
+                self.__cores = [[0.0, float("-inf"), float("inf")] for core in cores]
+                self.__cores_count = 0
+            self.__cores_count += 1
+            for values, value in zip(self.__cores, cores):
+                accumulate(values, value)
+
+        cpu_states = utilization_msg.get("cpu_states")
+        if cpu_states is not None:
+            self.__states_count += 1
+            for i in range(len(CPU_STATES)):
+                self.__states[i] += cpu_states.get(CPU_STATES[i], 0.0)
+
+        # Interfaces that appear during the period are averaged over the samples they are in
+        for iface, counters in utilization_msg["net"].items():
+            entry = self.__net.get(iface)
+            if entry is None:
+                entry = self.__net[iface] = [0, dict()]
+            entry[0] += 1
+            iface_counters = entry[1]
+            for counter, value in counters.items():
+                values = iface_counters.get(counter)
+                if values is None:
+                    values = iface_counters[counter] = [0.0, float("-inf"), float("inf")]
+                accumulate(values, value)
+
+
+def accumulate(values, value):
+    """
+    Adds a value to a running sum, max and min
+
+    :param values: (list) The sum, max and min
+    :param value: (float) The new value
+    :return: None
+    """
+    values[0] += value
+    if value > values[1]:
+        values[1] = value
+    if value < values[2]:
+        values[2] = value
@@ -0,0 +1,510 @@
+"""
+This file contains the recorder used by pistatsview.py to keep every sample
+it receives on disk, and the reader used by pistatsreplay.py to query them
+
+The samples of each device are appended to segment files in a directory named
+after the device's routing key. A segment holds a fixed number of records and
+is laid out by column: the sample times come first, as doubles, followed by
+each metric as single precision floats. A segment is preallocated and memory
+mapped when it is created. The records are buffered by row and copied into
+the mapping FLUSH_ROWS at a time, one block per column, so that no system
+call is made and the kernel writes the segment back in the background. Once a
+segment is full, or the metrics reported by the device change, the next
+record starts a new segment.
+
+Every mapping holds a file descriptor, so only a bounded number of segments
+are kept open, OPEN_SEGMENTS at most and a quarter of the process's file
+descriptor limit. Once more devices report, the segment that was written the
+longest ago is closed, and reopened from its record count when its device
+reports again. If a segment can't be written anyway, recording is disabled
+with a warning rather than stopping the viewer.
+
+Segment layout, all values little endian:
+    header: magic 'PSTS', version (B), padding (B), column count (H),
+            capacity (I), record count (I)
+    names:  one length (B) prefixed name per column, 'time' first
+    data:   aligned on 8 bytes, capacity doubles for 'time', then capacity
+            floats for each of the other columns
+"""
+
+import bisect
+import mmap
+import os
+import resource
+import struct
+import sys
+import time
+from array import array
+
+from pistatscommon import CPU_STATES, NET_COUNTERS
+from pistatsstore import CURRENT, METRIC_WIDTH
+
+# Number of records per segment, an hour of samples at the default interval
+SEGMENT_ROWS = 3600
+
+# Number of records buffered before they are copied into the segment
+FLUSH_ROWS = 16
+
+# Largest number of segments kept open at once
+OPEN_SEGMENTS = 256
+
+# File name suffix of the segments
+SEGMENT_SUFFIX = ".seg"
+
+SEGMENT_MAGIC = "PSTS"
+SEGMENT_VERSION = 1
+
+HEADER = struct.Struct("<4sBBHII")
+NAME_LENGTH = struct.Struct("<B")
+TIME_VALUE = struct.Struct("<d")
+METRIC_VALUE = struct.Struct("<f")
+
+# The record count, and its offset inside the header
+ROWS = struct.Struct("<I")
+ROWS_OFFSET = 12
+
+
+def device_shape(device):
+    """
+    Returns what identifies the metrics a device reports, which changes when
+    cores, cpu states or interfaces appear or disappear
+
+    :param device: (pistatsstore.DeviceStats) The device
+    :return: (tuple) The number of cores, whether cpu states are reported and
+             the sorted interface names
+    """
+    cores = len(device.cores) / METRIC_WIDTH if device.cores is not None else -1
+    return cores, device.cpu_states is not None, tuple(sorted(device.net.keys()))
+
+
+def device_columns(device, ifaces):
+    """
+    Returns the columns a device's records are made of
+
+    :param device: (pistatsstore.DeviceStats) The device
+    :param ifaces: (tuple) The sorted interface names, as in device_shape()
+    :return: (tuple) The column names, 'time' first, utf-8 encoded since the
+             decoded interface names are unicode
+    """
+    columns = ["time", "cpu"]
+    if device.cores is not None:
+        columns.extend("core%d" %(core) for core in range(len(device.cores) / METRIC_WIDTH))
+    if device.cpu_states is not None:
+        columns.extend("state." + state for state in CPU_STATES)
+    for iface in ifaces:
+        if not isinstance(iface, bytes):
+            iface = iface.encode("utf-8")
+        columns.extend(iface + "." + counter for counter in NET_COUNTERS)
+    return tuple(columns)
+
+
+def device_values(device, ifaces):
+    """
+    Returns the current values of a device, in device_columns() order
+
+    :param device: (pistatsstore.DeviceStats) The device
+    :param ifaces: (tuple) The sorted interface names, as in device_shape()
+    :return: (list) The metric values, without the time
+    """
+    values = [device.cpu[CURRENT]]
+    if device.cores is not None:
+        values.extend(device.cores[CURRENT::METRIC_WIDTH])
+    if device.cpu_states is not None:
+        values.extend(device.cpu_states[CURRENT::METRIC_WIDTH])
+    for iface in ifaces:
+        values.extend(device.net[iface][CURRENT::METRIC_WIDTH])
+    return values
+
+
+def open_segments_limit():
+    """
+    Returns the number of segments a recorder may keep open, leaving most
+    file descriptors to the rest of the process
+
+    :return: (int) OPEN_SEGMENTS, or a quarter of the file descriptor limit if lower
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return OPEN_SEGMENTS
+    return max(1, min(OPEN_SEGMENTS, soft / 4))
+
+
+def data_offset(columns):
+    """
+    Returns the offset of the first column inside a segment
+
+    :param columns: (tuple) The column names
+    :return: (int) The offset in bytes, aligned on 8 bytes
+    """
+    size = HEADER.size + sum(NAME_LENGTH.size + len(name) for name in columns)
+    return (size + 7) & ~7
+
+
+class SegmentWriter(object):
+    """
+    Appends records to a memory mapped segment file
+    """
+
+    def __init__(self, path, columns, capacity=SEGMENT_ROWS, resume=False):
+        """
+        Create a new SegmentWriter object and the segment file
+
+        :param path: (str) The path of the segment file, which must not exist
+                     unless resuming
+        :param columns: (tuple) The column names, 'time' first, as utf-8
+                        encoded or unicode strings
+        :param capacity: (int) The number of records the segment holds
+        :param resume: (bool) Whether to append to the existing segment at
+                       path, created with the same columns and capacity,
+                       after the records it holds
+        :raises EnvironmentError: if the file couldn't be created or mapped
+        :raises ValueError: if a column name is longer than 255 bytes
+        :return: None
+        """
+        columns = tuple(name if isinstance(name, bytes) else name.encode("utf-8") for name in columns)
+        if max(len(name) for name in columns) > 255:
+            raise ValueError("Column name longer than 255 bytes")
+        self.path = path
+        self.columns = columns
+        self.capacity = capacity
+        # The number of records copied into the segment, and the buffered ones, by row
+        self.rows = 0
+        self.__times = array("d")
+        self.__values = array("f")
+
+        offset = data_offset(columns)
+        size = offset + capacity * (TIME_VALUE.size + (len(columns) - 1) * METRIC_VALUE.size)
+        if resume:
+            fd = os.open(path, os.O_RDWR)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0644)
+        try:
+            # The file is sparse until the records are written
+            if not resume:
+                os.ftruncate(fd, size)
+            self.__map = mmap.mmap(fd, size)
+        finally:
+            # The mapping keeps a descriptor of its own
+            os.close(fd)
+
+        if resume:
+            self.rows = ROWS.unpack_from(self.__map, ROWS_OFFSET)[0]
+        else:
+            HEADER.pack_into(self.__map, 0, SEGMENT_MAGIC, SEGMENT_VERSION, 0, len(columns), capacity, 0)
+            position = HEADER.size
+            for name in columns:
+                NAME_LENGTH.pack_into(self.__map, position, len(name))
+                self.__map[position + NAME_LENGTH.size:position + NAME_LENGTH.size + len(name)] = name
+                position += NAME_LENGTH.size + len(name)
+
+        # The offset of each metric column
+        self.__time_offset = offset
+        first = offset + capacity * TIME_VALUE.size
+        self.__offsets = [first + i * capacity * METRIC_VALUE.size for i in range(len(columns) - 1)]
+
+    def full(self):
+        """
+        :return: (bool) Whether the segment can't hold another record
+        """
+        return self.rows + len(self.__times) >= self.capacity
+
+    def append(self, timestamp, values):
+        """
+        Appends a record to the segment
+
+        :param timestamp: (float) The wall-clock time of the record
+        :param values: (list) The metric values, in column order after 'time'
+        :return: None
+        """
+        self.__times.append(timestamp)
+        self.__values.extend(values)
+        if len(self.__times) >= FLUSH_ROWS:
+            self.flush()
+
+    def flush(self):
+        """
+        Copies the buffered records into the segment
+
+        :return: None
+        """
+        count = len(self.__times)
+        if count == 0:
+            return
+        times, values = self.__times, self.__values
+        if sys.byteorder != "little":
+            times.byteswap()
+            values.byteswap()
+
+        segment = self.__map
+        start = self.__time_offset + self.rows * TIME_VALUE.size
+        segment[start:start + count * TIME_VALUE.size] = times.tostring()
+        width = len(self.__offsets)
+        position = self.rows * METRIC_VALUE.size
+        for i in range(width):
+            start = self.__offsets[i] + position
+            segment[start:start + count * METRIC_VALUE.size] = values[i::width].tostring()
+
+        # Publish the records to the readers once they are complete
+        self.rows += count
+        ROWS.pack_into(segment, ROWS_OFFSET, self.rows)
+        self.__times = array("d")
+        self.__values = array("f")
+
+    def close(self):
+        """
+        Writes the segment back to disk and closes it
+
+        :return: None
+        """
+        self.flush()
+        self.__map.flush()
+        self.__map.close()
+
+
+class SegmentRecorder(object):
+    """
+    Records the current values of every device after each of its samples,
+    rotating each device's segments as they fill up
+    """
+
+    def __init__(self, directory, segment_rows=SEGMENT_ROWS, max_open=None):
+        """
+        Create a new SegmentRecorder object
+
+        :param directory: (str) The directory holding one subdirectory of segments per device
+        :param segment_rows: (int) The number of records per segment
+        :param max_open: (int) The number of segments kept open at once, None
+                         for open_segments_limit()
+        :raises ValueError: if segment_rows or max_open is lower than one
+        :return: None
+        """
+        if segment_rows < 1:
+            raise ValueError("A segment must hold at least one record")
+        if max_open is None:
+            max_open = open_segments_limit()
+        if max_open < 1:
+            raise ValueError("At least one segment must be kept open")
+        self.directory = directory
+        self.__segment_rows = segment_rows
+        self.__max_open = max_open
+        # The open segment of each device, and the record it was last written at, keyed by routing key
+        self.__writers = dict()
+        self.__used = dict()
+        # The path and shape of the segment each device records in, open or not
+        self.__paths = dict()
+        self.__shapes = dict()
+
+        # Set once a segment couldn't be written, nothing is recorded afterwards
+        self.disabled = False
+
+        # Counters reported when the recorder is closed
+        self.records = 0
+        self.segments = 0
+
+    def record(self, device, timestamp=None):
+        """
+        Appends the current values of a device to its segment. If the segment
+        can't be written, recording is disabled with a warning
+
+        :param device: (pistatsstore.DeviceStats) The device that was just updated
+        :param timestamp: (float) The wall-clock time of the sample, None for now
+        :return: None
+        """
+        if self.disabled:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+
+        routing_key = device.routing_key
+        shape = device_shape(device)
+        try:
+            # Reopen the segment of a device whose segment was closed to make room for others
+            writer = self.__writers.get(routing_key)
+            if writer is None and self.__shapes.get(routing_key) == shape:
+                writer = self.__open(routing_key, self.__paths[routing_key], device_columns(device, shape[2]), True)
+
+            # Start a new segment once the current one is full, or the columns changed
+            if writer is None or writer.full() or self.__shapes[routing_key] != shape:
+                writer = self.__rotate(device, shape, timestamp)
+
+            writer.append(timestamp, device_values(device, shape[2]))
+        except (EnvironmentError, ValueError), error:
+            print >> sys.stderr, "Warning: Recording disabled, could not write the segment of %s: %s" %(routing_key, error)
+            self.disabled = True
+            self.close()
+            return
+        self.records += 1
+        self.__used[routing_key] = self.records
+
+    def close(self):
+        """
+        Closes the segments being written
+
+        :return: None
+        """
+        for writer in self.__writers.values():
+            try:
+                writer.close()
+            except EnvironmentError, error:
+                print >> sys.stderr, "Warning: Could not write back the segment %s: %s" %(writer.path, error)
+        self.__writers.clear()
+
+    def __rotate(self, device, shape, timestamp):
+        # Loaded on the first segment, only recording viewers need it
+        import urllib
+
+        writer = self.__writers.pop(device.routing_key, None)
+        if writer is not None:
+            writer.close()
+
+        device_directory = os.path.join(self.directory, urllib.quote(device.routing_key, safe=""))
+        if not os.path.isdir(device_directory):
+            os.makedirs(device_directory)
+        path = os.path.join(device_directory, "%017.6f%s" %(timestamp, SEGMENT_SUFFIX))
+
+        writer = self.__open(device.routing_key, path, device_columns(device, shape[2]), False)
+        self.__paths[device.routing_key] = path
+        self.__shapes[device.routing_key] = shape
+        self.segments += 1
+        return writer
+
+    def __open(self, routing_key, path, columns, resume):
+        # Close the segment written the longest ago first, if as many segments as allowed are open
+        writers = self.__writers
+        if len(writers) >= self.__max_open:
+            oldest = min(writers, key=self.__used.get)
+            writers.pop(oldest).close()
+        writer = writers[routing_key] = SegmentWriter(path, columns, self.__segment_rows, resume)
+        return writer
+
+
+class SegmentReader(object):
+    """
+    Reads the columns of a segment file straight from its memory mapping
+    """
+
+    def __init__(self, path):
+        """
+        Create a new SegmentReader object
+
+        :param path: (str) The path of the segment file
+        :raises IOError: if the file couldn't be opened
+        :raises ValueError: if the file is not a segment
+        :return: None
+        """
+        self.path = path
+        with open(path, "rb") as segment_file:
+            self.__map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, version, padding, column_count, capacity, rows = HEADER.unpack_from(self.__map, 0)
+            if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+                raise ValueError("Not a version %d segment: %s" %(SEGMENT_VERSION, path))
+
+            columns = []
+            position = HEADER.size
+            for i in range(column_count):
+                length, = NAME_LENGTH.unpack_from(self.__map, position)
+                position += NAME_LENGTH.size
+                columns.append(self.__map[position:position + length])
+                position += length
+        except struct.error:
+            self.__map.close()
+            raise ValueError("Truncated segment: " + path)
+
+        self.columns = tuple(columns)
+        self.capacity = capacity
+        self.__time_offset = data_offset(self.columns)
+        first = self.__time_offset + capacity * TIME_VALUE.size
+        self.__offsets = dict((name, first + i * capacity * METRIC_VALUE.size) for i, name in enumerate(self.columns[1:]))
+        if first + (column_count - 1) * capacity * METRIC_VALUE.size > len(self.__map):
+            self.__map.close()
+            raise ValueError("Truncated segment: " + path)
+
+    def rows(self):
+        """
+        :return: (int) The number of records written so far, the segment may still be growing
+        """
+        return ROWS.unpack_from(self.__map, ROWS_OFFSET)[0]
+
+    def time(self, row):
+        """
+        :param row: (int) The index of a record
+        :return: (float) The wall-clock time of the record
+        """
+        return TIME_VALUE.unpack_from(self.__map, self.__time_offset + row * TIME_VALUE.size)[0]
+
+    def find_time(self, timestamp):
+        """
+        Finds the first record at or after a point in time, without reading the other records
+
+        :param timestamp: (float) The wall-clock time to look for
+        :return: (int) The index of the record, rows() if all records are older
+        """
+        return bisect.bisect_left(_TimeColumn(self), timestamp)
+
+    def column(self, name, start=0, end=None):
+        """
+        Returns a range of the values of a column
+
+        :param name: (str) The column name
+        :param start: (int) The index of the first record
+        :param end: (int) The index after the last record, None for all the records written so far
+        :raises KeyError: if the segment has no such column
+        :return: (array.array) The values, doubles for 'time' and floats otherwise
+        """
+        if end is None:
+            end = self.rows()
+        if name == self.columns[0]:
+            values = array("d")
+            offset, size = self.__time_offset, TIME_VALUE.size
+        else:
+            values = array("f")
+            offset, size = self.__offsets[name], METRIC_VALUE.size
+        values.fromstring(self.__map[offset + start * size:offset + end * size])
+        if sys.byteorder != "little":
+            values.byteswap()
+        return values
+
+    def close(self):
+        """
+        Closes the segment
+
+        :return: None
+        """
+        self.__map.close()
+
+
+class _TimeColumn(object):
+    # Lets bisect search the time column of a segment in place
+
+    def __init__(self, reader):
+        self.__reader = reader
+        self.__rows = reader.rows()
+
+    def __len__(self):
+        return self.__rows
+
+    def __getitem__(self, row):
+        return self.__reader.time(row)
+
+
+def list_segments(directory):
+    """
+    Lists the segments recorded in a directory
+
+    :param directory: (str) The directory given to SegmentRecorder
+    :return: (dict) The segment paths of each device, oldest first, keyed by routing key
+    """
+    import urllib
+
+    segments = dict()
+    for name in sorted(os.listdir(directory)):
+        device_directory = os.path.join(directory, name)
+        if not os.path.isdir(device_directory):
+            continue
+        paths = [os.path.join(device_directory, segment) for segment in sorted(os.listdir(device_directory))
+                 if segment.endswith(SEGMENT_SUFFIX)]
+        if paths:
+            segments[urllib.unquote(name)] = paths
+    return segments
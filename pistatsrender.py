@@ -0,0 +1,195 @@
+"""
+This file contains the renderer used by pistatsview.py to display the stats
+of every device as tables on the terminal
+
+Devices are marked dirty as their messages arrive and redrawn together, at
+most once per refresh interval, and only the rows whose values changed since
+a device was last displayed are printed again. The tabulate module is only
+loaded once the first table is printed, so that viewers that display nothing,
+such as recording-only ones, start without it.
+"""
+
+from pistatscommon import monotonic, CPU_STATES, NET_COUNTERS
+from pistatsstore import IFACE_MODES, IFACE_OFFSETS, CURRENT, MAX, MIN, METRIC_WIDTH
+from pistatswindow import QUANTILES
+
+
+class StatsRenderScheduler:
+    """
+    This helper class decouples receiving messages from displaying them. Devices are marked dirty as their
+    messages arrive and are redrawn together, at most once per refresh interval
+    """
+
+    def __init__(self, connection, refresh, store, metrics=None):
+        """
+        Create a new StatsRenderScheduler object
+
+        :param connection: (pika.BlockingConnection) The connection, or the IOLoop, whose event loop drives the
+                           refresh timer
+        :param refresh: (float) The number of seconds between two redraws, 0 redraws on every message
+        :param store: (pistatsstore.StatsStore) The store the devices are looked up in when redrawn
+        :param metrics: (pistatsmetrics.Metrics) Times every redraw, None to time nothing
+        :return: None
+        """
+        self.__connection = connection
+        self.__refresh = refresh
+        self.__store = store
+        self.__metrics = metrics
+        # Routing keys of the devices updated since the last redraw, in arrival order
+        self.__dirty = []
+        self.__dirty_keys = set()
+        # Rows printed during the last redraw of each device, keyed by routing key
+        self.__last_rows = dict()
+
+    def start(self):
+        """
+        Starts the periodic redraw timer
+
+        :return: None
+        """
+        if self.__refresh > 0:
+            self.__connection.add_timeout(self.__refresh, self.__on_refresh)
+
+    def mark_dirty(self, routing_key):
+        """
+        Records that a device was updated and needs to be redrawn
+
+        :param routing_key: (str) The routing key of the device that was updated. The device is only looked up
+                            in the store when redrawn, since merging the results of a worker replaces it
+        :return: None
+        """
+        if self.__refresh <= 0:
+            self.__render_device(routing_key)
+        elif routing_key not in self.__dirty_keys:
+            self.__dirty_keys.add(routing_key)
+            self.__dirty.append(routing_key)
+
+    def render(self):
+        """
+        Redraws every device updated since the last redraw, and the devices whose rolling windows dropped values
+        since they stopped reporting
+
+        :return: None
+        """
+        metrics = self.__metrics
+        if metrics is not None:
+            start = monotonic()
+        for routing_key in self.__store.expire_windows(monotonic()):
+            if routing_key not in self.__dirty_keys:
+                self.__dirty_keys.add(routing_key)
+                self.__dirty.append(routing_key)
+        dirty = self.__dirty
+        self.__dirty = []
+        self.__dirty_keys.clear()
+        for routing_key in dirty:
+            self.__render_device(routing_key)
+        if metrics is not None and dirty:
+            metrics.observe("render_seconds", monotonic() - start)
+
+    def close(self):
+        """
+        Displays the updates received since the last redraw
+
+        :return: None
+        """
+        self.render()
+
+    def __render_device(self, routing_key):
+        device = self.__store.devices.get(routing_key)
+        if device is None:
+            return
+        last_rows = self.__last_rows.get(routing_key)
+        if last_rows is None:
+            last_rows = self.__last_rows[routing_key] = dict()
+        show_stats_history(device, last_rows)
+
+    def __on_refresh(self):
+        self.render()
+        self.__connection.add_timeout(self.__refresh, self.__on_refresh)
+
+def show_stats_history(device, last_rows=None):
+    """
+    Displays stats history invoked by the event handler
+
+    :param device: (pistatsstore.DeviceStats) Data structure that holds the latest minimum and maximum values of a device
+    :param last_rows: (dict) The rows displayed the last time this device was shown, updated in place. If given,
+                      only the rows whose values changed since then are displayed
+    :return None
+
+    NOTE: We use package called tabulate to display the stats, Following url gives the source
+    url: https://pypi.python.org/pypi/tabulate
+    """
+    cpu_rows = [["CPU", device.cpu[CURRENT], device.cpu[MAX], device.cpu[MIN]]]
+    if device.cores is not None:
+        for core in range(len(device.cores) / METRIC_WIDTH):
+            offset = core * METRIC_WIDTH
+            cpu_rows.append(["CPU%d" %(core), device.cores[offset + CURRENT], device.cores[offset + MAX], device.cores[offset + MIN]])
+
+    state_rows = []
+    if device.cpu_states is not None:
+        for i in range(len(CPU_STATES)):
+            offset = i * METRIC_WIDTH
+            state_rows.append(["CPU", CPU_STATES[i], device.cpu_states[offset + CURRENT], device.cpu_states[offset + MAX], device.cpu_states[offset + MIN]])
+
+    window_rows = []
+    for key in sorted(device.windows.keys()):
+        windows = device.windows[key]
+        for i in range(len(windows)):
+            window = windows[i]
+            window_rows.append([key[0], key[1], device.spans[i][0], window.mean(), window.min(), window.max()]
+                               + [window.quantile(p) for p in QUANTILES])
+
+    net_rows = []
+    for iface in device.net.keys():
+        record = device.net[iface]
+        for iface_mode in NET_COUNTERS:
+            offset = IFACE_OFFSETS[iface_mode]
+            # Only display the other counters, such as errors and drops, once they were seen moving
+            if iface_mode in IFACE_MODES or record[offset + MAX] > 0:
+                net_rows.append(["NET", iface, iface_mode, record[offset + CURRENT], record[offset + MAX], record[offset + MIN]])
+
+    # Skip the rows that are displayed unchanged already
+    if last_rows is not None:
+        cpu_rows = changed_rows(cpu_rows, last_rows, 1)
+        state_rows = changed_rows(state_rows, last_rows, 2)
+        net_rows = changed_rows(net_rows, last_rows, 3)
+        window_rows = changed_rows(window_rows, last_rows, 3)
+        if not cpu_rows and not state_rows and not net_rows and not window_rows:
+            return
+
+    # Loaded on first use, viewers that never display anything don't pay for it
+    from tabulate import tabulate
+
+    # Print the routing key whose message gets printed below:
+    print "%s :" %(device.routing_key)
+
+    if cpu_rows:
+        print tabulate([["Type", "Current", "High", "Low"]] + cpu_rows)
+
+    if state_rows:
+        print tabulate([["Type", "State", "Current", "High", "Low"]] + state_rows)
+
+    if net_rows:
+        print tabulate([["Type", "Interface", "Tx/Rx", "Current", "High", "Low"]] + net_rows)
+
+    if window_rows:
+        print tabulate([["Type", "Metric", "Window", "Mean", "Low", "High"] + ["p%g" %(p * 100) for p in QUANTILES]]
+                       + window_rows)
+
+def changed_rows(rows, last_rows, key_width):
+    """
+    Filters out the table rows that have not changed since they were last displayed
+
+    :param rows: (list) The table rows to display
+    :param last_rows: (dict) The rows displayed last time, keyed by their first key_width columns, updated in place
+    :param key_width: (int) The number of leading columns identifying a row
+    :return: (list) The rows whose values changed
+    """
+    result = []
+    for row in rows:
+        key = tuple(row[:key_width])
+        values = tuple(row[key_width:])
+        if last_rows.get(key) != values:
+            last_rows[key] = values
+            result.append(row)
+    return result
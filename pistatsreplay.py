@@ -0,0 +1,210 @@
+#!/usr/bin/python
+"""
+This file contains pistatsreplay.py which computes aggregates over the samples
+recorded by pistatsview.py --record, for every device and for the whole fleet
+
+The segments are memory mapped and only the requested columns of the records
+inside the requested time range are read, as packed arrays of numbers
+"""
+
+import fnmatch
+import sys
+import time
+from pistatscommon import parse_duration
+from pistatsrecord import SegmentReader, list_segments
+
+# The metrics aggregated unless others are asked for
+DEFAULT_METRICS = "cpu,core*,*.rx,*.tx"
+
+
+class MetricAggregate(object):
+    """
+    Accumulates the count, sum, maximum and minimum of a metric
+    """
+
+    def __init__(self):
+        """
+        Create a new, empty MetricAggregate object
+
+        :return: None
+        """
+        self.count = 0
+        self.total = 0.0
+        self.high = float("-inf")
+        self.low = float("inf")
+        self.devices = 0
+
+    def add(self, values):
+        """
+        Accumulates a range of values
+
+        :param values: (array.array) The values
+        :return: None
+        """
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.total += sum(values)
+        self.high = max(self.high, max(values))
+        self.low = min(self.low, min(values))
+
+    def merge(self, other):
+        """
+        Accumulates the values of another aggregate
+
+        :param other: (MetricAggregate) The aggregate of another device
+        :return: None
+        """
+        if other.count == 0:
+            return
+        self.count += other.count
+        self.total += other.total
+        self.high = max(self.high, other.high)
+        self.low = min(self.low, other.low)
+        self.devices += 1
+
+    def row(self, name):
+        """
+        :param name: (str) The metric name
+        :return: (list) The table row displaying the aggregate
+        """
+        return [name, self.count, self.total / self.count, self.low, self.high]
+
+
+def aggregate_device(paths, patterns, since, until):
+    """
+    Aggregates the metrics of a device over a time range
+
+    :param paths: (list) The segments of the device, oldest first
+    :param patterns: (list) The shell style patterns of the metrics to aggregate
+    :param since: (float) The wall-clock time the range starts at
+    :param until: (float) The wall-clock time the range ends at
+    :return: (dict) The MetricAggregate of each metric, keyed by metric name
+    """
+    aggregates = dict()
+    for path in paths:
+        try:
+            reader = SegmentReader(path)
+        except (IOError, ValueError), error:
+            print >> sys.stderr, "Warning: skipping segment: " + str(error)
+            continue
+
+        try:
+            rows = reader.rows()
+            if rows == 0 or reader.time(rows - 1) < since or reader.time(0) > until:
+                continue
+            start = reader.find_time(since)
+            end = reader.find_time(until)
+            for name in reader.columns[1:]:
+                if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns):
+                    aggregate = aggregates.get(name)
+                    if aggregate is None:
+                        aggregate = aggregates[name] = MetricAggregate()
+                    aggregate.add(reader.column(name, start, end))
+        finally:
+            reader.close()
+    return aggregates
+
+
+def main(argv):
+    """
+    Aggregates the recorded samples and prints the tables of the devices and
+    of the fleet
+
+    :param argv: (list) The command line arguments, the program name first
+    :return: None
+    """
+    # Guard try clause to catch any errors that aren't expected
+    try:
+        # The directory the samples were recorded in
+        directory = None
+
+        # The routing keys of the devices to aggregate
+        topics = [] # Defaults to every recorded device
+
+        # The metrics to aggregate, as shell style patterns
+        patterns = DEFAULT_METRICS.split(",")
+
+        # The time range to aggregate, as durations before now
+        since = None # Defaults to the first recorded sample
+        until = 0.0 # Defaults to now
+
+        # Whether the aggregates of every device are displayed, besides the fleet ones
+        per_device = False
+
+        usage = "Usage: %s -d directory [-k routing_key...] [-m metric[,metric...]] [--since duration] [--until duration] [--devices]" %(argv[0])
+
+        # Parse the command line arguments
+        i = 1
+        try:
+            while i < len(argv):
+                if argv[i] == '-d':
+                    directory = argv[i + 1]
+                    i += 1
+                elif argv[i] == '-k':
+                    while i + 1 < len(argv) and argv[i + 1][0] != '-':
+                        topics.append(argv[i + 1])
+                        i += 1
+                elif argv[i] == '-m':
+                    patterns = argv[i + 1].split(",")
+                    i += 1
+                elif argv[i] == '--since':
+                    since = parse_duration(argv[i + 1])
+                    i += 1
+                elif argv[i] == '--until':
+                    until = parse_duration(argv[i + 1])
+                    i += 1
+                elif argv[i] == '--devices':
+                    per_device = True
+                else:
+                    raise ValueError("Unknown option: " + argv[i])
+                i += 1
+        except (IndexError, ValueError), ve:
+            print >> sys.stderr, usage
+            print >> sys.stderr, "Please enter proper options, now quitting! " + str(ve)
+            sys.exit(-1)
+
+        if directory is None:
+            print >> sys.stderr, usage
+            print >> sys.stderr, "Error: You must specify the directory the samples were recorded in"
+            sys.exit(-1)
+
+        now = time.time()
+        range_start = now - since if since is not None else float("-inf")
+        range_end = now - until
+
+        # Loaded only now, so that the aggregation can be imported without it
+        from tabulate import tabulate
+
+        segments = list_segments(directory)
+        if topics:
+            segments = dict((routing_key, paths) for routing_key, paths in segments.items() if routing_key in topics)
+
+        fleet = dict()
+        for routing_key in sorted(segments.keys()):
+            aggregates = aggregate_device(segments[routing_key], patterns, range_start, range_end)
+            for name, aggregate in aggregates.items():
+                fleet_aggregate = fleet.get(name)
+                if fleet_aggregate is None:
+                    fleet_aggregate = fleet[name] = MetricAggregate()
+                fleet_aggregate.merge(aggregate)
+
+            if per_device:
+                rows = [aggregates[name].row(name) for name in sorted(aggregates.keys()) if aggregates[name].count > 0]
+                if rows:
+                    print "%s :" %(routing_key)
+                    print tabulate([["Metric", "Samples", "Mean", "Low", "High"]] + rows)
+
+        rows = [fleet[name].row(name) + [fleet[name].devices] for name in sorted(fleet.keys()) if fleet[name].count > 0]
+        print "Fleet of %d device(s) :" %(len(segments))
+        print tabulate([["Metric", "Samples", "Mean", "Low", "High", "Devices"]] + rows)
+
+    except Exception, ee:
+        # Add code here to handle the exception, print an error, and exit gracefully
+        print >> sys.stderr, "Error: An unexpected exception occured: " + str(ee)
+
+
+# Application Entry Point
+# ^^^^^^^^^^^^^^^^^^^^^^^
+if __name__ == "__main__":
+    main(sys.argv)
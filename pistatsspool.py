@@ -0,0 +1,173 @@
+"""
+This file contains the spool used by pistatsd.py to keep the samples taken
+while the message broker is unreachable, until they can be published
+
+The samples are kept in a bounded ring in memory. Once the ring is full, the
+oldest samples are either dropped or spilled to a file, one compact JSON
+document per line, which is bounded as well. The spill file is read back in
+order, oldest first, and is left in place on exit so that the samples it
+holds are published by the next run.
+"""
+
+import collections
+import json
+import os
+import sys
+
+# Number of samples kept in memory, an hour of samples taken every second
+SPOOL_SAMPLES = 3600
+
+# Size in bytes the spill file may grow to
+SPILL_BYTES = 16 * 1024 * 1024
+
+
+class SampleSpool(object):
+    """
+    Queues samples oldest first in a bounded ring, optionally spilling the
+    oldest ones to disk once the ring is full
+    """
+
+    def __init__(self, capacity=SPOOL_SAMPLES, spill_path=None, spill_bytes=SPILL_BYTES):
+        """
+        Create a new SampleSpool object
+
+        :param capacity: (int) The number of samples kept in memory
+        :param spill_path: (str) The file the samples that don't fit in memory
+                           are spilled to, None to drop them. Samples left in
+                           the file by a previous run are queued first
+        :param spill_bytes: (int) The size the spill file may grow to
+        :raises ValueError: if capacity is lower than one
+        :raises IOError: if the spill file couldn't be opened
+        :return: None
+        """
+        if capacity < 1:
+            raise ValueError("The spool must hold at least one sample")
+
+        self.__ring = collections.deque()
+        self.__capacity = capacity
+        self.__spill_bytes = spill_bytes
+        self.__spill = None
+        # Offset of the oldest sample in the spill file, and the number of samples after it
+        self.__read_offset = 0
+        self.__spilled = 0
+        # What the last peek() read, removed by discard()
+        self.__peeked_memory = 0
+        self.__peeked_offset = 0
+        self.__peeked_spilled = 0
+        self.__peeked_corrupt = 0
+
+        # Counters reported when pistatsd.py exits
+        self.dropped_samples = 0
+        self.spilled_samples = 0
+
+        if spill_path is not None:
+            self.__spill = open(spill_path, "a+b")
+            self.__spill.seek(0)
+            self.__spilled = sum(1 for line in self.__spill)
+
+    def __len__(self):
+        return self.__spilled + len(self.__ring)
+
+    def append(self, sample):
+        """
+        Queues a sample, making room for it once the ring is full
+
+        :param sample: (dict) The sample
+        :return: None
+        """
+        if len(self.__ring) >= self.__capacity:
+            oldest = self.__ring.popleft()
+            if not self.__spill_sample(oldest):
+                self.dropped_samples += 1
+        self.__ring.append(sample)
+
+    def peek(self, count):
+        """
+        Returns the oldest samples, without removing them from the spool
+
+        :param count: (int) The most samples returned
+        :return: (list) The samples, oldest first. Call discard() to remove them
+        """
+        samples = []
+        offset = self.__read_offset
+        spilled = 0
+        corrupt = 0
+        if self.__spilled:
+            self.__spill.seek(offset)
+            while spilled < self.__spilled and len(samples) < count:
+                line = self.__spill.readline()
+                offset += len(line)
+                spilled += 1
+                try:
+                    samples.append(json.loads(line))
+                except ValueError:
+                    # A sample only partly written before the previous run ended
+                    corrupt += 1
+        memory = min(count - len(samples), len(self.__ring))
+        for i in range(memory):
+            samples.append(self.__ring[i])
+
+        self.__peeked_memory = memory
+        self.__peeked_offset = offset
+        self.__peeked_spilled = spilled
+        self.__peeked_corrupt = corrupt
+        return samples
+
+    def discard(self):
+        """
+        Removes the samples returned by the last call to peek()
+
+        :return: None
+        """
+        if self.__peeked_spilled:
+            self.__read_offset = self.__peeked_offset
+            self.__spilled -= self.__peeked_spilled
+            self.dropped_samples += self.__peeked_corrupt
+            if self.__spilled == 0:
+                # Every spilled sample was read back, start the file over
+                self.__spill.truncate(0)
+                self.__read_offset = 0
+        for i in range(self.__peeked_memory):
+            self.__ring.popleft()
+        self.__peeked_memory = 0
+        self.__peeked_spilled = 0
+        self.__peeked_corrupt = 0
+
+    def close(self):
+        """
+        Spills the samples still in memory, if spilling, and closes the spill file
+
+        :return: (int) The number of samples that are lost
+        """
+        lost = len(self.__ring)
+        if self.__spill is not None:
+            # Keep only the samples not read back yet, so the next run starts with them
+            self.__spill.seek(self.__read_offset)
+            pending = self.__spill.read()
+            self.__spill.seek(0)
+            self.__spill.truncate(0)
+            self.__spill.write(pending)
+            while self.__ring and self.__spill_sample(self.__ring[0]):
+                self.__ring.popleft()
+            lost = len(self.__ring)
+            self.__spill.close()
+            self.__spill = None
+        self.__ring.clear()
+        return lost
+
+    def __spill_sample(self, sample):
+        if self.__spill is None:
+            return False
+        line = json.dumps(sample, separators=(",", ":")) + "\n"
+        self.__spill.seek(0, os.SEEK_END)
+        if self.__spill.tell() + len(line) > self.__spill_bytes:
+            return False
+        try:
+            self.__spill.write(line)
+            self.__spill.flush()
+        except IOError, error:
+            print >> sys.stderr, "Warning: Could not spill a sample: " + str(error)
+            return False
+        self.__spilled += 1
+        self.spilled_samples += 1
+        return True
@@ -0,0 +1,514 @@
+"""
+This file contains the per-device aggregation store used by pistatsview.py to
+keep the current, maximum and minimum utilization values of every Raspberry Pi
+it subscribes to, keyed by the routing key the Pi publishes with
+
+Besides the values since the viewer started, the CPU, core and interface byte
+rates can be summarized over rolling windows, see pistatswindow.py. The stores
+of the pipeline workers only log the values each sample adds to the windows,
+and the windows are kept by the viewer's own store, which merges the logs, so
+that the devices the workers send back stay small. The store keeps the devices
+whose windows hold values in a heap ordered by when they are due for expiry,
+so that expiring the windows only touches the devices that stopped reporting.
+"""
+
+import heapq
+import sys
+from array import array
+
+from pistatscommon import CPU_STATES, NET_COUNTERS, monotonic
+from pistatswindow import RollingWindow, WINDOW_SLOTS
+
+# Layout of the array backing a single metric: current, max, min
+CURRENT = 0
+MAX = 1
+MIN = 2
+METRIC_WIDTH = 3
+
+# Offsets of the counter metrics inside an interface record, and the counters
+# that are always displayed
+IFACE_OFFSETS = dict((counter, i * METRIC_WIDTH) for i, counter in enumerate(NET_COUNTERS))
+IFACE_MODES = ("rx", "tx")
+
+
+def new_metric_record(modes=1):
+    """
+    Returns a preallocated array holding the current/max/min triple for
+    one or more metrics
+
+    :param modes: (int) The number of metrics stored in the record
+    :return: (array.array) An array of doubles, initialized so that the
+             first update sets both the max and the min
+    """
+    return array("d", (0.0, 0.0, float("inf")) * modes)
+
+
+def update_metric(record, offset, value):
+    """
+    Stores a new value in a metric record and updates its max and min
+
+    :param record: (array.array) The record returned by new_metric_record()
+    :param offset: (int) The offset of the metric inside the record
+    :param value: (float) The newly received value
+    :return: None
+    """
+    record[offset + CURRENT] = value
+    if value > record[offset + MAX]:
+        record[offset + MAX] = value
+    if value < record[offset + MIN]:
+        record[offset + MIN] = value
+
+
+def widen_metric(record, offset, high, low):
+    """
+    Widens the max and min of a metric to the extremes of a summarized period
+
+    :param record: (array.array) The record returned by new_metric_record()
+    :param offset: (int) The offset of the metric inside the record
+    :param high: (float) The highest value of the period
+    :param low: (float) The lowest value of the period
+    :return: None
+    """
+    if high > record[offset + MAX]:
+        record[offset + MAX] = high
+    if low < record[offset + MIN]:
+        record[offset + MIN] = low
+
+
+class DeviceStats(object):
+    """
+    Holds the aggregated CPU and network statistics of a single device
+    """
+
+    __slots__ = ("routing_key", "cpu", "cores", "cpu_states", "net", "updates", "spans", "windows", "window_log",
+                 "windows_time", "__window_keys", "__window_shape")
+
+    def __init__(self, routing_key, spans=(), log_windows=False):
+        """
+        Create a new, empty DeviceStats object
+
+        :param routing_key: (str) The routing key identifying the device
+        :param spans: (tuple) The rolling windows to keep for each metric, as
+                      (label, seconds) pairs. None are kept if empty
+        :param log_windows: (bool) Whether the values added to the windows are
+                            logged in window_log rather than added, for the
+                            windows to be kept by another store
+        :return: None
+        """
+        self.routing_key = routing_key
+        self.cpu = new_metric_record()
+        # One metric per core, and per cpu state in CPU_STATES order. Both
+        # are only allocated once the device reports them
+        self.cores = None
+        self.cpu_states = None
+        self.net = dict()
+        self.updates = 0
+        # The rolling windows of each metric, in spans order, keyed by the
+        # metric type and name, such as ('CPU', 'CPU0') or ('NET', 'eth0 rx')
+        self.spans = spans
+        self.windows = dict()
+        # The monotonic time of the last value added to the windows, None once they are all empty
+        self.windows_time = None
+        # The (time, keys, values) added to the windows since the log was last emptied, None unless logging
+        self.window_log = [] if log_windows else None
+        # The window keys of the current values, in the order of window_values(), and the number of cores and
+        # interfaces they were listed for
+        self.__window_keys = ()
+        self.__window_shape = None
+
+    def update_cpu(self, value):
+        """
+        Stores a new CPU utilization value
+
+        :param value: (float) The CPU utilization received from the device
+        :return: None
+        """
+        update_metric(self.cpu, 0, value)
+        self.updates += 1
+
+    def update_cores(self, values):
+        """
+        Stores new utilization values for each core
+
+        :param values: (list) The utilization of each core, in core order
+        :return: None
+        """
+        if self.cores is None or len(self.cores) != len(values) * METRIC_WIDTH:
+            self.cores = new_metric_record(len(values))
+        for i in range(len(values)):
+            update_metric(self.cores, i * METRIC_WIDTH, values[i])
+
+    def update_cpu_states(self, states):
+        """
+        Stores the new share of time spent in each cpu state
+
+        :param states: (dict) The share of time of each state in CPU_STATES
+        :return: None
+        """
+        if self.cpu_states is None:
+            self.cpu_states = new_metric_record(len(CPU_STATES))
+        for i in range(len(CPU_STATES)):
+            update_metric(self.cpu_states, i * METRIC_WIDTH, states.get(CPU_STATES[i], 0.0))
+
+    def update_iface(self, iface, counters):
+        """
+        Stores new counter rates for a network interface. The counters that
+        are missing keep their last value
+
+        :param iface: (str) The name of the network interface
+        :param counters: (dict) The rate per second of the counters, such as
+                         'rx' and 'tx' for the bytes received and transmitted.
+                         Unknown counters are ignored
+        :return: None
+        """
+        record = self.net.get(iface)
+        if record is None:
+            record = self.net[iface] = new_metric_record(len(NET_COUNTERS))
+        for counter, value in counters.items():
+            offset = IFACE_OFFSETS.get(counter)
+            if offset is not None:
+                update_metric(record, offset, value)
+
+    def update_extremes(self, high, low):
+        """
+        Widens the max and min of the CPU, core and interface metrics to the
+        extremes of a summary sample, once its mean values were stored
+
+        :param high: (dict) The highest values of the period, with the same
+                     'cpu', 'cores' and 'net' fields as a sample
+        :param low: (dict) The lowest values of the period
+        :return: None
+        """
+        widen_metric(self.cpu, 0, high["cpu"], low["cpu"])
+        cores = high.get("cores")
+        if cores is not None and self.cores is not None and len(self.cores) == len(cores) * METRIC_WIDTH:
+            for i in range(len(cores)):
+                widen_metric(self.cores, i * METRIC_WIDTH, cores[i], low["cores"][i])
+        for iface, counters in high.get("net", {}).items():
+            record = self.net.get(iface)
+            if record is None:
+                continue
+            for counter, value in counters.items():
+                offset = IFACE_OFFSETS.get(counter)
+                if offset is not None:
+                    widen_metric(record, offset, value, low["net"][iface][counter])
+
+    def update_windows(self, now):
+        """
+        Adds the current CPU, core and interface byte rates to their rolling
+        windows, or to the window log
+
+        :param now: (float) The monotonic time the values were received at
+        :return: None
+        """
+        if not self.spans:
+            return
+        values = self.window_values()
+        keys = self.__window_keys
+        shape = (len(self.cores) if self.cores is not None else 0, len(self.net))
+        if shape != self.__window_shape:
+            # A core or an interface came or went, the keys are only listed again then
+            keys = self.__window_keys = self.__list_window_keys()
+            self.__window_shape = shape
+        if self.window_log is not None:
+            self.window_log.append((now, keys, values))
+        else:
+            self.add_to_windows(now, keys, values)
+
+    def window_values(self):
+        """
+        Returns the current values kept in rolling windows
+
+        :return: (array.array) The CPU, then each core, then the rx and tx byte rates of each interface
+        """
+        values = array("d", (self.cpu[CURRENT],))
+        if self.cores is not None:
+            values.extend(self.cores[CURRENT::METRIC_WIDTH])
+        rx = IFACE_OFFSETS["rx"] + CURRENT
+        tx = IFACE_OFFSETS["tx"] + CURRENT
+        for record in self.net.itervalues():
+            values.append(record[rx])
+            values.append(record[tx])
+        return values
+
+    def add_to_windows(self, now, keys, values):
+        """
+        Adds values to the rolling windows of their metrics
+
+        :param now: (float) The monotonic time the values were received at
+        :param keys: (tuple) The window key of each value, such as ('CPU', 'CPU0') or ('NET', 'eth0 rx')
+        :param values: (array.array) The values, as returned by window_values()
+        :return: None
+        """
+        all_windows = self.windows
+        for i in range(len(keys)):
+            windows = all_windows.get(keys[i])
+            if windows is None:
+                windows = all_windows[keys[i]] = [RollingWindow(span) for label, span in self.spans]
+            value = values[i]
+            for window in windows:
+                window.add(value, now)
+        self.windows_time = now
+
+    def expire_windows(self, now):
+        """
+        Drops the values that fell out of the rolling windows, for a device
+        that stopped reporting
+
+        :param now: (float) The monotonic time
+        :return: (bool) Whether any value was dropped
+        """
+        expired = False
+        empty = True
+        for windows in self.windows.itervalues():
+            for window in windows:
+                if window.expire(now):
+                    expired = True
+                if len(window):
+                    empty = False
+        if empty:
+            # Nothing is left to expire until the next value
+            self.windows_time = None
+        return expired
+
+    def memory_usage(self):
+        """
+        Returns the number of bytes used by this device's records
+
+        :return: (int) The approximate heap size of the device in bytes
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self.cpu) + sys.getsizeof(self.net) + sys.getsizeof(self.windows)
+        if self.cores is not None:
+            size += sys.getsizeof(self.cores)
+        if self.cpu_states is not None:
+            size += sys.getsizeof(self.cpu_states)
+        for iface, record in self.net.items():
+            size += sys.getsizeof(iface) + sys.getsizeof(record)
+        for key, windows in self.windows.items():
+            size += sys.getsizeof(key) + sys.getsizeof(windows) + sum(window.memory_usage() for window in windows)
+        return size
+
+    def __list_window_keys(self):
+        keys = [("CPU", "all")]
+        if self.cores is not None:
+            keys.extend(("CPU", "CPU%d" %(core)) for core in range(len(self.cores) / METRIC_WIDTH))
+        for iface in self.net.iterkeys():
+            keys.append(("NET", iface + " rx"))
+            keys.append(("NET", iface + " tx"))
+        return tuple(keys)
+
+
+class StatsStore(object):
+    """
+    Maps routing keys to their DeviceStats so that the statistics of
+    different devices are never mixed together
+    """
+
+    def __init__(self, spans=(), recorder=None, log_windows=False):
+        """
+        Create a new, empty StatsStore object
+
+        :param spans: (tuple) The rolling windows to keep for each metric of
+                      every device, as (label, seconds) pairs
+        :param recorder: (pistatsrecord.SegmentRecorder) Records the values of
+                         every device after each sample, None to record nothing
+        :param log_windows: (bool) Whether the devices only log the values
+                            added to their windows, for the store they are
+                            merged into to keep the windows
+        :return: None
+        """
+        self.devices = dict()
+        self.spans = spans
+        self.recorder = recorder
+        self.log_windows = log_windows
+
+        # The windows of a device that reported less than a slot of the shortest window ago are at most a slot
+        # behind, they are only expired once the device has been silent that long
+        self.__slot_width = min(span for label, span in spans) / WINDOW_SLOTS if spans else None
+
+        # The (due time, routing key) of the devices whose windows hold values, and the routing keys in it
+        self.__expiry = []
+        self.__scheduled = set()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def device(self, routing_key):
+        """
+        Returns the statistics of a device, creating them on first use
+
+        :param routing_key: (str) The routing key identifying the device
+        :return: (DeviceStats) The statistics stored for the device
+        """
+        device = self.devices.get(routing_key)
+        if device is None:
+            device = self.devices[routing_key] = DeviceStats(routing_key, self.spans, self.log_windows)
+        return device
+
+    def merge(self, device):
+        """
+        Replaces the current, maximum and minimum values of a device with the
+        ones aggregated elsewhere, e.g. by a worker process, and adds the
+        values it logged to the rolling windows kept here
+
+        :param device: (DeviceStats) The statistics of the device, aggregated
+                       by a store logging its windows
+        :return: (DeviceStats) The statistics stored for the device
+        """
+        merged = self.device(device.routing_key)
+        merged.cpu = device.cpu
+        merged.cores = device.cores
+        merged.cpu_states = device.cpu_states
+        merged.net = device.net
+        merged.updates = device.updates
+        if device.window_log and merged.spans:
+            for now, keys, values in device.window_log:
+                merged.add_to_windows(now, keys, values)
+            self.__schedule(merged)
+        return merged
+
+    def expire_windows(self, now):
+        """
+        Drops the values that fell out of the rolling windows of the devices
+        that didn't report since the shortest window moved on
+
+        :param now: (float) The monotonic time
+        :return: (list) The routing keys of the devices whose windows changed
+        """
+        expiry = self.__expiry
+        slot_width = self.__slot_width
+        expired = []
+        while expiry and expiry[0][0] <= now:
+            routing_key = expiry[0][1]
+            device = self.devices[routing_key]
+            if device.windows_time is None:
+                # Nothing is left to expire until the next value
+                heapq.heappop(expiry)
+                self.__scheduled.discard(routing_key)
+            elif now - device.windows_time < slot_width:
+                # The device reported since it was scheduled
+                heapq.heapreplace(expiry, (device.windows_time + slot_width, routing_key))
+            else:
+                if device.expire_windows(now):
+                    expired.append(routing_key)
+                heapq.heapreplace(expiry, (now + slot_width, routing_key))
+        return expired
+
+    def aggregate(self, routing_key, samples, now=None):
+        """
+        Evaluates decoded samples for max/min status and stores their current values
+
+        :param routing_key: (str) The routing key identifying the device that sent the samples
+        :param samples: (list) The samples, as returned by pistatscodec.StatsDecoder.decode()
+        :param now: (float) The monotonic time the samples were received at, None for now
+        :return: (DeviceStats) The device that was updated, None if no sample was well formed
+        """
+        if now is None and self.spans:
+            now = monotonic()
+        device = None
+        for stats in samples:
+            # Check that the sample appears to be well formed
+            if not isinstance(stats, dict):
+                print "Warning: ignoring sample: not a JSON object"
+
+            elif "cpu" not in stats:
+                print "Warning: ignoring message: missing 'cpu' field"
+
+            elif "net" not in stats:
+                print "Warning: ignoring message: missing 'net' field"
+
+            else:
+                # Sample appears well formed, look up the device that sent it
+                device = self.device(routing_key)
+
+                # Evaluate CPU field for max/min status and store the current value
+                device.update_cpu(stats["cpu"])
+
+                # Evaluate the per core and per cpu state fields, if the device reports them
+                if "cores" in stats:
+                    device.update_cores(stats["cores"])
+                if "cpu_states" in stats:
+                    device.update_cpu_states(stats["cpu_states"])
+
+                # Evaluate NET field for max/min status. Delta samples only hold the counters that
+                # changed, the missing ones keep their last value
+                delta = stats.get("delta", False)
+                for iface in stats["net"].keys():
+                    # Check if the iface key is well formed
+                    if not delta and "rx" not in stats["net"][iface]:
+                        print "Warning: ignoring interface: " + iface + ": no 'rx' field"
+                        continue
+
+                    elif not delta and "tx" not in stats["net"][iface]:
+                        print "Warning: ignoring interface: " + iface + ": no 'tx' field"
+                        continue
+
+                    else:
+                        # Evaluate max and min for each iface mode
+                        device.update_iface(iface, stats["net"][iface])
+
+                # Summary samples carry the mean of a period as their values, widen the max and min to its extremes
+                summary = stats.get("summary")
+                if summary is not None:
+                    try:
+                        device.update_extremes(summary["max"], summary["min"])
+                    except (KeyError, IndexError, TypeError):
+                        print "Warning: ignoring summary: malformed 'max' or 'min' field"
+
+                # Add the new current values to the rolling windows, and to the recording
+                device.update_windows(now)
+                self.__schedule(device)
+                if self.recorder is not None:
+                    self.recorder.record(device)
+        return device
+
+    def memory_usage(self):
+        """
+        Returns the number of bytes used by all devices in the store
+
+        :return: (int) The approximate heap size of the store in bytes
+        """
+        size = sys.getsizeof(self.devices)
+        for routing_key, device in self.devices.items():
+            size += sys.getsizeof(routing_key) + device.memory_usage()
+        return size
+
+    def __schedule(self, device):
+        # Schedules the expiry of the windows a device added values to, unless it already is. A device that reports
+        # again before it is due is scheduled again when due, rather than moved in the heap at every sample
+        if device.windows_time is not None and device.routing_key not in self.__scheduled:
+            self.__scheduled.add(device.routing_key)
+            heapq.heappush(self.__expiry, (device.windows_time + self.__slot_width, device.routing_key))
+
+
+def handle_msg(decoder, store, routing_key, content_type, msg, metrics=None):
+    """
+    Decodes a message and aggregates its samples into a store
+
+    :param decoder: (pistatscodec.StatsDecoder) Decodes the message
+    :param store: (pistatsstore.StatsStore) Stores the aggregated samples
+    :param routing_key: (str) The routing key the message was published with
+    :param content_type: (str) The content type of the message, None for JSON
+    :param msg: (str) The message body
+    :param metrics: (pistatsmetrics.Metrics) Times decoding and aggregating
+                    the message, None to time nothing
+    :return: (pistatsstore.DeviceStats) The device that was updated, None if
+             the message held no well formed sample
+    """
+    if metrics is not None:
+        start = monotonic()
+    try:
+        samples = decoder.decode(routing_key, content_type, msg)
+    except ValueError, ve:
+        # Thrown by decoder.decode() if it couldn't parse the message
+        print "Warning: Discarding Message: received message couldn't be parsed: " + str(ve)
+        return None
+    if metrics is None:
+        return store.aggregate(routing_key, samples)
+
+    decoded = monotonic()
+    device = store.aggregate(routing_key, samples, decoded)
+    metrics.observe("decode_seconds", decoded - start)
+    metrics.observe("aggregate_seconds", monotonic() - decoded)
+    metrics.count("samples_total", len(samples))
+    return device
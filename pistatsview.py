@@ -1,15 +1,58 @@
 #!/usr/bin/python
+"""
+This file contains pistatsview.py which subscribes to the stats published by
+pistatsd.py on a RabbitMQ exchange, aggregates them per device and displays
+them
+
+The decoding, aggregation, recording, alerting and rendering live in their own
+modules, this file only wires them to the broker from the command line. The
+pika and tabulate modules, and the modules of the recording, alerting,
+measuring and worker pool, are loaded once they are needed, so that importing
+this file, or running it --headless, doesn't load them.
+"""
 
-import json
-import pika
-import pika.channel
-import pika.exceptions
 import signal
 import sys
-from tabulate import tabulate
+import time
+from pistatsstore import StatsStore, handle_msg
+from pistatscommon import parse_duration, parse_broker, is_pattern, monotonic, EXCHANGE_TYPES, EXCHANGE_NAMES, \
+    SHARED_EXCHANGE_TYPE, SHARED_EXCHANGE_PLUGIN, SHARED_WEIGHT, SAMPLED_HEADER
+from pistatscodec import StatsDecoder
+from pistatsack import BulkAcknowledger, PREFETCH_COUNT, ACK_EVERY, ACK_TIME
+from pistatswindow import WINDOWS
+from pistatsrender import StatsRenderScheduler
 
-# Create a data structure for holding the maximum and minimum values
-stats_history = {"cpu": {"max":0.0, "min": float("inf"), "current": 0.0}, "net": dict()}
+# Number of seconds between two merges of the devices aggregated by the pipeline workers
+MERGE_INTERVAL = 0.1
+
+# Create a data structure for holding the maximum and minimum values of every
+# device, keyed by the routing key the device publishes with
+stats_store = StatsStore()
+
+# Decodes the messages of every supported format
+stats_decoder = StatsDecoder()
+
+# The scheduler that displays the stats, created once connected to the broker, None if running headless
+render_scheduler = None
+
+# The worker pool decoding and aggregating the messages, None to handle them on the consumer
+pipeline = None
+
+# The connection, or the IOLoop, whose event loop drives the pipeline merge timer
+event_loop = None
+
+# Acknowledges the messages of the blocking connection in bulk, None if the broker doesn't wait for acknowledgements
+acknowledger = None
+
+# The consumer of several brokers, whose acknowledgers acknowledge the messages handled by the workers
+fan_in = None
+
+# Checks the updated devices against the alert rules, None if no rules were given
+alert_engine = None
+
+# The measures of the viewer itself, None unless they are reported, and the number of seconds between two stats lines
+metrics = None
+stats_interval = None
 
 class StatsClientChannelHelper:
     """
@@ -25,6 +68,8 @@ class StatsClientChannelHelper:
         :return: None
         """
 
+        import pika.channel
+
         if isinstance(channel, pika.channel.Channel):
             self.__channel = channel
 
@@ -43,151 +88,322 @@ class StatsClientChannelHelper:
         # Attempt to gracefully stop pika's event loop whenever a SIGINT is received
         self.__channel.stop_consuming()
 
-def show_stats_history(stats_history, routing_key):
+def on_new_msg(channel, delivery_info, msg_properties, msg):
     """
-    Displays stats history invoked by the event handler
+    Event handler that processes new messages from the message broker
 
-    :param stats_history: Data structure that holds the latest minimum and maximum values
+    :param channel: (pika.Channel) The channel object this message was received from
+    :param delivery_info: (pika.spec.Basic.Deliver) Delivery information related to the message just received
+    :param msg_properties: (pika.spec.BasicProperties) Additional metadata about the message just received
+    :param msg: The message received from the server
     :return None
-
-    NOTE: We use package called tabulate to display the stats, Following url gives the source
-    url: https://pypi.python.org/pypi/tabulate
     """
-    # Print the routing key whose message gets printed below:
-    print "%s :" %(routing_key)
 
-    cpu_table = [["Type", "Current", "High", "Low"], ["CPU", stats_history["cpu"]["current"], stats_history["cpu"]["max"], stats_history["cpu"]["min"]]]
-
-    print tabulate(cpu_table)
+    # Count the message, and measure the time since its oldest sample was taken, if the publisher sent it
+    if metrics is not None:
+        metrics.count("messages_total")
+        metrics.count("bytes_total", len(msg))
+        headers = msg_properties.headers
+        if headers and SAMPLED_HEADER in headers:
+            try:
+                metrics.observe("end_to_end_seconds", max(0.0, time.time() - float(headers[SAMPLED_HEADER])))
+            except ValueError:
+                pass
+
+    # Hand the message over to the worker that owns its device, if running the pipeline. The message is only
+    # acknowledged once the results of the worker were merged, see merge_pipeline_results()
+    if pipeline is not None:
+        channel_acknowledger = fan_in.acknowledger_of(channel) if fan_in is not None else acknowledger
+        tag = (channel_acknowledger, delivery_info.delivery_tag) if channel_acknowledger is not None else None
+        pipeline.submit(delivery_info.routing_key, msg_properties.content_type, msg, tag)
+        return
+
+    # Parse the message into a list of samples, according to its content type, and aggregate them
+    device = handle_msg(stats_decoder, stats_store, delivery_info.routing_key, msg_properties.content_type, msg,
+                        metrics)
+
+    if device is not None:
+        # Schedule the max, min and current stats value to be printed to stdout
+        if render_scheduler is not None:
+            render_scheduler.mark_dirty(device.routing_key)
+        if alert_engine is not None:
+            alert_engine.evaluate(device)
+
+    # The message was handled, acknowledge it along with the previous ones once they are due
+    if acknowledger is not None:
+        acknowledger.ack(delivery_info.delivery_tag)
+
+def merge_devices(devices):
+    """
+    Merges the devices aggregated by the workers into the displayed stats, then acknowledges the messages the
+    workers handled
 
-    net_table = [["Type", "Interface", "Tx/Rx", "Current", "High", "Low"]]
-    for iface in stats_history["net"].keys():
-        for iface_mode in ("rx", "tx"):
-            net_table.append(["NET", iface, iface_mode, stats_history["net"][iface][iface_mode]["current"], stats_history["net"][iface][iface_mode]["max"], stats_history["net"][iface][iface_mode]["min"]])
+    :param devices: (list) The pistatsstore.DeviceStats returned by the pipeline
+    :return None
+    """
+    for device in devices:
+        device = stats_store.merge(device)
+        if render_scheduler is not None:
+            render_scheduler.mark_dirty(device.routing_key)
+        if alert_engine is not None:
+            alert_engine.evaluate(device)
+    for channel_acknowledger, delivery_tag in pipeline.handled():
+        channel_acknowledger.ack(delivery_tag)
+
+def merge_pipeline_results():
+    """
+    Timer callback that hands the messages waiting for a worker over, and merges the devices aggregated by the
+    workers into the displayed stats
 
-    print tabulate(net_table)
+    :return None
+    """
+    pipeline.flush()
+    merge_devices(pipeline.collect())
+    event_loop.add_timeout(MERGE_INTERVAL, merge_pipeline_results)
 
-def on_new_msg(channel, delivery_info, msg_properties, msg):
+def print_stats():
     """
-    Event handler that processes new messages from the message broker
+    Timer callback that prints the measures of the viewer since the last stats line
 
-    :param channel: (pika.Channel) The channel object this message was received from
-    :param delivery_info: (pika.spec.Basic.Deliver) Delivery information related to the message just received
-    :param msg_properties: (pika.spec.BasicProperties) Additional metadata about the message just received
-    :param msg: The message received from the server
     :return None
     """
+    print "Stats: " + metrics.stats_line(monotonic())
+    sys.stdout.flush()
+    event_loop.add_timeout(stats_interval, print_stats)
 
-    # Parse the JSON message into a dict
-    try:
-        stats = json.loads(msg)
+def open_renderer(connection, options, on_quit):
+    """
+    Creates the scheduler that displays the stats, and starts it
+
+    :param connection: (pika.BlockingConnection) The connection, or the IOLoop, whose event loop drives the redraws
+    :param options: (dict) The options returned by parse_args(): the refresh interval, whether nothing is displayed
+                    (headless), whether the full-screen dashboard is displayed instead of the tables, and whether it
+                    displays the recent CPU utilization of every device (sparklines)
+    :param on_quit: (callable) Stops consuming, when the dashboard is asked to quit
+    :return: (pistatsrender.StatsRenderScheduler) The scheduler, or the pistatsdash.DashboardRenderer, None if headless
+    """
+    if options["headless"]:
+        return None
+    if options["dashboard"]:
+        from pistatsdash import DashboardRenderer
+        renderer = DashboardRenderer(connection, options["refresh"], stats_store, metrics, options["sparklines"],
+                                     on_quit)
+    else:
+        renderer = StatsRenderScheduler(connection, options["refresh"], stats_store, metrics)
+    renderer.start()
+    return renderer
+
+def parse_args(argv):
+    """
+    Parses the command line arguments, quitting with the usage if they are not proper
 
-        # Check that the message appears to be well formed
-        if "cpu" not in stats:
-            print "Warning: ignoring message: missing 'cpu' field"
+    :param argv: (list) The command line arguments, the program name first
+    :return: (dict) The options of the viewer, keyed by name
+    """
+    # The message broker hostnames or IP addresses
+    hosts = []
 
-        elif "net" not in stats:
-            print "Warning: ignoring message: missing 'net' field"
+    # The virtual host to connect to
+    vhost = "/" # Defaults to the root virtual host
 
-        else:
-            # Message appears well formed
+    # The credentials to be used
+    credentials = None
 
-            # Evaluate CPU field for max/min status
-            if stats["cpu"] > stats_history["cpu"]["max"]:
-                stats_history["cpu"]["max"] = stats["cpu"]
-            if stats["cpu"] < stats_history["cpu"]["min"]:
-                stats_history["cpu"]["min"] = stats["cpu"]
+    # The topics (list of topic) to subscribe to
+    topics = []
 
-            # Store the current CPU value
-            stats_history["cpu"]["current"] = stats["cpu"]
+    # The number of seconds between two redraws of the stats
+    refresh = 1.0 # Defaults to one redraw per second
 
-            # Evaluate NET field for max/min status
-            for iface in stats["net"].keys():
-                # Has the current iface been seen before?
-                if iface not in stats_history["net"]:
-                    # No, create a new entry for the iface
-                    stats_history["net"][iface] = {"rx":{"max":0.0, "min":float("inf"), "current":0.0}, "tx": {"max":0.0, "min":float("inf"), "current":0.0}}
+    # Whether the stats are aggregated without being displayed, when only recording, alerting or measuring
+    headless = False
 
-                # Check if the iface key is well formed
-                if "rx" not in stats["net"][iface]:
-                    print "Warning: ignoring interface: " + iface + ": no 'rx' field"
-                    continue
+    # Whether the stats are displayed on a full-screen dashboard instead of tables, and with sparklines
+    dashboard = False
+    sparklines = False
 
-                elif "tx" not in stats["net"][iface]:
-                    print "Warning: ignoring interface: " + iface + ": no 'tx' field"
-                    continue
+    # Whether the messages are consumed on pika's asynchronous event loop
+    async_mode = False # Defaults to a blocking connection, unless several brokers are given
 
-                else:
-                    # Evaluate max and min for each iface mode
-                    for iface_mode in ("rx", "tx"):
-                        # Store new global max
-                        if stats["net"][iface][iface_mode] > stats_history["net"][iface][iface_mode]["max"]:
-                            stats_history["net"][iface][iface_mode]["max"] = stats["net"][iface][iface_mode]
-                        # Store new global min
-                        if stats["net"][iface][iface_mode] < stats_history["net"][iface][iface_mode]["min"]:
-                            stats_history["net"][iface][iface_mode]["min"] = stats["net"][iface][iface_mode]
+    # The number of worker processes decoding and aggregating the messages
+    workers = 0 # Defaults to handling the messages on the consumer
 
-                        # Store the current value
-                        stats_history["net"][iface][iface_mode]["current"] = stats["net"][iface][iface_mode]
+    # The number of unacknowledged messages the broker may send, and how the messages are acknowledged
+    prefetch = None # Defaults to no acknowledgements on a blocking connection, and to PREFETCH_COUNT otherwise
+    ack_every = ACK_EVERY
+    ack_time = ACK_TIME
 
-            # Print the max, min and current stats value to stdout
-            show_stats_history(stats_history, delivery_info.routing_key)
+    # The rolling windows the CPU, core and interface byte rates are summarized over
+    spans = WINDOWS # Defaults to the last minute, 5 minutes and hour
 
-    except ValueError, ve:
-        # Thrown by json.loads() if it couldn't parse a JSON object
-        print "Warning: Discarding Message: received message couldn't be parsed"
+    # The directory every sample is recorded in
+    record_directory = None # Defaults to recording nothing
 
-# Application Entry Point
-# ^^^^^^^^^^^^^^^^^^^^^^^
+    # The file holding the alert rules, and where the alerts are sent
+    rules_path = None # Defaults to no alerting
+    alert_targets = ["stdout"]
 
-# Guard try clause to catch any errors that aren't expected
-try:
-    # The message broker hostname or IP address
-    host = None
+    # The number of seconds between two stats lines, and the local port serving the measures of the viewer in the
+    # Prometheus text format
+    stats_interval = None # Defaults to not printing them
+    metrics_port = None # Defaults to not serving them
 
-    # The virtual host to connect to
-    vhost = "/" # Defaults to the root virtual host
+    # The type of the exchange to bind to, and its name
+    exchange_type = "direct"
+    exchange = None # Defaults to the name used for the exchange type
 
-    # The credentials to be used
-    credentials = None
+    # The name of the exchange splitting the devices between the viewers given the same name
+    share_group = None # Defaults to receiving every message
 
-    # The topics (list of topic) to subscribe to
-    topics = []
+    usage = "Usage: %s -b message_broker[,message_broker...] [-p virtual_host] [-c login:password] [--refresh interval] [--headless] [--dashboard] [--sparklines] [--async] [--workers count] [--prefetch count] [--ack-every count] [--ack-time interval] [--windows interval[,interval...]|none] [--record directory] [--exchange-type direct|topic] [--exchange name] [--share-group name] [--rules file] [--alert-to stdout|file|url[,...]] [--stats interval] [--metrics-port port] -k routing_key" %(argv[0])
 
     # Parse the command line arguments
-    if len(sys.argv[1:]) < 1:
-        print >> sys.stderr, "Usage: %s -b message_broker [-p virtual_host] [-c login:password] -k routing_key" %(sys.argv[0])
+    if len(argv[1:]) < 1:
+        print >> sys.stderr, usage
         sys.exit(-1)
 
-    last_argv = sys.argv[len(sys.argv) - 1]
-    for i in range(1, (len(sys.argv[1:]) + 1)):
-        if sys.argv[i] == '-b':
-            if sys.argv[i + 1][0] == '-' if not ((i + 1) >= len(sys.argv)) else True:
-                print >> sys.stderr, "Usage: %s -b message_broker [-p virtual_host] [-c login:password] -k routing_key" %(sys.argv[0])
+    last_argv = argv[len(argv) - 1]
+    for i in range(1, (len(argv[1:]) + 1)):
+        if argv[i] == '-b':
+            if argv[i + 1][0] == '-' if not ((i + 1) >= len(argv)) else True:
+                print >> sys.stderr, usage
                 print >> sys.stderr, "Please enter proper hostname or IP address of the message broker, now quitting!"
                 sys.exit(-1)
-            host = sys.argv[i + 1]
-            # print host
-        elif sys.argv[i] == '-p':
-            if sys.argv[i + 1][0] == '-' if not ((i + 1) >= len(sys.argv)) else True:
-                print >> sys.stderr, "Usage: %s -b message_broker [-p virtual_host] [-c login:password] -k routing_key" %(sys.argv[0])
+            hosts.extend(argv[i + 1].split(','))
+            # print hosts
+        elif argv[i] == '-p':
+            if argv[i + 1][0] == '-' if not ((i + 1) >= len(argv)) else True:
+                print >> sys.stderr, usage
                 print >> sys.stderr, "Please enter a proper virtual host, now quitting!"
                 sys.exit(-1)
-            vhost = sys.argv[i + 1]
+            vhost = argv[i + 1]
             # print vhost
-        elif sys.argv[i] == '-c':
-            if sys.argv[i + 1][0] == '-' or (not sys.argv[i + 1].count(':') == 1) if not ((i + 1) >= len(sys.argv)) else True:
-                print >> sys.stderr, "Usage: %s -b message_broker [-p virtual_host] [-c login:password] -k routing_key" %(sys.argv[0])
+        elif argv[i] == '-c':
+            if argv[i + 1][0] == '-' or (not argv[i + 1].count(':') == 1) if not ((i + 1) >= len(argv)) else True:
+                print >> sys.stderr, usage
                 print >> sys.stderr, "Please enter proper credentials in the form 'username:password', now quitting!"
                 sys.exit(-1)
-            credentials = sys.argv[i + 1]
+            credentials = argv[i + 1]
             # print credentials
-        elif sys.argv[i] == '-k':
-            if sys.argv[i + 1][0] == '-' if not ((i + 1) >= len(sys.argv)) else True:
-                print >> sys.stderr, "Usage: %s -b message_broker [-p virtual_host] [-c login:password] -k routing_key" %(sys.argv[0])
+        elif argv[i] == '--async':
+            async_mode = True
+        elif argv[i] == '--headless':
+            headless = True
+        elif argv[i] == '--dashboard':
+            dashboard = True
+        elif argv[i] == '--sparklines':
+            sparklines = True
+        elif argv[i] == '--refresh':
+            try:
+                refresh = parse_duration(argv[i + 1])
+            except (IndexError, ValueError):
+                print >> sys.stderr, usage
+                print >> sys.stderr, "Please enter a proper refresh interval such as '1s' or '500ms', now quitting!"
+                sys.exit(-1)
+        elif argv[i] == '--workers':
+            try:
+                workers = int(argv[i + 1])
+                if workers < 0:
+                    raise ValueError(workers)
+            except (IndexError, ValueError):
+                print >> sys.stderr, usage
+                print >> sys.stderr, "Please enter a proper number of workers, now quitting!"
+                sys.exit(-1)
+        elif argv[i] == '--prefetch':
+            try:
+                prefetch = int(argv[i + 1])
+                if prefetch < 1:
+                    raise ValueError(prefetch)
+            except (IndexError, ValueError):
+                print >> sys.stderr, usage
+                print >> sys.stderr, "Please enter a proper prefetch count, now quitting!"
+                sys.exit(-1)
+        elif argv[i] == '--ack-every':
+            try:
+                ack_every = int(argv[i + 1])
+                if ack_every < 1:
+                    raise ValueError(ack_every)
+            except (IndexError, ValueError):
+                print >> sys.stderr, usage
+                print >> sys.stderr, "Please enter a proper number of messages to acknowledge at once, now quitting!"
+                sys.exit(-1)
+        elif argv[i] == '--ack-time':
+            try:
+                ack_time = parse_duration(argv[i + 1])
+            except (IndexError, ValueError):
+                print >> sys.stderr, usage
+                print >> sys.stderr, "Please enter a proper acknowledgement interval such as '100ms', now quitting!"
+                sys.exit(-1)
+        elif argv[i] == '--windows':
+            try:
+                if argv[i + 1] == 'none':
+                    spans = ()
+                else:
+                    spans = tuple((label, parse_duration(label)) for label in argv[i + 1].split(','))
+                    if min(span for label, span in spans) <= 0:
+                        raise ValueError(argv[i + 1])
+            except (IndexError, ValueError):
+                print >> sys.stderr, usage
+                print >> sys.stderr, "Please enter proper windows such as '1m,5m,1h' or 'none', now quitting!"
+                sys.exit(-1)
+        elif argv[i] == '--record':
+            if argv[i + 1][0] == '-' if not ((i + 1) >= len(argv)) else True:
+                print >> sys.stderr, usage
+                print >> sys.stderr, "Please enter a proper directory to record the samples in, now quitting!"
+                sys.exit(-1)
+            record_directory = argv[i + 1]
+        elif argv[i] == '--exchange-type':
+            if argv[i + 1] not in EXCHANGE_TYPES if not ((i + 1) >= len(argv)) else True:
+                print >> sys.stderr, usage
+                print >> sys.stderr, "Please enter one of the following exchange types: " + "|".join(EXCHANGE_TYPES) + ", now quitting!"
+                sys.exit(-1)
+            exchange_type = argv[i + 1]
+        elif argv[i] == '--exchange':
+            if argv[i + 1][0] == '-' if not ((i + 1) >= len(argv)) else True:
+                print >> sys.stderr, usage
+                print >> sys.stderr, "Please enter a proper exchange name, now quitting!"
+                sys.exit(-1)
+            exchange = argv[i + 1]
+        elif argv[i] == '--share-group':
+            if argv[i + 1][0] == '-' if not ((i + 1) >= len(argv)) else True:
+                print >> sys.stderr, usage
+                print >> sys.stderr, "Please enter a proper share group name, now quitting!"
+                sys.exit(-1)
+            share_group = argv[i + 1]
+        elif argv[i] == '--rules':
+            if argv[i + 1][0] == '-' if not ((i + 1) >= len(argv)) else True:
+                print >> sys.stderr, usage
+                print >> sys.stderr, "Please enter a proper alert rules file, now quitting!"
+                sys.exit(-1)
+            rules_path = argv[i + 1]
+        elif argv[i] == '--alert-to':
+            if argv[i + 1][0] == '-' if not ((i + 1) >= len(argv)) else True:
+                print >> sys.stderr, usage
+                print >> sys.stderr, "Please enter 'stdout', a file or a webhook URL to send the alerts to, now quitting!"
+                sys.exit(-1)
+            alert_targets = argv[i + 1].split(',')
+        elif argv[i] == '--stats':
+            try:
+                stats_interval = parse_duration(argv[i + 1])
+                if stats_interval <= 0:
+                    raise ValueError(argv[i + 1])
+            except (IndexError, ValueError):
+                print >> sys.stderr, usage
+                print >> sys.stderr, "Please enter a proper stats interval such as '10s', now quitting!"
+                sys.exit(-1)
+        elif argv[i] == '--metrics-port':
+            try:
+                metrics_port = int(argv[i + 1])
+            except (IndexError, ValueError):
+                print >> sys.stderr, usage
+                print >> sys.stderr, "Please enter a proper port to serve the metrics on, now quitting!"
+                sys.exit(-1)
+        elif argv[i] == '-k':
+            if argv[i + 1][0] == '-' if not ((i + 1) >= len(argv)) else True:
+                print >> sys.stderr, usage
                 print >> sys.stderr, "Please enter one or more routing key(s), now quitting!"
                 sys.exit(-1)
-            further_args = sys.argv[(i + 1):]
+            further_args = argv[(i + 1):]
             j = 0
             while further_args[j][0] != '-':
                 topics.append(further_args[j])
@@ -195,110 +411,314 @@ try:
                     break
                 j += 1
 
-    if host is None:
+    if len(hosts) == 0:
         print >> sys.stderr, "Error: You must specify a message broker to connect to"
         sys.exit(-1)
 
     if len(topics) == 0:
         print >> sys.stderr, "Error: You must specify at least one topic to subscribe to"
         sys.exit(-1)
-    
-    print "List of routing key(s) are"
-    print topics
 
-    message_broker = None
-    channel = None
-    try:
-        # Connect to the message broker using the given broker address (host)
-        # Use the virtual host (vhost) and credential information (credentials), if provided
-
-        if credentials is not None:
-            usrname = credentials.split(':').__getitem__(0)
-            password = credentials.split(':').__getitem__(1)
-            # Check if there is a user with "usrname" else create it
-            pika_credentials = pika.PlainCredentials(usrname, password)
-        else:
-            pika_credentials = None
-
-        pika_parameters = pika.ConnectionParameters(host=host, virtual_host=vhost, credentials=pika_credentials)
-        message_broker = pika.BlockingConnection(pika_parameters)
-        print "A blocking connection named message_broker successfully created, now creating a channel"
-
-        # Setup the channel and exchange
-        channel = message_broker.channel()
-        print "Channel created, now declaring exchange 'pi_utilization' with type 'direct'"
-        # Exchange declaration, NOTE that this exchange is not a durable one
-        channel.exchange_declare(exchange='pi_utilization', type='direct')
-        print "Exchange declared successfully, now declaring an exclusive queue"
-
-        # Setup signal handlers to shutdown this app when SIGINT or SIGTERM
-        # is sent to this app
-        signal_num = signal.SIGINT
-        try:
-            # Create a StatsClientChannelEvents object to store a reference
-            # to the channel that will need to be shutdown if a signal is caught
-            channel_manager = StatsClientChannelHelper(channel)
-            signal.signal(signal_num, channel_manager.stop_stats_client)
-            signal_num = signal.SIGTERM
-            signal.signal(signal_num, channel_manager.stop_stats_client)
-
-        except ValueError, ve:
-            print "Warning: Graceful shutdown may not be possible: Unsupported Signal: " + signal_num
+    if dashboard and headless:
+        print >> sys.stderr, "Error: --dashboard and --headless can't be combined"
+        sys.exit(-1)
+    if sparklines and not dashboard:
+        print >> sys.stderr, "Error: The sparklines are only displayed with --dashboard"
+        sys.exit(-1)
+    if dashboard and not (sys.stdin.isatty() and sys.stdout.isatty()):
+        print >> sys.stderr, "Error: The dashboard must be displayed on a terminal"
+        sys.exit(-1)
 
-        # Create a queue
-        # --------------------
-        # Creating an exclusive queue NOTE that will only exists
-        # as long as the client is connected
+    # Bind every routing key, or pattern, only once
+    unique_topics = []
+    for topic in topics:
+        if topic not in unique_topics:
+            unique_topics.append(topic)
+    topics = unique_topics
 
-        result = channel.queue_declare(exclusive=True)
-        queue_name = result.method.queue
-        print "An exclusive queue declared successfully, now binding the queue and the exchange with the given routing key(s)"
+    # A direct exchange only routes the messages whose routing key is exactly the one bound
+    if exchange_type != 'topic' and any(is_pattern(topic) for topic in topics):
+        print >> sys.stderr, "Error: The '*' and '#' wildcards require '--exchange-type topic'"
+        sys.exit(-1)
+    if exchange is None:
+        exchange = EXCHANGE_NAMES[exchange_type]
 
-        # Bind you queue to the message exchange, and register your new message event handler
-        for topic in topics:
-            channel.queue_bind(exchange='pi_utilization', queue=queue_name, routing_key=topic)
-        print "Binding of exchange with the declared queue successful, now start pika's event loop by calling channel.basic_consume"
+    # The broker stops sending once prefetch messages are unacknowledged, so they must be acknowledged sooner
+    if ack_every > (prefetch or PREFETCH_COUNT):
+        print >> sys.stderr, "Error: The number of messages acknowledged at once must not exceed the prefetch count"
+        sys.exit(-1)
 
-        # Start pika's event loop
-        channel.basic_consume(on_new_msg, queue=queue_name, no_ack=True)
-        print "Pika's event loop started"
+    return {"hosts": hosts, "vhost": vhost, "credentials": credentials, "topics": topics, "refresh": refresh,
+            "headless": headless, "dashboard": dashboard, "sparklines": sparklines, "async_mode": async_mode,
+            "workers": workers, "prefetch": prefetch, "ack_every": ack_every, "ack_time": ack_time, "spans": spans,
+            "record_directory": record_directory, "rules_path": rules_path, "alert_targets": alert_targets,
+            "stats_interval": stats_interval, "metrics_port": metrics_port, "exchange_type": exchange_type,
+            "exchange": exchange, "share_group": share_group}
 
-        channel.start_consuming()
+def main(argv):
+    """
+    Runs the viewer until it is interrupted
 
-    except pika.exceptions.ProbableAccessDeniedError, pade:
-        print >> sys.stderr, "Error: A Probable Access Denied Error occured: " + str(pade.message)
+    :param argv: (list) The command line arguments, the program name first
+    :return: None
+    """
+    global stats_store, render_scheduler, pipeline, event_loop, acknowledger, fan_in, alert_engine, metrics, \
+        stats_interval
 
-    except pika.exceptions.ProbableAuthenticationError, aue:
-        print >> sys.stderr, "Error: A Probable Authentication error occured: " + str(aue.message)
+    # Guard try clause to catch any errors that aren't expected
+    try:
+        options = parse_args(argv)
+        stats_interval = options["stats_interval"]
+        recorder = None
+        metrics_server = None
+
+        # Keep the rolling windows of every device, and record its samples unless the workers do. The modules
+        # of the recording, alerting, measuring and worker pool are only loaded when asked for
+        if options["record_directory"] is not None and options["workers"] == 0:
+            from pistatsrecord import SegmentRecorder
+            recorder = SegmentRecorder(options["record_directory"])
+        stats_store = StatsStore(options["spans"], recorder)
+        if options["record_directory"] is not None:
+            print "Recording every sample in " + options["record_directory"]
+
+        # Compile the alert rules once, before any message is received
+        if options["rules_path"] is not None:
+            from pistatsalert import AlertEngine, load_rules, open_sink
+            try:
+                rules = load_rules(options["rules_path"])
+                alert_engine = AlertEngine(rules, [open_sink(target) for target in options["alert_targets"]])
+            except (IOError, ValueError), error:
+                print >> sys.stderr, "Error: Could not load the alert rules: " + str(error)
+                sys.exit(-1)
+            print "Checking %d alert rule(s) from %s" %(len(rules), options["rules_path"])
+
+        # Only measure the viewer when the measures are reported
+        if stats_interval is not None or options["metrics_port"] is not None:
+            from pistatsmetrics import Metrics, MetricsServer
+            metrics = Metrics("pistatsview")
+            if options["metrics_port"] is not None:
+                try:
+                    metrics_server = MetricsServer(metrics, options["metrics_port"])
+                except Exception, error:
+                    print >> sys.stderr, "Error: Could not serve the metrics: " + str(error)
+                    sys.exit(-1)
+                print "Serving the metrics on http://127.0.0.1:%d/metrics" %(options["metrics_port"])
+
+        print "List of routing key(s) are"
+        print options["topics"]
+
+        # Start the workers before the signal handlers are set up, they are stopped by the consumer. The messages
+        # are acknowledged once handled, so they don't wait for a full batch when the broker waits for them
+        if options["workers"] > 0:
+            from pistatspipeline import ShardedPipeline
+            acknowledged = options["async_mode"] or len(options["hosts"]) > 1 or options["prefetch"] is not None
+            pipeline = ShardedPipeline(options["workers"], spans=options["spans"],
+                                       record_directory=options["record_directory"], metrics=metrics,
+                                       flush_every=options["ack_every"] if acknowledged else None)
+            print "Decoding and aggregating the messages on %d worker process(es)" %(options["workers"])
+
+        # Loaded only now, once the arguments are known to be fine
+        import pika
+        import pika.exceptions
+
+        message_broker = None
+        channel = None
+        try:
+            # Connect to the message broker using the given broker address (host)
+            # Use the virtual host (vhost) and credential information (credentials), if provided
+
+            if options["credentials"] is not None:
+                usrname = options["credentials"].split(':').__getitem__(0)
+                password = options["credentials"].split(':').__getitem__(1)
+                # Check if there is a user with "usrname" else create it
+                pika_credentials = pika.PlainCredentials(usrname, password)
+            else:
+                pika_credentials = None
+
+            if options["async_mode"] or len(options["hosts"]) > 1:
+                # Consume the messages of every broker on a single asynchronous event loop, feeding them
+                # all to the same aggregation and display path
+                from pistatsfanin import FanInConsumer
+                consumer = FanInConsumer(options["hosts"], options["vhost"], pika_credentials, options["exchange"],
+                                         options["topics"], on_new_msg, options["prefetch"] or PREFETCH_COUNT,
+                                         options["ack_every"], options["ack_time"], options["exchange_type"],
+                                         options["share_group"], defer_acks=(pipeline is not None))
+                fan_in = consumer
+
+                # Setup signal handlers to shutdown this app when SIGINT or SIGTERM
+                # is sent to this app
+                signal_num = signal.SIGINT
+                try:
+                    signal.signal(signal_num, consumer.stop)
+                    signal_num = signal.SIGTERM
+                    signal.signal(signal_num, consumer.stop)
+
+                except ValueError, ve:
+                    print "Warning: Graceful shutdown may not be possible: Unsupported Signal: " + signal_num
+
+                # Redraw the stats of the updated devices once per refresh interval
+                render_scheduler = open_renderer(consumer.ioloop, options, consumer.stop)
+
+                # Merge the devices aggregated by the workers periodically
+                event_loop = consumer.ioloop
+                if pipeline is not None:
+                    event_loop.add_timeout(MERGE_INTERVAL, merge_pipeline_results)
+                if stats_interval is not None:
+                    event_loop.add_timeout(stats_interval, print_stats)
+
+                print "Connecting to message broker(s) %s, now starting pika's asynchronous event loop" %(", ".join(options["hosts"]))
+                consumer.run()
+
+            else:
+                host, port = parse_broker(options["hosts"][0])
+                pika_parameters = pika.ConnectionParameters(host=host, virtual_host=options["vhost"],
+                                                            credentials=pika_credentials)
+                if port is not None:
+                    pika_parameters.port = port
+                message_broker = pika.BlockingConnection(pika_parameters)
+                print "A blocking connection named message_broker successfully created, now creating a channel"
+
+                # Setup the channel and exchange
+                channel = message_broker.channel()
+                print "Channel created, now declaring exchange '%s' with type '%s'" %(options["exchange"], options["exchange_type"])
+                # Exchange declaration, NOTE that this exchange is not a durable one
+                channel.exchange_declare(exchange=options["exchange"], type=options["exchange_type"])
+                print "Exchange declared successfully, now declaring a queue"
+
+                # Setup signal handlers to shutdown this app when SIGINT or SIGTERM
+                # is sent to this app
+                signal_num = signal.SIGINT
+                try:
+                    # Create a StatsClientChannelEvents object to store a reference
+                    # to the channel that will need to be shutdown if a signal is caught
+                    channel_manager = StatsClientChannelHelper(channel)
+                    signal.signal(signal_num, channel_manager.stop_stats_client)
+                    signal_num = signal.SIGTERM
+                    signal.signal(signal_num, channel_manager.stop_stats_client)
+
+                except ValueError, ve:
+                    print "Warning: Graceful shutdown may not be possible: Unsupported Signal: " + signal_num
+
+                # Create a queue
+                # --------------------
+                # Creating an exclusive queue NOTE that will only exists
+                # as long as the client is connected
+                result = channel.queue_declare(exclusive=True)
+                queue_name = result.method.queue
+                print "An exclusive queue declared successfully, now binding the queue and the exchange with the given routing key(s)"
+
+                # Bind you queue to the message exchange, and register your new message event handler
+                if options["share_group"] is None:
+                    for topic in options["topics"]:
+                        channel.queue_bind(exchange=options["exchange"], queue=queue_name, routing_key=topic)
+                else:
+                    # Split the devices with the other viewers given the same name. The shared exchange hands every
+                    # message of a device to the same viewer, so that its dictionary, its delta samples and its
+                    # windows are never split. NOTE that it is deleted once the last viewer leaves
+                    try:
+                        channel.exchange_declare(exchange=options["share_group"], type=SHARED_EXCHANGE_TYPE,
+                                                 auto_delete=True)
+                    except pika.exceptions.ChannelClosed, cce:
+                        # The broker closed the channel, most likely since it doesn't know the exchange type
+                        channel = None
+                        print >> sys.stderr, "Error: The share group exchange '%s' couldn't be declared: %s" %(
+                            options["share_group"], " ".join(str(arg) for arg in cce.args))
+                        print >> sys.stderr, "Share groups need the %s plugin on the broker, enable it with " \
+                            "'rabbitmq-plugins enable %s'" %(SHARED_EXCHANGE_PLUGIN, SHARED_EXCHANGE_PLUGIN)
+                        return
+                    for topic in options["topics"]:
+                        channel.exchange_bind(destination=options["share_group"], source=options["exchange"],
+                                              routing_key=topic)
+                    channel.queue_bind(exchange=options["share_group"], queue=queue_name, routing_key=SHARED_WEIGHT)
+                    print "Sharing the devices with the other viewers of share group '%s'" %(options["share_group"])
+                print "Binding of exchange with the declared queue successful, now start pika's event loop by calling channel.basic_consume"
+
+                # Redraw the stats of the updated devices once per refresh interval
+                render_scheduler = open_renderer(message_broker, options, channel_manager.stop_stats_client)
+
+                # Merge the devices aggregated by the workers periodically
+                event_loop = message_broker
+                if pipeline is not None:
+                    event_loop.add_timeout(MERGE_INTERVAL, merge_pipeline_results)
+                if stats_interval is not None:
+                    event_loop.add_timeout(stats_interval, print_stats)
+
+                # Limit the unacknowledged messages the broker sends, if asked to, and acknowledge them in bulk
+                if options["prefetch"] is not None:
+                    channel.basic_qos(prefetch_count=options["prefetch"])
+                    acknowledger = BulkAcknowledger(channel, options["ack_every"], options["ack_time"])
+                    acknowledger.start(message_broker)
+                    print "Prefetching %d message(s), acknowledged %d at a time" %(options["prefetch"],
+                                                                                   options["ack_every"])
+
+                # Start pika's event loop
+                channel.basic_consume(on_new_msg, queue=queue_name, no_ack=(acknowledger is None))
+                print "Pika's event loop started"
+
+                channel.start_consuming()
+
+        except pika.exceptions.ProbableAccessDeniedError, pade:
+            print >> sys.stderr, "Error: A Probable Access Denied Error occured: " + str(pade.message)
+
+        except pika.exceptions.ProbableAuthenticationError, aue:
+            print >> sys.stderr, "Error: A Probable Authentication error occured: " + str(aue.message)
     
-    except pika.exceptions.AMQPConnectionError, acoe:
-        print >> sys.stderr, "Error: An AMQP Connection Error occured: " + str(acoe.message)
+        except pika.exceptions.AMQPConnectionError, acoe:
+            print >> sys.stderr, "Error: An AMQP Connection Error occured: " + str(acoe.message)
 
-    except pika.exceptions.AMQPChannelError, ache:
-        print >> sys.stderr, "Error: An AMQP Channel Error occured: " + str(ache.message)
+        except pika.exceptions.AMQPChannelError, ache:
+            print >> sys.stderr, "Error: An AMQP Channel Error occured: " + str(ache.message)
     
-    except pika.exceptions.ChannelError, ce:
-        print >> sys.stderr, "Error: A channel error occured: " + str(ce.message)
+        except pika.exceptions.ChannelError, ce:
+            print >> sys.stderr, "Error: A channel error occured: " + str(ce.message)
     
-    except pika.exceptions.AMQPError, ae:
-        print >> sys.stderr, "Error: An AMQP Error occured: " + str(ae.message)
+        except pika.exceptions.AMQPError, ae:
+            print >> sys.stderr, "Error: An AMQP Error occured: " + str(ae.message)
     
-    except Exception, eee:
-        print >> sys.stderr, "Error: An unexpected exception occured: " + str(eee.message)
-
-    finally:
-        #TODO: Attempt to gracefully shutdown the connection to the message broker
-        # Closing the channel gracefully
-        if channel is not None:
-            print ""
-            print "Exited pika event loop, closing channel and the message broker"
-            channel.close()
-            print "Channel closed successfully!"
-        # For closing the connection gracefully
-        if message_broker is not None:
-            message_broker.close()
-            print "Message broker closed successfully, Shutting down gracefully!"
-
-except Exception, ee:
+        except Exception, eee:
+            print >> sys.stderr, "Error: An unexpected exception occured: " + str(eee.message)
+
+        finally:
+            #TODO: Attempt to gracefully shutdown the connection to the message broker
+            # Let the workers finish the messages they were handed, and merge their results
+            if pipeline is not None:
+                merge_devices(pipeline.close())
+                print "Handed %d message(s) over to %d worker(s), %d couldn't be handled" %(
+                    pipeline.submitted_msgs, pipeline.workers, pipeline.failed_msgs)
+            # Display the updates received since the last redraw
+            if render_scheduler is not None:
+                render_scheduler.close()
+            # Write the recorded samples back to disk
+            if recorder is not None:
+                recorder.close()
+                print "Recorded %d sample(s) in %d segment(s)" %(recorder.records, recorder.segments)
+            # Acknowledge the messages handled since the last acknowledgement
+            if acknowledger is not None:
+                acknowledger.flush()
+                print "Acknowledged %d message(s) with %d acknowledgement(s)" %(acknowledger.acked_msgs, acknowledger.ack_frames)
+            if metrics_server is not None:
+                metrics_server.close()
+            # Report the alerts, and close their destinations
+            if alert_engine is not None:
+                alert_engine.close()
+                print "Fired %d alert(s), %d of which were resolved" %(alert_engine.fired, alert_engine.resolved)
+            # Closing the channel gracefully
+            if channel is not None:
+                print ""
+                print "Exited pika event loop, closing channel and the message broker"
+                channel.close()
+                print "Channel closed successfully!"
+            # For closing the connection gracefully
+            if message_broker is not None:
+                message_broker.close()
+                print "Message broker closed successfully, Shutting down gracefully!"
+            print "Tracked %d device(s) using %d bytes of statistics" %(len(stats_store), stats_store.memory_usage())
+
+    except Exception, ee:
         # Add code here to handle the exception, print an error, and exit gracefully
         print >> sys.stderr, "Error: An unexpected exception occured: " + str(ee.message)
+
+# Application Entry Point
+# ^^^^^^^^^^^^^^^^^^^^^^^
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,362 @@
+"""
+This file contains the rolling windows used by pistatsview.py to summarize
+the recent values of a metric, rather than all the values since it started
+
+A window covering 'span' seconds is split into a fixed number of slots, held
+in preallocated ring buffers. Each slot keeps the sum, count, maximum and
+minimum of the values received during its share of the span, and slots are
+recycled as time moves on, so a window uses the same memory however long the
+viewer runs. The window mean is kept as a running sum, and the window maximum
+and minimum are read from monotonic deques of the slot maxima and minima, all
+in O(1) amortized time per value.
+
+The 95th and 99th percentiles are estimated from quantile sketches, which
+count the values in logarithmic buckets rather than storing them, so that any
+quantile is known within QUANTILE_ACCURACY of its value. Every power of two is
+split into the same number of buckets, so that the bucket of a value is found
+from its binary exponent and mantissa, without computing a logarithm. A sketch
+holds at most QUANTILE_BUCKETS buckets, merging its lowest buckets together
+when more are needed, which only blurs the quantiles far below the ones
+displayed. One sketch counts the values of each group of slots, and the
+sketches of the groups still in the window are merged when a quantile is read.
+"""
+
+import math
+import sys
+from array import array
+from collections import deque
+
+# Default windows, as the label displayed and the span in seconds
+WINDOWS = (("1m", 60.0), ("5m", 300.0), ("1h", 3600.0))
+
+# Number of slots a window is split into, and of slot groups estimating the
+# quantiles. The slots must split evenly into groups
+WINDOW_SLOTS = 30
+QUANTILE_GROUPS = 6
+
+# The quantiles displayed for every window
+QUANTILES = (0.95, 0.99)
+
+# The relative error of the estimated quantiles, and the smallest value told
+# apart from zero
+QUANTILE_ACCURACY = 0.05
+QUANTILE_MIN_VALUE = 1e-9
+
+# The largest number of buckets a quantile sketch holds
+QUANTILE_BUCKETS = 96
+
+# The number of buckets each power of two is split into, so that the value
+# displayed for a bucket is within QUANTILE_ACCURACY of every value in it
+_OCTAVE_BUCKETS = int(math.ceil(0.5 / QUANTILE_ACCURACY))
+_MANTISSA_SCALE = 2 * _OCTAVE_BUCKETS
+
+
+class QuantileSketch(object):
+    """
+    Counts values in buckets whose bounds grow geometrically, one power of
+    two at a time, so that every value is known within QUANTILE_ACCURACY of
+    its bucket's value
+    """
+
+    __slots__ = ("buckets", "zeros", "count", "floor")
+
+    def __init__(self):
+        """
+        Create a new, empty QuantileSketch object
+
+        :return: None
+        """
+        # The number of values per bucket index, and of values too small to be told apart from zero
+        self.buckets = dict()
+        self.zeros = 0
+        self.count = 0
+        # The lowest bucket index, once the lower buckets were merged together
+        self.floor = None
+
+    def add(self, value):
+        """
+        Counts a value
+
+        :param value: (float) The value, values below QUANTILE_MIN_VALUE are counted as zero
+        :return: None
+        """
+        if value < QUANTILE_MIN_VALUE:
+            self.zeros += 1
+        else:
+            buckets = self.buckets
+            # The mantissa is in [0.5, 1), its scaled integer part picks the bucket within the power of two
+            mantissa, exponent = math.frexp(value)
+            bucket = exponent * _OCTAVE_BUCKETS + int(mantissa * _MANTISSA_SCALE)
+            if self.floor is not None and bucket < self.floor:
+                bucket = self.floor
+            buckets[bucket] = buckets.get(bucket, 0) + 1
+            if len(buckets) > QUANTILE_BUCKETS:
+                self.__shrink()
+        self.count += 1
+
+    def merge(self, other):
+        """
+        Counts the values counted by another sketch as well
+
+        :param other: (QuantileSketch) The sketch, left unchanged
+        :return: None
+        """
+        buckets = self.buckets
+        for bucket, count in other.buckets.iteritems():
+            if self.floor is not None and bucket < self.floor:
+                bucket = self.floor
+            buckets[bucket] = buckets.get(bucket, 0) + count
+        while len(buckets) > QUANTILE_BUCKETS:
+            self.__shrink()
+        self.zeros += other.zeros
+        self.count += other.count
+
+    def clear(self):
+        """
+        Forgets every value counted so far
+
+        :return: None
+        """
+        self.buckets.clear()
+        self.zeros = 0
+        self.count = 0
+        self.floor = None
+
+    def __shrink(self):
+        # Merge the lowest bucket into the next one
+        buckets = self.buckets
+        count = buckets.pop(min(buckets))
+        self.floor = min(buckets)
+        buckets[self.floor] += count
+
+
+def merged_quantile(sketches, p):
+    """
+    Estimates a quantile of the values counted by several sketches together
+
+    :param sketches: (list) The QuantileSketch objects to merge
+    :param p: (float) The quantile to estimate, between 0 and 1
+    :return: (float) The estimated quantile, 0 if the sketches are empty
+    """
+    count = sum(sketch.count for sketch in sketches)
+    if count == 0:
+        return 0.0
+    rank = int(p * (count - 1))
+
+    seen = sum(sketch.zeros for sketch in sketches)
+    if rank < seen:
+        return 0.0
+
+    buckets = dict()
+    for sketch in sketches:
+        for bucket, bucket_count in sketch.buckets.iteritems():
+            buckets[bucket] = buckets.get(bucket, 0) + bucket_count
+    for bucket in sorted(buckets):
+        seen += buckets[bucket]
+        if rank < seen:
+            return _bucket_value(bucket)
+    return 0.0
+
+
+def _bucket_value(bucket):
+    # Returns the value halfway between the bounds of a bucket, in relative terms
+    exponent, step = divmod(bucket - _OCTAVE_BUCKETS, _OCTAVE_BUCKETS)
+    low = math.ldexp(1.0 + float(step) / _OCTAVE_BUCKETS, exponent - 1)
+    high = math.ldexp(1.0 + float(step + 1) / _OCTAVE_BUCKETS, exponent - 1)
+    return 2 * low * high / (low + high)
+
+
+class RollingWindow(object):
+    """
+    Summarizes the values of a metric received during the last few seconds
+    """
+
+    __slots__ = ("span", "__width", "__slot", "__index", "__sums", "__counts", "__maxima", "__minima", "__total",
+                 "__count", "__max_deque", "__min_deque", "__slots_per_group", "__sketches", "__sketch")
+
+    def __init__(self, span, slots=WINDOW_SLOTS, groups=QUANTILE_GROUPS):
+        """
+        Create a new, empty RollingWindow object
+
+        :param span: (float) The number of seconds covered by the window
+        :param slots: (int) The number of slots the window is split into
+        :param groups: (int) The number of slot groups estimating the quantiles
+        :raises ValueError: if span isn't positive, or slots don't split evenly into groups
+        :return: None
+        """
+        if span <= 0:
+            raise ValueError("The window span must be positive")
+        if groups < 1 or slots % groups != 0:
+            raise ValueError("The window slots must split evenly into quantile groups")
+
+        self.span = span
+        self.__width = float(span) / slots
+        # The absolute index of the slot receiving values, None until the first value, and its index in the ring
+        self.__slot = None
+        self.__index = 0
+        self.__sums = array("d", [0.0]) * slots
+        self.__counts = array("d", [0.0]) * slots
+        self.__maxima = array("d", [float("-inf")]) * slots
+        self.__minima = array("d", [float("inf")]) * slots
+        self.__total = 0.0
+        self.__count = 0
+        # (absolute slot, value) pairs of the closed slots, with decreasing
+        # maxima and increasing minima
+        self.__max_deque = deque()
+        self.__min_deque = deque()
+
+        # One sketch per group of slots, recycled like the slots
+        self.__slots_per_group = slots / groups
+        self.__sketches = [QuantileSketch() for i in range(groups)]
+        self.__sketch = self.__sketches[0]
+
+    def __len__(self):
+        return self.__count
+
+    def add(self, value, now):
+        """
+        Adds a value to the window, dropping the values that fell out of it
+
+        :param value: (float) The value
+        :param now: (float) The monotonic time the value was received at
+        :return: None
+        """
+        slot = int(now / self.__width)
+        if slot != self.__slot and (self.__slot is None or slot > self.__slot):
+            self.__advance(slot)
+
+        i = self.__index
+        self.__sums[i] += value
+        self.__counts[i] += 1
+        maxima = self.__maxima
+        if value > maxima[i]:
+            maxima[i] = value
+        minima = self.__minima
+        if value < minima[i]:
+            minima[i] = value
+        self.__total += value
+        self.__count += 1
+        self.__sketch.add(value)
+
+    def expire(self, now):
+        """
+        Drops the values that fell out of the window. The window is otherwise
+        only moved on by add(), so the window of a metric that stopped
+        receiving values must be expired before it is read
+
+        :param now: (float) The monotonic time
+        :return: (bool) Whether any value was dropped
+        """
+        slot = int(now / self.__width)
+        if self.__slot is None or slot <= self.__slot:
+            return False
+        count = self.__count
+        self.__advance(slot)
+        return self.__count != count
+
+    def mean(self):
+        """
+        :return: (float) The mean of the values in the window, 0 if it is empty
+        """
+        if self.__count == 0:
+            return 0.0
+        return self.__total / self.__count
+
+    def max(self):
+        """
+        :return: (float) The largest value in the window, 0 if it is empty
+        """
+        if self.__count == 0:
+            return 0.0
+        value = self.__maxima[self.__index]
+        if self.__max_deque and self.__max_deque[0][1] > value:
+            value = self.__max_deque[0][1]
+        return value
+
+    def min(self):
+        """
+        :return: (float) The smallest value in the window, 0 if it is empty
+        """
+        if self.__count == 0:
+            return 0.0
+        value = self.__minima[self.__index]
+        if self.__min_deque and self.__min_deque[0][1] < value:
+            value = self.__min_deque[0][1]
+        return value
+
+    def quantile(self, p):
+        """
+        Returns an estimate of a quantile of the values in the window
+
+        :param p: (float) The quantile to estimate, between 0 and 1
+        :return: (float) The estimated quantile, 0 if the window is empty
+        """
+        if self.__count == 0:
+            return 0.0
+        # The bucket value may lie a little outside of the values really received
+        return min(max(merged_quantile(self.__sketches, p), self.min()), self.max())
+
+    def memory_usage(self):
+        """
+        Returns the number of bytes used by the window
+
+        :return: (int) The approximate heap size of the window in bytes
+        """
+        size = sys.getsizeof(self)
+        for values in (self.__sums, self.__counts, self.__maxima, self.__minima):
+            size += sys.getsizeof(values)
+        size += sys.getsizeof(self.__max_deque) + sys.getsizeof(self.__min_deque) + sys.getsizeof(self.__sketches)
+        for sketch in self.__sketches:
+            size += sys.getsizeof(sketch) + sys.getsizeof(sketch.buckets)
+        return size
+
+    def __advance(self, slot):
+        slots = len(self.__sums)
+        if self.__slot is None:
+            self.__move_to(slot)
+            return
+
+        # Close the current slot, its maximum and minimum stay in the deques until it leaves the window
+        i = self.__slot % slots
+        if self.__counts[i] > 0:
+            maximum = self.__maxima[i]
+            while self.__max_deque and self.__max_deque[-1][1] <= maximum:
+                self.__max_deque.pop()
+            self.__max_deque.append((self.__slot, maximum))
+            minimum = self.__minima[i]
+            while self.__min_deque and self.__min_deque[-1][1] >= minimum:
+                self.__min_deque.pop()
+            self.__min_deque.append((self.__slot, minimum))
+
+        # Recycle the sketches of the groups that left the window
+        groups = len(self.__sketches)
+        group = self.__slot / self.__slots_per_group
+        new_group = slot / self.__slots_per_group
+        for expired in range(max(group + 1, new_group - groups + 1), new_group + 1):
+            self.__sketches[expired % groups].clear()
+
+        # Recycle the slots that left the window, at most all of them
+        for expired in range(max(self.__slot + 1, slot - slots + 1), slot + 1):
+            j = expired % slots
+            self.__total -= self.__sums[j]
+            self.__count -= int(self.__counts[j])
+            self.__sums[j] = 0.0
+            self.__counts[j] = 0.0
+            self.__maxima[j] = float("-inf")
+            self.__minima[j] = float("inf")
+        if self.__count == 0:
+            # Don't let rounding errors accumulate over an empty window
+            self.__total = 0.0
+
+        oldest = slot - slots
+        while self.__max_deque and self.__max_deque[0][0] <= oldest:
+            self.__max_deque.popleft()
+        while self.__min_deque and self.__min_deque[0][0] <= oldest:
+            self.__min_deque.popleft()
+
+        self.__move_to(slot)
+
+    def __move_to(self, slot):
+        self.__slot = slot
+        self.__index = slot % len(self.__sums)
+        self.__sketch = self.__sketches[(slot / self.__slots_per_group) % len(self.__sketches)]
@@ -0,0 +1,88 @@
+"""
+This file contains the tests of pistatsack.py, run from the top directory
+with:
+
+$ python -m unittest discover tests
+"""
+
+import time
+import unittest
+
+from pistatsack import BulkAcknowledger
+
+
+class FakeChannel(object):
+    # Records the acknowledgements instead of sending them to a broker
+
+    def __init__(self):
+        self.is_open = True
+        self.acks = []
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acks.append((delivery_tag, multiple))
+
+
+class FakeConnection(object):
+    # Records the timers instead of running them
+
+    def __init__(self):
+        self.timeouts = []
+
+    def add_timeout(self, deadline, callback):
+        self.timeouts.append((deadline, callback))
+
+
+class BulkAcknowledgerTest(unittest.TestCase):
+
+    def test_acknowledges_in_batches(self):
+        channel = FakeChannel()
+        acknowledger = BulkAcknowledger(channel, ack_every=3, ack_time=0)
+        for tag in range(1, 8):
+            acknowledger.ack(tag)
+        self.assertEqual(channel.acks, [(3, True), (6, True)])
+        acknowledger.flush()
+        self.assertEqual(channel.acks, [(3, True), (6, True), (7, True)])
+        self.assertEqual((acknowledger.acked_msgs, acknowledger.ack_frames), (7, 3))
+        # Nothing is left to acknowledge
+        acknowledger.flush()
+        self.assertEqual(len(channel.acks), 3)
+
+    def test_acknowledges_old_messages(self):
+        channel = FakeChannel()
+        acknowledger = BulkAcknowledger(channel, ack_every=100, ack_time=0.01)
+        acknowledger.ack(1)
+        time.sleep(0.02)
+        acknowledger.ack(2)
+        self.assertEqual(channel.acks, [(2, True)])
+
+    def test_timer_acknowledges_after_a_lull(self):
+        channel = FakeChannel()
+        connection = FakeConnection()
+        acknowledger = BulkAcknowledger(channel, ack_every=100, ack_time=0.1)
+        acknowledger.start(connection)
+        acknowledger.ack(1)
+        deadline, callback = connection.timeouts.pop()
+        self.assertEqual(deadline, 0.1)
+        callback()
+        self.assertEqual(channel.acks, [(1, True)])
+        # The timer is scheduled again while the channel is open
+        self.assertEqual(len(connection.timeouts), 1)
+        channel.is_open = False
+        connection.timeouts.pop()[1]()
+        self.assertEqual(connection.timeouts, [])
+
+    def test_closed_channel(self):
+        channel = FakeChannel()
+        acknowledger = BulkAcknowledger(channel, ack_every=2, ack_time=0)
+        acknowledger.ack(1)
+        channel.is_open = False
+        acknowledger.ack(2)
+        self.assertEqual(channel.acks, [])
+        self.assertEqual(acknowledger.acked_msgs, 0)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, BulkAcknowledger, FakeChannel(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+"""
+This file contains the tests of pistatsalert.py, run from the top directory
+with:
+
+$ python -m unittest discover tests
+"""
+
+import BaseHTTPServer
+import sys
+import threading
+import time
+import unittest
+from StringIO import StringIO
+
+from pistatsalert import AlertRule, AlertEngine, WebhookSink, WEBHOOK_QUEUE
+from pistatsstore import StatsStore
+
+
+class ListSink(object):
+    # Keeps the alerts sent
+
+    def __init__(self):
+        self.alerts = []
+
+    def send(self, alert):
+        self.alerts.append(alert)
+
+    def close(self):
+        pass
+
+
+class AlertRuleTest(unittest.TestCase):
+
+    def test_parse(self):
+        rule = AlertRule("eth* tx < 2 kB/s for 1m on site1.# clear 3kB/s")
+        self.assertEqual((rule.iface, rule.above, rule.threshold, rule.clear, rule.duration, rule.pattern),
+                         ("eth*", False, 2000.0, 3000.0, 60.0, "site1.#"))
+
+    def test_default_hysteresis(self):
+        rule = AlertRule("cpu > 90%")
+        self.assertAlmostEqual(rule.clear, 0.855)
+        self.assertEqual((rule.duration, rule.pattern), (0.0, "#"))
+
+    def test_invalid(self):
+        for text in ("", "cpu", "cpu ~ 1", "disk > 1", "cpu > 1 parsecs", "cpu > 1 for", "cpu >"):
+            self.assertRaises(ValueError, AlertRule, text)
+
+
+class AlertEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = StatsStore()
+        self.sink = ListSink()
+
+    def evaluate(self, engine, routing_key, cpu, now):
+        engine.evaluate(self.store.aggregate(routing_key, [{"cpu": cpu, "net": {"eth0": {"rx": 0.0, "tx": 0.0}}}]),
+                        now)
+        return [alert["state"] for alert in self.sink.alerts]
+
+    def test_fires_once_breached_for_the_duration(self):
+        engine = AlertEngine([AlertRule("cpu > 90% for 30s")], [self.sink])
+        self.assertEqual(self.evaluate(engine, "pi0", 0.95, 0.0), [])
+        self.assertEqual(self.evaluate(engine, "pi0", 0.95, 29.0), [])
+        self.assertEqual(self.evaluate(engine, "pi0", 0.95, 30.0), ["firing"])
+        # Only reported once while it lasts
+        self.assertEqual(self.evaluate(engine, "pi0", 0.99, 40.0), ["firing"])
+        self.assertEqual(self.sink.alerts[0]["device"], "pi0")
+        self.assertEqual(self.sink.alerts[0]["value"], 0.95)
+
+    def test_dip_restarts_the_duration(self):
+        engine = AlertEngine([AlertRule("cpu > 90% for 30s")], [self.sink])
+        self.evaluate(engine, "pi0", 0.95, 0.0)
+        self.evaluate(engine, "pi0", 0.5, 20.0)
+        self.assertEqual(self.evaluate(engine, "pi0", 0.95, 30.0), [])
+        self.assertEqual(self.evaluate(engine, "pi0", 0.95, 60.0), ["firing"])
+
+    def test_hysteresis(self):
+        engine = AlertEngine([AlertRule("cpu > 90%")], [self.sink])
+        self.assertEqual(self.evaluate(engine, "pi0", 0.95, 0.0), ["firing"])
+        # Hovering just below the threshold doesn't resolve the alert, crossing back the clear value does
+        self.assertEqual(self.evaluate(engine, "pi0", 0.88, 1.0), ["firing"])
+        self.assertEqual(self.evaluate(engine, "pi0", 0.92, 2.0), ["firing"])
+        self.assertEqual(self.evaluate(engine, "pi0", 0.85, 3.0), ["firing", "resolved"])
+        self.assertEqual(self.evaluate(engine, "pi0", 0.95, 4.0), ["firing", "resolved", "firing"])
+        self.assertEqual((engine.fired, engine.resolved), (2, 1))
+
+    def test_rules_apply_to_their_devices(self):
+        engine = AlertEngine([AlertRule("cpu > 90% on site1.*"), AlertRule("cpu > 50% on site2.pi1")], [self.sink])
+        self.assertEqual(len(engine.rules_for("site1.pi1")), 1)
+        self.assertEqual(len(engine.rules_for("site1.rack1.pi1")), 0)
+        self.assertEqual(self.evaluate(engine, "site2.pi2", 0.95, 0.0), [])
+        self.assertEqual(self.evaluate(engine, "site1.pi1", 0.95, 0.0), ["firing"])
+        self.assertEqual(self.evaluate(engine, "site2.pi1", 0.6, 0.0), ["firing", "firing"])
+
+    def test_interface_patterns(self):
+        engine = AlertEngine([AlertRule("eth* rx < 1 B/s")], [self.sink])
+        self.evaluate(engine, "pi0", 0.5, 0.0)
+        self.assertEqual([(alert["iface"], alert["metric"]) for alert in self.sink.alerts], [("eth0", "rx")])
+
+
+class _SlowWebhookHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Accepts the alerts once the test releases them
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader("Content-Length")))
+        self.server.release.wait()
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookSinkTest(unittest.TestCase):
+
+    def test_slow_webhook_doesnt_block(self):
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), _SlowWebhookHandler)
+        server.release = threading.Event()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            sink = WebhookSink("http://127.0.0.1:%d/" %(server.server_port))
+            start = time.time()
+            for i in range(WEBHOOK_QUEUE + 10):
+                sink.send({"index": i})
+            self.assertLess(time.time() - start, 1.0)
+            # The alert being posted left the queue, the ones that didn't fit in it were dropped
+            self.assertGreaterEqual(sink.dropped, 9)
+            server.release.set()
+            sink.close()
+            warning = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+            server.release.set()
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(sink.posted + sink.dropped, WEBHOOK_QUEUE + 10)
+        self.assertIn("Warning: Dropped", warning)
+
+
+if __name__ == "__main__":
+    unittest.main()
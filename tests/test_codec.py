@@ -0,0 +1,96 @@
+"""
+This file contains the tests of pistatscodec.py, run from the top directory
+with:
+
+$ python -m unittest discover tests
+"""
+
+import unittest
+
+from pistatscodec import StatsEncoder, StatsDecoder, FORMATS, DICTIONARY_INTERVAL, FLAG_DICTIONARY
+from pistatscommon import CPU_STATES, NET_COUNTERS
+from pistatspublisher import DeltaSuppressor
+
+
+def sample(cpu, ifaces=("eth0",)):
+    return {"cpu": cpu, "cores": [0.25, 0.75], "cpu_states": dict((state, 0.125) for state in CPU_STATES),
+            "net": dict((iface, {"rx": 100.0, "tx": 50.0}) for iface in ifaces)}
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for fmt in FORMATS:
+            encoder = StatsEncoder(fmt)
+            decoder = StatsDecoder()
+            self.assertEqual(decoder.decode("pi0", encoder.content_type, encoder.encode(sample(0.5))),
+                             [sample(0.5)], fmt)
+
+    def test_batch_round_trip(self):
+        samples = [sample(0.5), sample(0.25, ("eth0", "wlan0")), sample(0.75)]
+        for fmt in FORMATS:
+            encoder = StatsEncoder(fmt)
+            decoder = StatsDecoder()
+            self.assertEqual(decoder.decode("pi0", encoder.content_type, encoder.encode_batch(samples)), samples,
+                             fmt)
+
+    def test_json_without_content_type(self):
+        # Publishers that predate the content types send a single JSON document
+        encoder = StatsEncoder("json")
+        self.assertEqual(StatsDecoder().decode("pi0", None, encoder.encode(sample(0.5))), [sample(0.5)])
+
+    def test_late_subscriber_waits_for_the_dictionary(self):
+        encoder = StatsEncoder("struct")
+        bodies = [encoder.encode(sample(0.5)) for i in range(DICTIONARY_INTERVAL + 1)]
+
+        # A subscriber that missed the first message can't name the interfaces until the dictionary is repeated
+        decoder = StatsDecoder()
+        for body in bodies[1:DICTIONARY_INTERVAL]:
+            self.assertRaises(ValueError, decoder.decode, "pi0", encoder.content_type, body)
+        self.assertEqual(decoder.decode("pi0", encoder.content_type, bodies[DICTIONARY_INTERVAL]), [sample(0.5)])
+
+    def test_dictionaries_are_kept_per_device(self):
+        encoder = StatsEncoder("struct")
+        decoder = StatsDecoder()
+        decoder.decode("pi0", encoder.content_type, encoder.encode(sample(0.5)))
+        self.assertRaises(ValueError, decoder.decode, "pi1", encoder.content_type, encoder.encode(sample(0.5)))
+
+    def test_new_interfaces_resend_the_dictionary(self):
+        encoder = StatsEncoder("struct")
+        decoder = StatsDecoder()
+        decoder.decode("pi0", encoder.content_type, encoder.encode(sample(0.5)))
+        self.assertEqual(decoder.decode("pi0", encoder.content_type, encoder.encode(sample(0.5, ("wlan0",)))),
+                         [sample(0.5, ("wlan0",))])
+
+    def test_dictionary_resent_every_interval_with_deltas(self):
+        encoder = StatsEncoder("struct")
+        suppressor = DeltaSuppressor(DICTIONARY_INTERVAL * 2)
+        decoder = StatsDecoder()
+        resent = []
+        for frame in range(DICTIONARY_INTERVAL * 3):
+            # Every counter is sent, and only some of them move between the keyframes
+            msg = {"cpu": 0.5, "net": {"eth0": dict((counter, float(frame % 2) if counter.endswith("errs") else 7.0)
+                                                    for counter in NET_COUNTERS)}}
+            for counter in ("rx", "rx_packets", "tx", "tx_packets"):
+                msg["net"]["eth0"][counter] = frame
+            sent = suppressor.filter(msg)
+            body = encoder.encode(sent)
+            # The flags are the second byte of the header
+            if ord(body[1]) & FLAG_DICTIONARY:
+                resent.append(frame)
+            decoded, = decoder.decode("pi0", encoder.content_type, body)
+            self.assertEqual(decoded, sent)
+        self.assertEqual(resent, [0, DICTIONARY_INTERVAL, DICTIONARY_INTERVAL * 2])
+
+    def test_malformed_messages(self):
+        encoder = StatsEncoder("struct")
+        body = encoder.encode(sample(0.5))
+        decoder = StatsDecoder()
+        self.assertRaises(ValueError, decoder.decode, "pi0", encoder.content_type, body[:-3])
+        self.assertRaises(ValueError, decoder.decode, "pi0", "text/plain", body)
+        self.assertRaises(ValueError, decoder.decode, "pi0", None, "{")
+        self.assertRaises(ValueError, StatsEncoder, "xml")
+
+
+if __name__ == "__main__":
+    unittest.main()
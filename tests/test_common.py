@@ -0,0 +1,59 @@
+"""
+This file contains the tests of pistatscommon.py, run from the top directory
+with:
+
+$ python -m unittest discover tests
+"""
+
+import time
+import unittest
+
+from pistatscommon import SampleScheduler, monotonic, parse_duration, MIN_INTERVAL
+
+
+class ParseDurationTest(unittest.TestCase):
+
+    def test_units(self):
+        self.assertEqual([parse_duration(text) for text in ("2", "10ms", "1.5s", "2m", "1h")],
+                         [2.0, 0.01, 1.5, 120.0, 3600.0])
+
+    def test_invalid(self):
+        for text in ("", "fast", "-1s", "1d"):
+            self.assertRaises(ValueError, parse_duration, text)
+
+
+class SampleSchedulerTest(unittest.TestCase):
+
+    def test_work_doesnt_drift(self):
+        scheduler = SampleScheduler(0.02)
+        scheduler.start()
+        start = monotonic()
+        for tick in range(10):
+            self.assertEqual(scheduler.wait(), 0)
+            # Sampling and publishing takes a good part of the interval
+            time.sleep(0.01)
+        # Waiting for the tenth deadline took ten intervals, not ten intervals plus the work
+        elapsed = monotonic() - start - 0.01
+        self.assertGreaterEqual(elapsed, 0.2 - 0.001)
+        self.assertLess(elapsed, 0.2 + 0.05)
+        self.assertEqual((scheduler.ticks, scheduler.missed_ticks), (10, 0))
+
+    def test_missed_deadlines_are_skipped(self):
+        scheduler = SampleScheduler(0.02)
+        scheduler.start()
+        scheduler.wait()
+        # A stall three and a half intervals long
+        time.sleep(0.07)
+        self.assertEqual(scheduler.wait(), 2)
+        self.assertEqual(scheduler.missed_ticks, 2)
+        # The next deadline is back on the original grid
+        start = monotonic()
+        self.assertEqual(scheduler.wait(), 0)
+        self.assertLess(monotonic() - start, 0.02)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, SampleScheduler, MIN_INTERVAL / 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
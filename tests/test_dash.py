@@ -0,0 +1,146 @@
+"""
+This file contains the tests of pistatsdash.py, run from the top directory
+with:
+
+$ python -m unittest discover tests
+"""
+
+import curses
+import unittest
+
+import pistatsdash
+from pistatsdash import DashboardRenderer, HEADER_LINES, SORT_CHUNK
+from pistatsstore import StatsStore
+
+# The curses functions the dashboard calls besides the methods of its screen
+CURSES_FUNCTIONS = ("initscr", "noecho", "cbreak", "curs_set", "doupdate", "nocbreak", "echo", "endwin")
+
+
+class FakeScreen(object):
+    # Records the lines drawn instead of sending them to a terminal
+
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+        self.lines = dict()
+        self.drawn = []
+        self.keys = []
+
+    def getmaxyx(self):
+        return self.height, self.width
+
+    def addstr(self, y, x, text, attr=0):
+        self.lines[y] = text
+        self.drawn.append(y)
+
+    def getch(self):
+        return self.keys.pop(0) if self.keys else -1
+
+    def keypad(self, flag):
+        pass
+
+    def nodelay(self, flag):
+        pass
+
+    def move(self, y, x):
+        pass
+
+    def clrtoeol(self):
+        pass
+
+    def erase(self):
+        self.lines.clear()
+
+    def noutrefresh(self):
+        pass
+
+
+class FakeConnection(object):
+    # Records the timers instead of running them
+
+    def __init__(self):
+        self.timeouts = []
+
+    def add_timeout(self, deadline, callback):
+        self.timeouts.append((deadline, callback))
+
+
+def sample(cpu):
+    return {"cpu": cpu, "net": {"eth0": {"rx": 100.0, "tx": 50.0}}}
+
+
+class DashboardRendererTest(unittest.TestCase):
+
+    def setUp(self):
+        self.functions = dict((name, getattr(curses, name)) for name in CURSES_FUNCTIONS)
+        self.screen = FakeScreen(12, 100)
+        for name in CURSES_FUNCTIONS:
+            setattr(curses, name, lambda *args: None)
+        curses.initscr = lambda: self.screen
+        self.store = StatsStore()
+        self.dashboard = DashboardRenderer(FakeConnection(), 1.0, self.store)
+
+    def tearDown(self):
+        self.dashboard.close()
+        for name, function in self.functions.items():
+            setattr(curses, name, function)
+
+    def update(self, key, cpu):
+        self.store.aggregate(key, [sample(cpu)])
+        self.dashboard.mark_dirty(key)
+
+    def rows(self):
+        # The routing keys shown on the device rows
+        return [self.screen.lines[y].split()[0] for y in range(HEADER_LINES, self.screen.height - 1)
+                if self.screen.lines.get(y)]
+
+    def render(self):
+        del self.screen.drawn[:]
+        self.dashboard.render()
+        return sorted(set(self.screen.drawn))
+
+    def test_only_draws_the_visible_rows_that_changed(self):
+        devices = 3 * SORT_CHUNK
+        for i in range(devices):
+            self.update("pi%04d" % (i), 0.5)
+        self.dashboard.start()
+        self.assertEqual(self.render(), range(self.screen.height))
+        self.assertEqual(self.rows(), ["pi%04d" % (i) for i in range(9)])
+        # Devices off the screen don't redraw anything
+        self.update("pi1000", 0.6)
+        self.update("pi0999", 0.7)
+        self.assertEqual(self.render(), [])
+        # An updated device only redraws its row
+        self.update("pi0003", 0.8)
+        self.assertEqual(self.render(), [HEADER_LINES + 3])
+        # A new device is put in place right away
+        self.update("pi0001a", 0.5)
+        self.render()
+        self.assertEqual(self.rows()[:3], ["pi0000", "pi0001", "pi0001a"])
+        self.assertIn("%d device(s)" % (devices + 1), self.screen.lines[0])
+
+    def test_sorted_by_a_metric(self):
+        for i in range(2 * SORT_CHUNK):
+            self.update("pi%04d" % (i), i / 10000.0)
+        self.dashboard.start()
+        self.screen.keys.append(ord("s"))
+        self.dashboard._DashboardRenderer__on_tick()
+        # The busiest devices first
+        self.assertEqual(self.rows()[:3], ["pi0999", "pi0998", "pi0997"])
+        # Moved once the devices are sorted again, the selected device stays selected
+        self.update("pi0000", 0.99)
+        self.assertEqual(self.rows()[:3], ["pi0999", "pi0998", "pi0997"])
+        pistatsdash.RESORT_INTERVAL, interval = 0.0, pistatsdash.RESORT_INTERVAL
+        try:
+            self.render()
+        finally:
+            pistatsdash.RESORT_INTERVAL = interval
+        self.assertEqual(self.rows()[:3], ["pi0000", "pi0999", "pi0998"])
+        # Reversed, the idlest devices first
+        self.screen.keys.extend((ord("r"), ord("g")))
+        self.dashboard._DashboardRenderer__on_tick()
+        self.assertEqual(self.rows()[:3], ["pi0001", "pi0002", "pi0003"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+"""
+This file contains the tests of pistatsfanin.py, run from the top directory
+with:
+
+$ python -m unittest discover tests
+"""
+
+import unittest
+
+from pistatsack import BulkAcknowledger
+
+try:
+    from pistatsfanin import FanInConsumer, DRAIN_SLICE
+except ImportError:
+    # pika isn't installed
+    FanInConsumer = None
+
+
+class FakeChannel(object):
+    # Records the acknowledgements instead of sending them to a broker
+
+    def __init__(self):
+        self.is_open = True
+        self.acks = []
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acks.append(delivery_tag)
+
+
+class FakeIOLoop(object):
+    # Records the timers instead of running them
+
+    def __init__(self):
+        self.timeouts = []
+
+    def add_timeout(self, deadline, callback):
+        self.timeouts.append((deadline, callback))
+
+    def run(self):
+        # Runs the timers until none is left, returning how many ran
+        count = 0
+        while self.timeouts:
+            self.timeouts.pop(0)[1]()
+            count += 1
+        return count
+
+
+class DeliveryInfo(object):
+    # The part of pika.spec.Basic.Deliver the consumer reads
+
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+@unittest.skipIf(FanInConsumer is None, "pika is not installed")
+class FanInConsumerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.handled = []
+        self.brokers = [FakeChannel(), FakeChannel()]
+
+    def fan_in(self, on_message=None, defer_acks=False):
+        if on_message is None:
+            on_message = lambda channel, delivery_info, msg_properties, msg: self.handled.append(msg)
+        fan_in = FanInConsumer(["broker1", "broker2:5673"], "/", None, "pi_utilization", ["#"], on_message,
+                               prefetch=1000, ack_every=1, ack_time=0, defer_acks=defer_acks)
+        fan_in.ioloop = FakeIOLoop()
+        return fan_in
+
+    def enqueue(self, fan_in, broker, tag):
+        channel = self.brokers[broker]
+        fan_in.enqueue(BulkAcknowledger(channel, 1, 0), channel, DeliveryInfo(tag), None, "%d:%d" %(broker, tag))
+
+    def test_messages_of_every_broker_are_handled_and_acknowledged_on_their_channel(self):
+        fan_in = self.fan_in()
+        for tag in range(1, 4):
+            self.enqueue(fan_in, 0, tag)
+            self.enqueue(fan_in, 1, tag)
+        # Nothing is handled from within the consumer callbacks
+        self.assertEqual(self.handled, [])
+        fan_in.ioloop.run()
+        self.assertEqual(self.handled, ["0:1", "1:1", "0:2", "1:2", "0:3", "1:3"])
+        self.assertEqual(self.brokers[0].acks, [1, 2, 3])
+        self.assertEqual(self.brokers[1].acks, [1, 2, 3])
+
+    def test_handled_in_slices(self):
+        fan_in = self.fan_in()
+        for tag in range(1, DRAIN_SLICE * 2 + 2):
+            self.enqueue(fan_in, tag % 2, tag)
+        # The IOLoop gets back control between the slices to serve the brokers
+        self.assertEqual(len(fan_in.ioloop.timeouts), 1)
+        fan_in.ioloop.timeouts.pop()[1]()
+        self.assertEqual(len(self.handled), DRAIN_SLICE)
+        self.assertEqual(fan_in.ioloop.run(), 2)
+        self.assertEqual(len(self.handled), DRAIN_SLICE * 2 + 1)
+        # A message arriving once the queue was drained schedules a new slice
+        self.enqueue(fan_in, 0, 1000)
+        self.assertEqual(fan_in.ioloop.run(), 1)
+        self.assertEqual(self.handled[-1], "0:1000")
+
+    def test_failed_messages_are_acknowledged(self):
+        def on_message(channel, delivery_info, msg_properties, msg):
+            raise ValueError(msg)
+        fan_in = self.fan_in(on_message)
+        self.enqueue(fan_in, 1, 7)
+        self.assertRaises(ValueError, fan_in.ioloop.run)
+        self.assertEqual(self.brokers[1].acks, [7])
+
+    def test_deferred_acknowledgements(self):
+        fan_in = self.fan_in(defer_acks=True)
+        self.enqueue(fan_in, 0, 1)
+        fan_in.ioloop.run()
+        self.assertEqual(self.handled, ["0:1"])
+        # The message handler acknowledges the messages itself
+        self.assertEqual(self.brokers[0].acks, [])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, FanInConsumer, ["broker1"], "/", None, "pi_utilization", ["#"], None,
+                          prefetch=10, ack_every=20)
+
+
+if __name__ == "__main__":
+    unittest.main()
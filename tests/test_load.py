@@ -0,0 +1,44 @@
+"""
+This file contains the tests of pistatsload.py, run from the top directory
+with:
+
+$ python -m unittest discover tests
+"""
+
+import sys
+import unittest
+from StringIO import StringIO
+
+import pistatsload
+from pistatscodec import StatsEncoder
+from pistatscommon import SAMPLED_HEADER
+from pistatspublisher import BatchPublisher
+
+
+class StandInTest(unittest.TestCase):
+
+    def test_publishes_without_pika(self):
+        channel = pistatsload.StandInChannel()
+        publisher = BatchPublisher(channel, "pistats", "pi0", StatsEncoder("json"), batch_size=2)
+        publisher.add({"cpu": 0.5, "net": {}}, 0.0)
+        publisher.add({"cpu": 0.6, "net": {}}, 1.0)
+        routing_key, body, properties = channel.msgs.popleft()
+        self.assertEqual(routing_key, "pi0")
+        self.assertEqual(properties.content_type, StatsEncoder("json").content_type)
+        self.assertIn(SAMPLED_HEADER, properties.headers)
+        self.assertEqual(publisher.published_samples, 2)
+
+    def test_fleet(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            pistatsload.main(["pistatsload.py", "-n", "5", "--duration", "3s", "--fast", "--seed", "1"])
+            report = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertIn("Published 15 sample(s) in 15 message(s)", report)
+        self.assertIn("The stand-in viewer handled 15 message(s)", report)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+"""
+This file contains the tests of pistatsmetrics.py, run from the top directory
+with:
+
+$ python -m unittest discover tests
+"""
+
+import unittest
+
+from pistatsmetrics import Metrics
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_prometheus_text(self):
+        metrics = Metrics("pistatsd")
+        metrics.count("messages_total", 3)
+        metrics.gauge("spool_samples", 12)
+        metrics.observe("encode_seconds", 0.5)
+        lines = metrics.prometheus_text().splitlines()
+        self.assertEqual(lines[:4], ["# TYPE pistatsd_messages_total counter", "pistatsd_messages_total 3",
+                                     "# TYPE pistatsd_spool_samples gauge", "pistatsd_spool_samples 12"])
+        self.assertIn("# TYPE pistatsd_encode_seconds summary", lines)
+        self.assertIn("pistatsd_encode_seconds_count 1", lines)
+
+    def test_stats_line(self):
+        metrics = Metrics("pistatsd")
+        # The first line starts the interval
+        metrics.stats_line(100.0)
+        metrics.count("messages_total", 10)
+        metrics.gauge("spool_samples", 4)
+        self.assertEqual(metrics.stats_line(102.0), "messages/s=5.0 spool_samples=4")
+
+    def test_merge(self):
+        metrics, worker = Metrics("pistatsview"), Metrics("pistatsview")
+        metrics.count("samples_total", 2)
+        worker.count("samples_total", 3)
+        worker.gauge("queued", 7)
+        worker.observe("decode_seconds", 0.001)
+        metrics.merge(worker)
+        self.assertEqual(metrics.counters, {"samples_total": 5})
+        self.assertEqual(metrics.gauges, {"queued": 7})
+        self.assertEqual(metrics.summaries["decode_seconds"].count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
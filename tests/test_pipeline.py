@@ -0,0 +1,121 @@
+"""
+This file contains the tests of pistatspipeline.py, run from the top directory
+with:
+
+$ python -m unittest discover tests
+"""
+
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import unittest
+from StringIO import StringIO
+
+from pistatscodec import StatsDecoder
+from pistatsmetrics import Metrics
+from pistatspipeline import ShardedPipeline
+from pistatsstore import StatsStore, handle_msg, CURRENT, MAX, MIN
+
+SPANS = (("1m", 60.0),)
+
+
+def messages(count, devices):
+    for index in range(count):
+        yield "pi%d" % (index % devices), json.dumps({"cpu": (index % 7) / 10.0, "cores": [index % 3 / 10.0],
+                                                      "net": {"eth0": {"rx": float(index), "tx": 1.0}}})
+
+
+class ShardedPipelineTest(unittest.TestCase):
+
+    def test_handled_in_submission_order(self):
+        pipeline = ShardedPipeline(2, batch_size=4)
+        try:
+            for tag, (routing_key, msg) in enumerate(messages(50, 5)):
+                pipeline.submit(routing_key, None, msg, tag)
+            # Nothing is handled before the results of the workers are returned
+            self.assertEqual(pipeline.handled(), [])
+        finally:
+            devices = pipeline.close()
+        self.assertEqual(pipeline.handled(), range(50))
+        self.assertEqual(sorted(set(device.routing_key for device in devices)), ["pi%d" % i for i in range(5)])
+        self.assertEqual(pipeline.submitted_msgs, 50)
+
+    def test_untracked_messages(self):
+        pipeline = ShardedPipeline(1)
+        pipeline.submit("pi0", None, json.dumps({"cpu": 0.5, "net": {}}), "first")
+        pipeline.submit("pi0", None, json.dumps({"cpu": 0.5, "net": {}}))
+        pipeline.close()
+        self.assertEqual(pipeline.handled(), ["first"])
+
+    def test_merged_like_inline(self):
+        inline = StatsStore(SPANS)
+        decoder = StatsDecoder()
+        merged = StatsStore(SPANS)
+        metrics = Metrics("pistatsview")
+        pipeline = ShardedPipeline(3, batch_size=8, spans=SPANS, metrics=metrics, flush_every=16)
+        try:
+            for routing_key, msg in messages(200, 7):
+                handle_msg(decoder, inline, routing_key, None, msg)
+                pipeline.submit(routing_key, None, msg)
+                for device in pipeline.collect():
+                    merged.merge(device)
+        finally:
+            for device in pipeline.close():
+                merged.merge(device)
+
+        self.assertEqual(sorted(merged.devices), sorted(inline.devices))
+        for routing_key, device in inline.devices.items():
+            other = merged.devices[routing_key]
+            for i in (CURRENT, MAX, MIN):
+                self.assertEqual(other.cpu[i], device.cpu[i])
+            self.assertEqual(list(other.net["eth0"]), list(device.net["eth0"]))
+            self.assertEqual(sorted(other.windows), sorted(device.windows))
+            for key, windows in device.windows.items():
+                self.assertEqual(len(other.windows[key][0]), len(windows[0]))
+                self.assertAlmostEqual(other.windows[key][0].mean(), windows[0].mean())
+                self.assertEqual(other.windows[key][0].max(), windows[0].max())
+        # The workers timed every message
+        self.assertEqual(metrics.summaries["decode_seconds"].count, 200)
+
+    def test_bad_message_doesnt_stop_the_worker(self):
+        pipeline = ShardedPipeline(1)
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            pipeline.submit("pi0", None, json.dumps({"cpu": 0.5, "net": {}}), 1)
+            # A sample that breaks the aggregation
+            pipeline.submit("pi0", None, json.dumps({"cpu": "busy", "net": {}}), 2)
+            pipeline.submit("pi1", None, json.dumps({"cpu": 0.5, "net": {}}), 3)
+            devices = pipeline.close()
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(pipeline.handled(), [1, 2, 3])
+        self.assertEqual(sorted(device.routing_key for device in devices), ["pi0", "pi1"])
+        self.assertEqual(pipeline.failed_msgs, 1)
+
+    def test_dead_worker_is_reported(self):
+        pipeline = ShardedPipeline(1, batch_size=1)
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            # The only child process is the worker
+            worker, = multiprocessing.active_children()
+            os.kill(worker.pid, signal.SIGKILL)
+            worker.join()
+            # Submitting fills the queue of the dead worker, then fails instead of waiting forever
+            self.assertRaises(RuntimeError, lambda: [pipeline.submit("pi0", None, "{}") for i in range(100)])
+            pipeline.close()
+            warning = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertIn("Warning: Pipeline worker 0 exited unexpectedly", warning)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, ShardedPipeline, 0)
+        self.assertRaises(ValueError, ShardedPipeline, 1, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
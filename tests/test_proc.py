@@ -0,0 +1,159 @@
+"""
+This file contains the tests of pistatsproc.py, run from the top directory
+with:
+
+$ python -m unittest discover tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pistatscommon import CPU_STATES
+from pistatsproc import CpuStatSampler, NetDevSampler, build_utilization_msg
+
+STAT = """cpu  %d 0 %d %d 0 0 0 0 0 0
+cpu0 %d 0 0 %d 0 0 0 0 0 0
+cpu1 0 0 %d %d 0 0 0 0 0 0
+intr 1234 0 0 0
+ctxt 5678
+"""
+
+STAT_ONE_CORE = """cpu  %d 0 %d %d 0 0 0 0 0 0
+cpu0 %d 0 %d %d 0 0 0 0 0 0
+intr 1234 0 0 0
+"""
+
+STAT_IOWAIT = """cpu  %d 0 0 %d %d 0 0 0 0 0
+"""
+
+NET_DEV = """Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+    lo:%8d       2    0    0    0     0          0         0 %8d       2    0    0    0     0       0          0
+  eth0:%8d       3    0    0    0     0          0         0 %8d       4    0    0    0     0       0          0
+"""
+
+
+class SamplerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.stat = os.path.join(self.directory, "stat")
+        self.net_dev = os.path.join(self.directory, "dev")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, path, text):
+        # Rewrites the file in place, the samplers keep it open
+        with open(path, "w") as proc_file:
+            proc_file.write(text)
+
+    def test_cpu_utilization(self):
+        self.write(self.stat, STAT % (100, 100, 800, 100, 400, 100, 400))
+        sampler = CpuStatSampler(self.stat)
+        sampler.sample()
+        self.assertEqual(sampler.cores, 2)
+        self.write(self.stat, STAT % (250, 150, 1000, 250, 450, 150, 550))
+        sampler.sample()
+        cpu, states, cores = sampler.utilization()
+        self.assertAlmostEqual(cpu, 0.5)
+        self.assertAlmostEqual(states[0], 0.375)
+        self.assertAlmostEqual(states[3], 0.5)
+        self.assertEqual(cores, [0.75, 0.25])
+        sampler.close()
+
+    def test_cores_going_offline(self):
+        self.write(self.stat, STAT % (100, 100, 800, 100, 400, 100, 400))
+        sampler = CpuStatSampler(self.stat)
+        sampler.sample()
+        self.write(self.stat, STAT_ONE_CORE % (200, 100, 900, 100, 0, 400))
+        sampler.sample()
+        cpu, states, cores = sampler.utilization()
+        # The overall utilization is still known, the cores' only from the next sample on
+        self.assertAlmostEqual(cpu, 0.5)
+        self.assertEqual((sampler.cores, cores), (1, None))
+        self.write(self.stat, STAT_ONE_CORE % (300, 100, 1000, 150, 0, 450))
+        sampler.sample()
+        self.assertEqual(sampler.utilization()[2], [0.5])
+        sampler.close()
+
+    def test_iowait_counts_as_idle(self):
+        self.write(self.stat, STAT_IOWAIT % (0, 100, 0))
+        sampler = CpuStatSampler(self.stat)
+        sampler.sample()
+        self.write(self.stat, STAT_IOWAIT % (100, 100, 100))
+        sampler.sample()
+        cpu, states, cores = sampler.utilization()
+        self.assertAlmostEqual(cpu, 0.5)
+        self.assertEqual(dict(zip(CPU_STATES, states))["iowait"], 0.5)
+        self.assertEqual(cores, [])
+        sampler.close()
+
+    def test_utilization_msg(self):
+        self.write(self.stat, STAT % (100, 100, 800, 100, 400, 100, 400))
+        self.write(self.net_dev, NET_DEV % (1000, 1000, 500, 200))
+        cpu_sampler = CpuStatSampler(self.stat)
+        net_sampler = NetDevSampler(self.net_dev, ("rx", "tx"))
+        cpu_sampler.sample()
+        net_sampler.sample()
+        cpu_sampler.sample()
+        net_sampler.sample()
+        # No tick elapsed between the samples
+        msg = build_utilization_msg(cpu_sampler, net_sampler, 1.0)
+        self.assertEqual((msg["cpu"], msg["cores"]), (0.0, [0.0, 0.0]))
+        self.assertEqual(msg["cpu_states"], dict((state, 0.0) for state in CPU_STATES))
+        # The cores are left out of the sample during which they changed
+        self.write(self.stat, STAT_ONE_CORE % (200, 100, 900, 100, 0, 400))
+        cpu_sampler.sample()
+        net_sampler.sample()
+        self.assertNotIn("cores", build_utilization_msg(cpu_sampler, net_sampler, 1.0))
+        cpu_sampler.close()
+        net_sampler.close()
+
+    def test_net_rates(self):
+        self.write(self.net_dev, NET_DEV % (1000, 1000, 500, 200))
+        sampler = NetDevSampler(self.net_dev)
+        sampler.sample()
+        self.write(self.net_dev, NET_DEV % (3000, 3000, 1500, 1201))
+        sampler.sample()
+        rates = sampler.rates(2.0)
+        self.assertEqual(sorted(rates), ["eth0", "lo"])
+        self.assertEqual((rates["lo"]["rx"], rates["lo"]["tx"]), (1000, 1000))
+        # The byte rates are truncated, the other counters are not
+        self.assertEqual((rates["eth0"]["rx"], rates["eth0"]["tx"]), (500, 500))
+        self.assertEqual(rates["eth0"]["rx_packets"], 0.0)
+        sampler.close()
+
+    def test_sampled_counters(self):
+        self.write(self.net_dev, NET_DEV % (1000, 1000, 500, 200))
+        sampler = NetDevSampler(self.net_dev, ("tx", "rx"))
+        sampler.sample()
+        sampler.sample()
+        self.assertEqual(sampler.rates(1.0), {"lo": {"rx": 0, "tx": 0}, "eth0": {"rx": 0, "tx": 0}})
+        self.assertRaises(ValueError, NetDevSampler, self.net_dev, ("rx",))
+        self.assertRaises(ValueError, NetDevSampler, self.net_dev, ("rx", "tx", "bogus"))
+        sampler.close()
+
+    def test_messages_dont_share_their_rates(self):
+        # The publisher keeps the messages of a batch, a later sample must not change them
+        self.write(self.stat, STAT % (100, 100, 800, 100, 400, 100, 400))
+        self.write(self.net_dev, NET_DEV % (1000, 1000, 500, 200))
+        cpu_sampler = CpuStatSampler(self.stat)
+        net_sampler = NetDevSampler(self.net_dev, ("rx", "tx"))
+        cpu_sampler.sample()
+        net_sampler.sample()
+        cpu_sampler.sample()
+        net_sampler.sample()
+        first = build_utilization_msg(cpu_sampler, net_sampler, 1.0)
+        self.write(self.net_dev, NET_DEV % (2000, 1000, 500, 200))
+        net_sampler.sample()
+        second = build_utilization_msg(cpu_sampler, net_sampler, 1.0)
+        self.assertEqual((first["net"]["lo"]["rx"], second["net"]["lo"]["rx"]), (0, 1000))
+        cpu_sampler.close()
+        net_sampler.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,297 @@
+"""
+This file contains the tests of pistatspublisher.py, run from the top directory
+with:
+
+$ python -m unittest discover tests
+"""
+
+import json
+import sys
+import unittest
+from StringIO import StringIO
+
+from pistatscodec import StatsEncoder
+from pistatscommon import SAMPLED_HEADER
+from pistatspublisher import BatchPublisher, ReconnectingPublisher, DeltaSuppressor, SampleSummarizer
+
+try:
+    import pika.exceptions
+except ImportError:
+    pika = None
+
+
+def sample(cpu):
+    return {"cpu": cpu, "net": {"eth0": {"rx": 100, "tx": 50}}}
+
+
+class FakeProperties(object):
+    # Stands in for pika.BasicProperties
+
+    def __init__(self, content_type=None, headers=None):
+        self.content_type = content_type
+        self.headers = headers
+
+
+class FakeChannel(object):
+    # Records the messages instead of sending them to a broker
+
+    basic_properties = FakeProperties
+
+    def __init__(self, delivered=True):
+        self.delivered = delivered
+        self.confirming = False
+        self.messages = []
+
+    def confirm_delivery(self):
+        self.confirming = True
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.messages.append((exchange, routing_key, json.loads(body), properties))
+        return self.delivered
+
+
+class FakeBroker(object):
+    # Hands out channels that fail, like the connection attempts, while the broker is down
+
+    def __init__(self):
+        self.down = False
+        self.attempts = 0
+        self.channels = []
+
+    def connect(self):
+        self.attempts += 1
+        if self.down:
+            raise pika.exceptions.AMQPConnectionError("Connection refused")
+        channel = FlakyChannel(self)
+        self.channels.append(channel)
+        return FakeConnection(), channel
+
+    def samples(self):
+        # The samples received, in publishing order
+        result = []
+        for channel in self.channels:
+            for msg in channel.messages:
+                if isinstance(msg[2], list):
+                    result.extend(msg[2])
+                else:
+                    result.append(msg[2])
+        return result
+
+
+class FlakyChannel(FakeChannel):
+    # Fails to publish while its broker is down
+
+    def __init__(self, broker):
+        FakeChannel.__init__(self)
+        self.broker = broker
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        if self.broker.down:
+            raise pika.exceptions.AMQPConnectionError("Connection reset")
+        return FakeChannel.basic_publish(self, exchange, routing_key, body, properties)
+
+
+class FakeConnection(object):
+    # Stands in for pika.BlockingConnection
+
+    def close(self):
+        pass
+
+
+class BatchPublisherTest(unittest.TestCase):
+
+    def test_publishes_full_batches(self):
+        channel = FakeChannel()
+        publisher = BatchPublisher(channel, "stats", "pi0", StatsEncoder("compact"), batch_size=3)
+        for index in range(7):
+            publisher.add(sample(index / 10.0), index)
+        self.assertEqual([msg[2] for msg in channel.messages],
+                         [[sample(0.0), sample(0.1), sample(0.2)], [sample(0.3), sample(0.4), sample(0.5)]])
+        exchange, routing_key, body, properties = channel.messages[0]
+        self.assertEqual((exchange, routing_key, properties.content_type), ("stats", "pi0", "application/json"))
+        self.assertIn(SAMPLED_HEADER, properties.headers)
+        publisher.flush()
+        # A batch of one is sent as a single sample
+        self.assertEqual(channel.messages[-1][2], sample(0.6))
+        self.assertEqual((publisher.published_msgs, publisher.published_samples), (3, 7))
+
+    def test_publishes_old_batches(self):
+        channel = FakeChannel()
+        publisher = BatchPublisher(channel, "stats", "pi0", StatsEncoder("compact"), batch_size=100,
+                                   batch_time=2.0)
+        publisher.add(sample(0.1), 10.0)
+        publisher.add(sample(0.2), 11.0)
+        self.assertEqual(channel.messages, [])
+        publisher.add(sample(0.3), 12.0)
+        self.assertEqual(channel.messages[0][2], [sample(0.1), sample(0.2), sample(0.3)])
+
+    def test_counts_unconfirmed_messages(self):
+        channel = FakeChannel(delivered=False)
+        publisher = BatchPublisher(channel, "stats", "pi0", StatsEncoder("compact"), confirm=True)
+        self.assertTrue(channel.confirming)
+        publisher.add(sample(0.1), 0.0)
+        publisher.add(sample(0.2), 1.0)
+        self.assertEqual(publisher.unconfirmed_msgs, 2)
+
+        # Without confirmations nothing is counted
+        publisher = BatchPublisher(FakeChannel(delivered=False), "stats", "pi0", StatsEncoder("compact"))
+        publisher.add(sample(0.1), 0.0)
+        self.assertEqual(publisher.unconfirmed_msgs, 0)
+
+    def test_take_batch_and_reopen(self):
+        channel = FakeChannel()
+        publisher = BatchPublisher(channel, "stats", "pi0", StatsEncoder("compact"), batch_size=3, confirm=True)
+        publisher.add(sample(0.1), 0.0)
+        publisher.add(sample(0.2), 1.0)
+        self.assertEqual(publisher.take_batch(), [sample(0.1), sample(0.2)])
+        # The samples taken aren't published again
+        publisher.flush()
+        self.assertEqual(channel.messages, [])
+
+        other = FakeChannel()
+        publisher.reopen(other)
+        self.assertTrue(other.confirming)
+        publisher.publish([sample(0.3)])
+        self.assertEqual(other.messages[0][2], sample(0.3))
+        # Replayed samples carry no sampling time
+        self.assertEqual(other.messages[0][3].headers, None)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, BatchPublisher, FakeChannel(), "stats", "pi0", StatsEncoder(), 0)
+
+
+@unittest.skipIf(pika is None, "pika is not installed")
+class ReconnectingPublisherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = FakeBroker()
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+
+    def test_reconnects_with_backoff_and_drains_the_spool(self):
+        publisher = ReconnectingPublisher(self.broker.connect, "stats", "pi0", StatsEncoder("compact"), drain_rate=10)
+        published = [sample(0.0)]
+        publisher.add(published[-1], 0.0)
+
+        self.broker.down = True
+        for index, now in enumerate((1.0, 1.0, 1.4, 2.0)):
+            published.append(sample(index + 1))
+            publisher.add(published[-1], now)
+        self.assertEqual(publisher.lost_connections, 1)
+        self.assertIn("Warning: Lost the connection to the message broker", sys.stderr.getvalue())
+        # Attempted right away, then after a second and then after two seconds, both shortened by up to half
+        self.assertEqual(self.broker.attempts, 3)
+        for index in range(20):
+            published.append(sample(index + 5))
+            publisher.add(published[-1], 2.9)
+        self.assertEqual(self.broker.attempts, 3)
+
+        self.broker.down = False
+        published.append(sample(0.5))
+        publisher.add(published[-1], 4.0)
+        self.assertEqual((self.broker.attempts, publisher.reconnects), (4, 1))
+        # The spooled samples are replayed at drain_rate samples per second, the new samples queue up behind them
+        self.assertEqual(publisher.replayed_samples, 0)
+        published.append(sample(0.6))
+        publisher.add(published[-1], 4.5)
+        self.assertEqual(publisher.replayed_samples, 5)
+        published.append(sample(0.7))
+        publisher.add(published[-1], 6.0)
+        self.assertEqual(publisher.replayed_samples, 15)
+        # Flushing replays the rest at once
+        publisher.flush()
+        self.assertEqual(publisher.replayed_samples, 27)
+        self.assertEqual(self.broker.samples(), published)
+        publisher.close()
+        self.assertEqual(publisher.dropped_samples, 0)
+
+    def test_batch_is_spooled_once_lost(self):
+        publisher = ReconnectingPublisher(self.broker.connect, "stats", "pi0", StatsEncoder("compact"), batch_size=2)
+        publisher.add(sample(0.1), 0.0)
+        self.broker.down = True
+        publisher.add(sample(0.2), 1.0)
+        self.broker.down = False
+        publisher.add(sample(0.3), 1.0)
+        publisher.flush()
+        self.assertEqual(self.broker.samples(), [sample(0.1), sample(0.2), sample(0.3)])
+        # The sample taken while disconnected is spooled behind the batch
+        self.assertEqual(publisher.replayed_samples, 3)
+
+    def test_unpublished_samples_are_dropped_on_close(self):
+        publisher = ReconnectingPublisher(self.broker.connect, "stats", "pi0", StatsEncoder("compact"), batch_size=5)
+        publisher.add(sample(0.1), 0.0)
+        publisher.add(sample(0.2), 1.0)
+        publisher.close()
+        self.assertEqual(publisher.dropped_samples, 2)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, ReconnectingPublisher, self.broker.connect, "stats", "pi0", StatsEncoder(),
+                          drain_rate=0)
+
+
+class DeltaSuppressorTest(unittest.TestCase):
+
+    def test_keyframes_and_deltas(self):
+        suppressor = DeltaSuppressor(3)
+        first = {"cpu": 0.5, "net": {"eth0": {"rx": 100, "tx": 50, "rx_errs": 0.0}, "wlan0": {"rx": 10, "tx": 5}}}
+        self.assertIs(suppressor.filter(first), first)
+        # Only the counters that moved are sent, and the interfaces that didn't move are left out
+        self.assertEqual(suppressor.filter({"cpu": 0.6, "net": {"eth0": {"rx": 120, "tx": 50, "rx_errs": 1.0},
+                                                                "wlan0": {"rx": 10, "tx": 5}}}),
+                         {"cpu": 0.6, "net": {"eth0": {"rx": 120, "rx_errs": 1.0}}, "delta": True})
+        # Changes are measured against the values sent last, not against the keyframe
+        self.assertEqual(suppressor.filter({"cpu": 0.7, "net": {"eth0": {"rx": 120, "tx": 50, "rx_errs": 1.0},
+                                                                "wlan0": {"rx": 10, "tx": 6}}}),
+                         {"cpu": 0.7, "net": {"wlan0": {"tx": 6}}, "delta": True})
+        fourth = {"cpu": 0.7, "net": {"eth0": {"rx": 120, "tx": 50, "rx_errs": 1.0}}}
+        self.assertIs(suppressor.filter(fourth), fourth)
+
+    def test_new_interfaces_are_sent_in_full(self):
+        suppressor = DeltaSuppressor(10)
+        suppressor.filter({"cpu": 0.5, "net": {"eth0": {"rx": 100, "tx": 50}}})
+        self.assertEqual(suppressor.filter({"cpu": 0.5, "net": {"eth0": {"rx": 100, "tx": 50},
+                                                                "usb0": {"rx": 1, "tx": 0}}})["net"],
+                         {"usb0": {"rx": 1, "tx": 0}})
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, DeltaSuppressor, 0)
+
+
+class SampleSummarizerTest(unittest.TestCase):
+
+    def test_summarizes_each_period(self):
+        summarizer = SampleSummarizer(1.0)
+        due = []
+        for index, cpu in enumerate((0.2, 0.8, 0.5, 0.1)):
+            due.extend(summarizer.add({"cpu": cpu, "cores": [cpu, 1.0 - cpu],
+                                       "net": {"eth0": {"rx": 100 * (index + 1), "tx": 10}}}, index * 0.5))
+        # The period ends with the third sample, the fourth starts the next one
+        summary, = due
+        self.assertAlmostEqual(summary["cpu"], 0.5)
+        self.assertEqual(summary["net"]["eth0"], {"rx": 200, "tx": 10})
+        self.assertEqual(summary["summary"]["samples"], 3)
+        self.assertEqual((summary["summary"]["max"]["cpu"], summary["summary"]["min"]["cpu"]), (0.8, 0.2))
+        self.assertEqual(summary["summary"]["max"]["cores"], [0.8, 0.8])
+        self.assertEqual(summary["summary"]["min"]["net"]["eth0"]["rx"], 100)
+        self.assertEqual(summarizer.flush()["summary"]["samples"], 1)
+        self.assertEqual(summarizer.flush(), None)
+        self.assertEqual((summarizer.summaries, summarizer.summarized_samples), (2, 4))
+
+    def test_raw_samples_around_a_spike(self):
+        summarizer = SampleSummarizer(10.0, burst_threshold=0.9, burst_samples=3)
+        samples = [{"cpu": cpu, "net": {}} for cpu in (0.1, 0.2, 0.3, 0.95, 0.97, 0.99, 0.2, 0.96)]
+        due = [summarizer.add(msg, index * 0.1) for index, msg in enumerate(samples)]
+        # The spike is sent along with the samples just before it, up to burst_samples per period
+        self.assertEqual(due, [[], [], [], [samples[1], samples[2], samples[3]], [], [], [], []])
+        self.assertEqual(summarizer.raw_samples, 3)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, SampleSummarizer, 0)
+        self.assertRaises(ValueError, SampleSummarizer, 1.0, 0.9, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
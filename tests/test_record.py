@@ -0,0 +1,112 @@
+"""
+This file contains the tests of pistatsrecord.py, run from the top directory
+with:
+
+$ python -m unittest discover tests
+"""
+
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from pistatscodec import StatsEncoder, StatsDecoder
+from pistatsrecord import SegmentRecorder, SegmentReader, list_segments
+from pistatsstore import StatsStore
+
+
+def sample(cpu):
+    return {"cpu": cpu, "cores": [cpu, cpu], "net": {"eth0": {"rx": 100.0, "tx": 50.0}}}
+
+
+class SegmentRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+    def tearDown(self):
+        resource.setrlimit(resource.RLIMIT_NOFILE, self.limits)
+        shutil.rmtree(self.directory)
+
+    def test_records_more_devices_than_file_descriptors(self):
+        # Every open segment holds a descriptor, more devices than the limit must still be recorded
+        resource.setrlimit(resource.RLIMIT_NOFILE, (64, self.limits[1]))
+        recorder = SegmentRecorder(self.directory)
+        store = StatsStore((), recorder)
+        devices = 200
+        for step in range(3):
+            for device in range(devices):
+                store.aggregate("pi%d" % device, [sample(0.1 * step)])
+        recorder.close()
+
+        self.assertFalse(recorder.disabled)
+        self.assertEqual(recorder.records, devices * 3)
+        # Closed segments are reopened and continued rather than new ones started
+        self.assertEqual(recorder.segments, devices)
+        segments = list_segments(self.directory)
+        self.assertEqual(len(segments), devices)
+        reader = SegmentReader(segments["pi7"][0])
+        try:
+            self.assertEqual(reader.rows(), 3)
+            self.assertEqual([round(value, 6) for value in reader.column("cpu")], [0.0, 0.1, 0.2])
+        finally:
+            reader.close()
+
+    def test_records_decoded_messages(self):
+        # The decoded interface names are unicode, and may not be ascii
+        recorder = SegmentRecorder(self.directory)
+        store = StatsStore((), recorder)
+        name = u"wlan\u00e9"
+        for fmt in ("compact", "struct"):
+            encoder = StatsEncoder(fmt)
+            decoder = StatsDecoder()
+            msg = {"cpu": 0.5, "cores": [0.5], "net": {"eth0": {"rx": 100.0, "tx": 50.0}, name: {"rx": 1.0, "tx": 2.0}}}
+            for step in range(2):
+                store.aggregate(fmt, decoder.decode(fmt, encoder.content_type, encoder.encode(msg)))
+        recorder.close()
+
+        self.assertFalse(recorder.disabled)
+        self.assertEqual(recorder.records, 4)
+        for fmt in ("compact", "struct"):
+            reader = SegmentReader(list_segments(self.directory)[fmt][0])
+            try:
+                self.assertEqual(list(reader.column(name.encode("utf-8") + ".tx")), [2.0, 2.0])
+                self.assertEqual(list(reader.column("eth0.rx")), [100.0, 100.0])
+            finally:
+                reader.close()
+
+    def test_new_cores_start_a_segment(self):
+        recorder = SegmentRecorder(self.directory, max_open=1)
+        store = StatsStore((), recorder)
+        store.aggregate("pi0", [sample(0.5)])
+        store.aggregate("pi1", [sample(0.5)])
+        store.aggregate("pi0", [{"cpu": 0.5, "cores": [0.5], "net": {}}])
+        recorder.close()
+        self.assertEqual(recorder.segments, 3)
+        self.assertEqual(len(list_segments(self.directory)["pi0"]), 2)
+
+    def test_failure_disables_recording(self):
+        # A file where the device directory should be created makes the segment fail
+        path = os.path.join(self.directory, "not-a-directory")
+        open(path, "w").close()
+        recorder = SegmentRecorder(path)
+        store = StatsStore((), recorder)
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            store.aggregate("pi0", [sample(0.5)])
+            store.aggregate("pi0", [sample(0.5)])
+            warning = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertTrue(recorder.disabled)
+        self.assertEqual(recorder.records, 0)
+        self.assertEqual(warning.count("Warning: Recording disabled"), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+"""
+This file contains the tests of pistatsrender.py, run from the top directory
+with:
+
+$ python -m unittest discover tests
+"""
+
+import unittest
+
+import pistatsrender
+from pistatsrender import StatsRenderScheduler, changed_rows
+from pistatsstore import StatsStore
+
+
+class FakeConnection(object):
+    # Records the timers instead of running them
+
+    def __init__(self):
+        self.timeouts = []
+
+    def add_timeout(self, deadline, callback):
+        self.timeouts.append((deadline, callback))
+
+
+def sample(cpu):
+    return {"cpu": cpu, "net": {"eth0": {"rx": 100.0, "tx": 50.0}}}
+
+
+class ChangedRowsTest(unittest.TestCase):
+
+    def test_only_changed_rows(self):
+        last_rows = dict()
+        rows = [["CPU", 0.5, 0.5, 0.5], ["CPU0", 0.2, 0.2, 0.2]]
+        self.assertEqual(changed_rows(rows, last_rows, 1), rows)
+        self.assertEqual(changed_rows(rows, last_rows, 1), [])
+        rows[1] = ["CPU0", 0.3, 0.3, 0.2]
+        self.assertEqual(changed_rows(rows, last_rows, 1), [["CPU0", 0.3, 0.3, 0.2]])
+
+
+class StatsRenderSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        # Records the devices displayed instead of printing their tables
+        self.shown = []
+        self.show_stats_history = pistatsrender.show_stats_history
+        pistatsrender.show_stats_history = lambda device, last_rows=None: self.shown.append(device.routing_key)
+        self.store = StatsStore()
+        self.connection = FakeConnection()
+
+    def tearDown(self):
+        pistatsrender.show_stats_history = self.show_stats_history
+
+    def update(self, scheduler, routing_key, cpu):
+        self.store.aggregate(routing_key, [sample(cpu)])
+        scheduler.mark_dirty(routing_key)
+
+    def test_redraws_each_dirty_device_once(self):
+        scheduler = StatsRenderScheduler(self.connection, 0.5, self.store)
+        scheduler.start()
+        self.update(scheduler, "pi0", 0.1)
+        self.update(scheduler, "pi1", 0.2)
+        self.update(scheduler, "pi0", 0.3)
+        # Nothing is displayed before the timer fires
+        self.assertEqual(self.shown, [])
+        deadline, callback = self.connection.timeouts.pop()
+        self.assertEqual(deadline, 0.5)
+        callback()
+        self.assertEqual(self.shown, ["pi0", "pi1"])
+        # The timer is scheduled again and an idle refresh displays nothing
+        self.connection.timeouts.pop()[1]()
+        self.assertEqual(self.shown, ["pi0", "pi1"])
+
+    def test_no_refresh_redraws_every_message(self):
+        scheduler = StatsRenderScheduler(self.connection, 0, self.store)
+        scheduler.start()
+        self.update(scheduler, "pi0", 0.1)
+        self.update(scheduler, "pi0", 0.2)
+        self.assertEqual(self.shown, ["pi0", "pi0"])
+        self.assertEqual(self.connection.timeouts, [])
+
+    def test_close_displays_the_pending_updates(self):
+        scheduler = StatsRenderScheduler(self.connection, 10.0, self.store)
+        self.update(scheduler, "pi0", 0.1)
+        # Unknown devices are skipped
+        scheduler.mark_dirty("pi9")
+        scheduler.close()
+        self.assertEqual(self.shown, ["pi0"])
+
+
+if __name__ == "__main__":
+    unittest.main()
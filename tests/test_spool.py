@@ -0,0 +1,106 @@
+"""
+This file contains the tests of pistatsspool.py, run from the top directory
+with:
+
+$ python -m unittest discover tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pistatsspool import SampleSpool
+
+
+def sample(index):
+    return {"cpu": index / 100.0, "net": {}}
+
+
+class SampleSpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "spill")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_drops_the_oldest_samples(self):
+        spool = SampleSpool(3)
+        for index in range(5):
+            spool.append(sample(index))
+        self.assertEqual(len(spool), 3)
+        self.assertEqual(spool.dropped_samples, 2)
+        self.assertEqual(spool.peek(10), [sample(2), sample(3), sample(4)])
+        self.assertEqual(spool.close(), 3)
+
+    def test_peek_keeps_the_samples_until_discarded(self):
+        spool = SampleSpool(10)
+        for index in range(5):
+            spool.append(sample(index))
+        self.assertEqual(spool.peek(2), [sample(0), sample(1)])
+        self.assertEqual(spool.peek(2), [sample(0), sample(1)])
+        spool.discard()
+        self.assertEqual(len(spool), 3)
+        self.assertEqual(spool.peek(10), [sample(2), sample(3), sample(4)])
+
+    def test_spills_and_replays_in_order(self):
+        spool = SampleSpool(2, self.path)
+        for index in range(7):
+            spool.append(sample(index))
+        self.assertEqual(len(spool), 7)
+        self.assertEqual(spool.spilled_samples, 5)
+        self.assertEqual(spool.dropped_samples, 0)
+
+        replayed = []
+        while len(spool):
+            samples = spool.peek(3)
+            replayed.extend(samples)
+            spool.discard()
+        self.assertEqual(replayed, [sample(index) for index in range(7)])
+        # The spill file starts over once every spilled sample was read back
+        self.assertEqual(os.path.getsize(self.path), 0)
+        spool.close()
+
+    def test_unpublished_samples_are_kept_for_the_next_run(self):
+        spool = SampleSpool(2, self.path)
+        for index in range(5):
+            spool.append(sample(index))
+        spool.peek(2)
+        spool.discard()
+        self.assertEqual(spool.close(), 0)
+
+        spool = SampleSpool(2, self.path)
+        self.assertEqual(len(spool), 3)
+        spool.append(sample(5))
+        self.assertEqual(spool.peek(10), [sample(index) for index in range(2, 6)])
+        spool.close()
+
+    def test_bounded_spill_file(self):
+        line = len('{"cpu":0.0,"net":{}}\n')
+        spool = SampleSpool(1, self.path, spill_bytes=2 * line)
+        for index in range(5):
+            spool.append(sample(0))
+        self.assertEqual(spool.spilled_samples, 2)
+        self.assertEqual(spool.dropped_samples, 2)
+        self.assertEqual(len(spool), 3)
+        spool.close()
+
+    def test_corrupt_samples_are_dropped(self):
+        # A sample only partly written before the previous run ended
+        with open(self.path, "w") as spill:
+            spill.write('{"cpu":0.0,"net":{}}\n{"cpu":0.\n{"cpu":0.02,"net":{}}\n')
+        spool = SampleSpool(2, self.path)
+        self.assertEqual(spool.peek(10), [sample(0), sample(2)])
+        spool.discard()
+        self.assertEqual(spool.dropped_samples, 1)
+        self.assertEqual(len(spool), 0)
+        spool.close()
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, SampleSpool, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+This file contains the tests of pistatsstore.py, run from the top directory
+with:
+
+$ python -m unittest discover tests
+"""
+
+import unittest
+
+from pistatsstore import StatsStore, CURRENT, MAX, MIN, IFACE_OFFSETS
+
+SPANS = (("1m", 60.0),)
+
+
+def sample(cpu):
+    return {"cpu": cpu, "net": {"eth0": {"rx": 100.0, "tx": 50.0}}}
+
+
+class StatsStoreTest(unittest.TestCase):
+
+    def test_devices_are_kept_apart(self):
+        store = StatsStore()
+        store.aggregate("pi0", [sample(0.2), sample(0.6)])
+        store.aggregate("pi1", [sample(0.9)])
+        self.assertEqual(len(store), 2)
+        pi0 = store.devices["pi0"]
+        self.assertEqual((pi0.cpu[CURRENT], pi0.cpu[MAX], pi0.cpu[MIN], pi0.updates), (0.6, 0.6, 0.2, 2))
+        self.assertEqual(store.devices["pi1"].cpu[MIN], 0.9)
+        self.assertEqual(pi0.net["eth0"][IFACE_OFFSETS["rx"] + CURRENT], 100.0)
+
+    def test_delta_samples_keep_the_missing_counters(self):
+        store = StatsStore()
+        store.aggregate("pi0", [sample(0.2)])
+        device = store.aggregate("pi0", [{"cpu": 0.3, "delta": True, "net": {"eth0": {"tx": 70.0}}}])
+        record = device.net["eth0"]
+        self.assertEqual((record[IFACE_OFFSETS["rx"] + CURRENT], record[IFACE_OFFSETS["tx"] + CURRENT]), (100.0, 70.0))
+
+    def test_malformed_samples_are_ignored(self):
+        store = StatsStore()
+        self.assertEqual(store.aggregate("pi0", [{"net": {}}, {"cpu": 0.5}, [0.5]]), None)
+        self.assertEqual(len(store), 0)
+
+    def test_memory_usage_grows_with_the_devices(self):
+        store = StatsStore()
+        store.aggregate("pi0", [sample(0.2)])
+        one = store.memory_usage()
+        store.aggregate("pi0", [sample(0.3)])
+        # Updating a device allocates nothing new
+        self.assertEqual(store.memory_usage(), one)
+        store.aggregate("pi1", [sample(0.3)])
+        self.assertGreater(store.memory_usage(), one)
+
+    def test_expires_the_silent_devices(self):
+        store = StatsStore(SPANS)
+        store.aggregate("pi0", [sample(0.1)], 0.0)
+        store.aggregate("pi1", [sample(0.2)], 0.0)
+        self.assertEqual(store.expire_windows(1.0), [])
+        # pi1 reported less than a slot ago, its windows are left for later
+        store.aggregate("pi1", [sample(0.3)], 60.5)
+        self.assertEqual(store.expire_windows(61.0), ["pi0"])
+        self.assertEqual(len(store.devices["pi0"].windows[("CPU", "all")][0]), 0)
+        # Adding the value moved the windows of pi1 on already
+        self.assertEqual(store.expire_windows(63.0), [])
+        self.assertEqual(len(store.devices["pi1"].windows[("CPU", "all")][0]), 1)
+        # An empty device is only expired again once it reports
+        self.assertEqual(store.expire_windows(100.0), [])
+        store.aggregate("pi0", [sample(0.4)], 100.0)
+        self.assertEqual(sorted(store.expire_windows(200.0)), ["pi0", "pi1"])
+
+    def test_expires_the_merged_devices(self):
+        worker = StatsStore(SPANS, log_windows=True)
+        store = StatsStore(SPANS)
+        device = worker.aggregate("pi0", [sample(0.5)], 0.0)
+        # The worker only logs the values, the windows are expired where they are merged
+        self.assertEqual(worker.expire_windows(100.0), [])
+        merged = store.merge(device)
+        self.assertEqual(merged.cpu[CURRENT], 0.5)
+        self.assertEqual(store.expire_windows(100.0), ["pi0"])
+
+    def test_without_windows(self):
+        store = StatsStore()
+        store.aggregate("pi0", [sample(0.5)], 0.0)
+        self.assertEqual(store.expire_windows(100.0), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
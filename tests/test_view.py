@@ -0,0 +1,46 @@
+"""
+This file contains the tests of the command line of pistatsview.py, run from
+the top directory with:
+
+$ python -m unittest discover tests
+"""
+
+import sys
+import unittest
+from StringIO import StringIO
+
+from pistatscommon import EXCHANGE_NAMES
+from pistatsview import parse_args
+
+
+class ParseArgsTest(unittest.TestCase):
+
+    def test_defaults(self):
+        options = parse_args(["pistatsview.py", "-b", "localhost", "-k", "pi0"])
+        self.assertEqual((options["hosts"], options["topics"]), (["localhost"], ["pi0"]))
+        self.assertEqual((options["exchange_type"], options["exchange"]), ("direct", EXCHANGE_NAMES["direct"]))
+        self.assertEqual(options["share_group"], None)
+
+    def test_topic_patterns_and_share_group(self):
+        options = parse_args(["pistatsview.py", "-b", "broker1,broker2", "--exchange-type", "topic",
+                              "-k", "site1.#", "-k", "*.rack2.*", "--share-group", "viewers"])
+        self.assertEqual(options["hosts"], ["broker1", "broker2"])
+        self.assertEqual(options["topics"], ["site1.#", "*.rack2.*"])
+        self.assertEqual(options["exchange"], EXCHANGE_NAMES["topic"])
+        self.assertEqual(options["share_group"], "viewers")
+
+    def test_invalid(self):
+        stderr = sys.stderr
+        stdout = sys.stdout
+        sys.stderr = sys.stdout = StringIO()
+        try:
+            for argv in (["-b", "localhost"], ["-b", "localhost", "-k", "pi0", "--share-group"],
+                         ["-b", "localhost", "-k", "pi0", "--exchange-type", "fanout"]):
+                self.assertRaises(SystemExit, parse_args, ["pistatsview.py"] + argv)
+        finally:
+            sys.stderr = stderr
+            sys.stdout = stdout
+
+
+if __name__ == "__main__":
+    unittest.main()
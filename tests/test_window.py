@@ -0,0 +1,105 @@
+"""
+This file contains the tests of pistatswindow.py, run from the top directory
+with:
+
+$ python -m unittest discover tests
+"""
+
+import random
+import unittest
+
+from pistatswindow import RollingWindow, QuantileSketch, merged_quantile, QUANTILE_ACCURACY, QUANTILE_BUCKETS
+
+
+class RollingWindowTest(unittest.TestCase):
+
+    def test_summary(self):
+        window = RollingWindow(60.0)
+        for step, value in enumerate([0.5, 0.25, 0.75, 1.0]):
+            window.add(value, 100.0 + step)
+        self.assertEqual(len(window), 4)
+        self.assertAlmostEqual(window.mean(), 0.625)
+        self.assertEqual(window.max(), 1.0)
+        self.assertEqual(window.min(), 0.25)
+
+    def test_empty(self):
+        window = RollingWindow(60.0)
+        self.assertEqual((window.mean(), window.max(), window.min(), window.quantile(0.95)), (0.0, 0.0, 0.0, 0.0))
+        self.assertFalse(window.expire(1000.0))
+
+    def test_values_leave_the_window(self):
+        window = RollingWindow(60.0)
+        window.add(0.9, 0.0)
+        window.add(0.1, 30.0)
+        self.assertEqual(window.max(), 0.9)
+        # The first value left the window once a span went by
+        window.add(0.2, 61.0)
+        self.assertEqual(len(window), 2)
+        self.assertEqual(window.max(), 0.2)
+        self.assertEqual(window.min(), 0.1)
+        self.assertAlmostEqual(window.mean(), 0.15)
+
+    def test_expire(self):
+        window = RollingWindow(60.0)
+        window.add(0.5, 0.0)
+        window.add(0.5, 50.0)
+        self.assertFalse(window.expire(55.0))
+        self.assertTrue(window.expire(61.0))
+        self.assertEqual(len(window), 1)
+        self.assertTrue(window.expire(200.0))
+        self.assertEqual(len(window), 0)
+        self.assertEqual(window.mean(), 0.0)
+        self.assertFalse(window.expire(300.0))
+
+    def test_late_values_count_in_the_current_slot(self):
+        window = RollingWindow(60.0)
+        window.add(0.5, 30.0)
+        window.add(0.7, 10.0)
+        self.assertEqual(len(window), 2)
+        self.assertEqual(window.max(), 0.7)
+
+    def test_quantiles(self):
+        window = RollingWindow(60.0)
+        values = [random.Random(step).uniform(0.001, 1.0) for step in range(2000)]
+        for step, value in enumerate(values):
+            window.add(value, step * 0.025)
+        values.sort()
+        for p in (0.5, 0.95, 0.99):
+            exact = values[int(p * (len(values) - 1))]
+            self.assertLessEqual(abs(window.quantile(p) - exact), exact * QUANTILE_ACCURACY)
+        self.assertLessEqual(window.quantile(1.0), window.max())
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, RollingWindow, 0)
+        self.assertRaises(ValueError, RollingWindow, 60.0, 30, 7)
+
+
+class QuantileSketchTest(unittest.TestCase):
+
+    def test_merge(self):
+        values = [random.Random(step).expovariate(10.0) for step in range(1000)] + [0.0] * 10
+        merged = QuantileSketch()
+        halves = QuantileSketch(), QuantileSketch()
+        for step, value in enumerate(values):
+            merged.add(value)
+            halves[step % 2].add(value)
+        quantiles = [merged_quantile([merged], p) for p in (0.01, 0.5, 0.95, 0.99)]
+        self.assertEqual([merged_quantile(halves, p) for p in (0.01, 0.5, 0.95, 0.99)], quantiles)
+        halves[0].merge(halves[1])
+        self.assertEqual(halves[0].count, len(values))
+        self.assertEqual(halves[0].zeros, 10)
+        self.assertEqual([merged_quantile(halves[:1], p) for p in (0.01, 0.5, 0.95, 0.99)], quantiles)
+
+    def test_bounded(self):
+        # Values spread over many powers of two only blur the lowest quantiles
+        sketch = QuantileSketch()
+        values = [10.0 ** (step / 100.0 - 6) for step in range(1200)]
+        for value in values:
+            sketch.add(value)
+        self.assertLessEqual(len(sketch.buckets), QUANTILE_BUCKETS)
+        exact = values[int(0.99 * (len(values) - 1))]
+        self.assertLessEqual(abs(merged_quantile([sketch], 0.99) - exact), exact * QUANTILE_ACCURACY)
+
+
+if __name__ == "__main__":
+    unittest.main()